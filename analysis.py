@@ -1,58 +1,275 @@
 import tables
 import numpy as np
 import os
-from scipy.optimize import curve_fit
 import pylandau as landau
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import AnchoredText
 import logging
 import progressbar
 
+from event_run import EventRun, CHUNK_BYTES
+from fitting import fit_histogram, guess_start_values
+from histogram import find_thresholds
+
+class EnergyCalibration(object):
+    '''
+        Linear energy calibration energy = m * ADC channel + b. The calibration is only applied to the bin edges of the histograms, never to the counts,
+        and the calibrated edges of a binning are computed once and shared (read-only) by all histograms with that binning.
+        Parameters:
+            m:float        -    Slope in energy_unit/ADC channel as obtained from energy calibration.
+            b:float        -    Intercept in energy_unit as obtained from energy calibration.
+            unit:string    -    Name of new energy unit (e.g. Electrons / keV) to be used in axis labels.
+    '''
+    def __init__(self, m, b, unit):
+        self.m = m
+        self.b = b
+        self.unit = unit
+        self._edges = {}
+    
+    
+    def __call__(self, x, out=None):
+        '''
+            Calibrates ADC channels. With out=x the array is calibrated in place.
+        '''
+        out = np.multiply(x, self.m, out=out)
+        out += self.b
+        return out
+    
+    
+    def inverse(self, energy):
+        '''
+            Converts energies back to ADC channels.
+        '''
+        return (np.asarray(energy) - self.b) / self.m
+    
+    
+    def get_edges(self, bins=1024, hist_range=(0, 2**14-10)):
+        '''
+            Calibrated left bin edges of a binning, equal to calibrate_energy(histogram_data(...)[0]). The array is cached and read-only.
+        '''
+        key = (bins, tuple(hist_range))
+        if key not in self._edges:
+            edges = self(np.histogram(np.empty(0), bins=bins, range=hist_range)[1][:-1])
+            edges.flags.writeable = False
+            self._edges[key] = edges
+        return self._edges[key]
+    
+    
+    def __getstate__(self):
+        return dict(m=self.m, b=self.b, unit=self.unit)                         # Without the cached edges
+    
+    
+    def __setstate__(self, state):
+        self.__init__(**state)
+    
+    
 class MCA_analysis(object):
     '''
         Collection of methods for analysis of LF Diode Teststructure data obtained via qMCA setup
         Parameters:
-            outformat:string    -    [Optional] Format of saved plots. Default value is 'pdf'.
+            outformat:string       -    [Optional] Format of saved plots. Default value is 'pdf'.
+            cache:AnalysisCache    -    [Optional] Cache of the amplitudes and histograms of read_amplitudes and histogram_data_file.
     '''
-    def __init__(self, outformat='pdf'):
+    def __init__(self, outformat='pdf', cache=None):
         self.outformat = outformat
+        self.cache = cache
         self.event_count = 0
         self.errorfiles = []
         self.error = False
         self._energy_calibrated = False
         self._darkframe_corrected = False
+        self._baseline_corrected = False
+        self._data_file = None
         self._energy_slope = 0
         self._energy_intercept = 0
         self._energy_unit = 'ADC channels'
+        self.calibration = None
+        self.multi = 1.
         self.outfile= ''
+        self.fit_result = None
+        self._darkframes = {}
     
     
     def load_data_file(self, path):
         '''
-            Reads a h5 data file to memory
+            Reads a h5 data file or all files of a run index (<name>_index.json) to memory. Recent files store the events as uint16, older files as uint32. Both are supported.
+            Use EventRun to read parts of large runs and iter_data_file, read_amplitudes or histogram_data_file to analyze runs that do not fit into memory.
             Parameters:
-                path:string    -    Full path to input h5 file
+                path:string    -    Full path to input h5 file or run index
             Returns:
                 data:np.ndarray    -    Numpy array of numpy arrays containing all waveforms from path
         '''
-        if not os.path.split(path)[1].split('.')[1] == 'h5':
+        self._set_data_file(path)
+        if path.endswith('.json'):
+            with EventRun(path) as run:
+                data = run.read()
+        else:
+            with tables.open_file(path, 'r') as infile:
+                try:
+                    data = infile.root.event_data[:]
+                except tables.exceptions.HDF5ExtError:
+                    logging.error('HDF5ExtError: Blosc decompression error! Omitting last 100 events...')
+                    data = infile.root.event_data[:-100]
+            
+        self.event_count = len(data)
+        logging.debug('Event count is: %i' % self.event_count)
+        return data
+    
+    
+    def _set_data_file(self, path):
+        '''
+            Checks the filetype of path and derives title and output filename of the plots from it.
+        '''
+        if not os.path.split(path)[1].split('.')[1] in ('h5', 'json'):
             raise IOError('Wrong filetype!')
+        self._data_file = path
         self.dirpath = os.path.split(path)[0]
         self.f = os.path.split(path)[1]
         self.title = self._make_title(os.path.split(path)[1].split('.')[0])
         self.outfile = os.path.join(os.path.split(path)[0], (os.path.split(path)[1].split('.')[0]))
         self._energy_calibrated = False
         self._darkframe_corrected = False
-        with tables.open_file(path, 'r') as infile:
-            try:
-                data = infile.root.event_data[:]
-            except tables.exceptions.HDF5ExtError:
-                logging.error('HDF5ExtError: Blosc decompression error! Omitting last 100 events...')
-                data = infile.root.event_data[:-100]
-            
-        self.event_count = len(data)
+        self._baseline_corrected = False
+        self.calibration = None
+    
+    
+    def iter_data_file(self, path, max_bytes=CHUNK_BYTES):
+        '''
+            Streams the waveforms of a h5 data file or run index in blocks that follow the HDF5 chunk layout (see EventRun.iter_chunks), so runs of any size can be analyzed with bounded memory.
+            Title, output filename and event count are set like by load_data_file.
+            Parameters:
+                path:string         -    Full path to input h5 file or run index
+                max_bytes:int       -    [Optional] Maximum size of a block in bytes
+            Returns:
+                blocks:generator    -    Consecutive (n, sample_count) arrays of waveforms
+        '''
+        self._set_data_file(path)
+        run = EventRun(path)
+        self.event_count = run.n_events
         logging.debug('Event count is: %i' % self.event_count)
-        return data
+        return self._iter_run(run, max_bytes)
+    
+    
+    def _iter_run(self, run, max_bytes=CHUNK_BYTES):
+        try:
+            for _, data in run.iter_chunks(max_bytes):
+                yield data
+        except tables.exceptions.HDF5ExtError:
+            logging.error('HDF5ExtError: Blosc decompression error! Omitting remaining events...')
+        finally:
+            run.close()
+    
+    
+    def _get_amplitudes(self, data, baseline_correction=False, baseline_samples=40, saturation=2**14-1):
+        '''
+            Amplitudes (maximum sample) of a block of waveforms. With baseline_correction they are equal to np.amax(self.correct_baseline(data), axis=1),
+            i.e. the rounded mean of the first baseline_samples samples is substracted and saturated waveforms are omitted.
+        '''
+        amplitudes = np.amax(data, axis=1)
+        if not baseline_correction:
+            return amplitudes
+        unsaturated = amplitudes < saturation
+        return (amplitudes[unsaturated] - self._get_baselines(data[unsaturated], baseline_samples)).astype(np.int64)
+    
+    
+    def read_amplitudes(self, path, baseline_correction=False, baseline_samples=40, max_bytes=CHUNK_BYTES):
+        '''
+            Streams a h5 data file or run index and returns the amplitude of every waveform. Only one block of waveforms is in memory at a time.
+            Parameters:
+                path:string                 -    Full path to input h5 file or run index
+                baseline_correction:bool    -    [Optional] Substract the baseline and omit saturated waveforms like correct_baseline
+                baseline_samples:int        -    [Optional] Number of samples at the beginning of every waveform used as baseline
+                max_bytes:int               -    [Optional] Maximum size of a block of waveforms in bytes
+            Returns:
+                amplitudes:np.ndarray       -    Amplitude of every waveform, equal to np.amax(data, axis=1) of the in-memory path
+        '''
+        amplitudes = self._read_amplitudes(path, baseline_correction, baseline_samples, max_bytes)
+        if baseline_correction:
+            self.outfile += '_baselineCorrected'
+            self._baseline_corrected = True
+        return amplitudes
+    
+    
+    def _read_amplitudes(self, path, baseline_correction=False, baseline_samples=40, max_bytes=CHUNK_BYTES):
+        params = dict(baseline_correction=baseline_correction, baseline_samples=baseline_samples if baseline_correction else None)
+        entry = self._get_cached(path, 'amplitudes', params)
+        if entry is not None:
+            return entry['amplitudes']
+        amplitudes = [self._get_amplitudes(data, baseline_correction, baseline_samples) for data in self.iter_data_file(path, max_bytes)]
+        amplitudes = np.concatenate(amplitudes) if amplitudes else np.empty(0, dtype=np.int64)
+        if self.cache is not None:
+            self.cache.put(path, 'amplitudes', params, info=dict(event_count=self.event_count), amplitudes=amplitudes)
+        return amplitudes
+    
+    
+    def _get_cached(self, path, kind, params):
+        '''
+            Looks up a result of path in the cache. On a hit the title, output filename and event count are set like by iter_data_file.
+        '''
+        if self.cache is None:
+            return None
+        entry = self.cache.get(path, kind, params)
+        if entry is not None:
+            self._set_data_file(path)
+            self.event_count = entry['info']['event_count']
+        return entry
+    
+    
+    def histogram_data_file(self, path, bins=1024, hist_range=(0, 2**14-10), baseline_correction=False, baseline_samples=40, max_bytes=CHUNK_BYTES):
+        '''
+            Streams a h5 data file or run index and histograms the waveforms. The result is identical to histogram_data(load_data_file(path)),
+            or with baseline_correction to histogram_data(correct_baseline(load_data_file(path))), but only one block of waveforms is in memory at a time.
+            With a cache, the histogram is computed from the cached amplitudes, so it is only read once for all binnings.
+            Parameters:
+                path:string                 -    Full path to input h5 file or run index
+                bins:int                    -    [Optional] Number of bins in the histogram.
+                hist_range:tuple            -    [Optional] Minimum and maximum label of x-axis of the histogram.
+                baseline_correction:bool    -    [Optional] Substract the baseline and omit saturated waveforms like correct_baseline
+                baseline_samples:int        -    [Optional] Number of samples at the beginning of every waveform used as baseline
+                max_bytes:int               -    [Optional] Maximum size of a block of waveforms in bytes
+            Returns:
+                x:np.ndarray                -    Bin edges of histogram.
+                y:np.ndarray                -    Histogrammed amplitudes per bin.
+        '''
+        if self.cache is None:
+            x, y = self._histogram_blocks(self.iter_data_file(path, max_bytes), bins, hist_range, baseline_correction, baseline_samples)
+        else:
+            params = dict(bins=bins, hist_range=hist_range, baseline_correction=baseline_correction, baseline_samples=baseline_samples if baseline_correction else None)
+            entry = self._get_cached(path, 'histogram', params)
+            if entry is not None:
+                x, y = entry['x'], entry['y']
+            else:
+                x, y = self.histogram_amplitudes(self._read_amplitudes(path, baseline_correction, baseline_samples, max_bytes), bins, hist_range)
+                self.cache.put(path, 'histogram', params, info=dict(event_count=self.event_count), x=x, y=y)
+        if baseline_correction:
+            self.outfile += '_baselineCorrected'
+            self._baseline_corrected = True
+        return x, y
+    
+    
+    def histogram_amplitudes(self, amplitudes, bins=1024, hist_range=(0, 2**14-10)):
+        '''
+            Histograms amplitudes, e.g. of read_amplitudes. histogram_amplitudes(np.amax(data, axis=1)) is equal to histogram_data(data).
+            Parameters:
+                amplitudes:np.ndarray    -    Amplitude of every waveform.
+                bins:int                 -    [Optional] Number of bins in the histogram.
+                hist_range:tuple         -    [Optional] Minimum and maximum label of x-axis of the histogram.
+            Returns:
+                x:np.ndarray             -    Bin edges of histogram.
+                y:np.ndarray             -    Histogrammed amplitudes per bin.
+        '''
+        hist, edges = np.histogram(amplitudes, bins=bins, range=hist_range)
+        return edges[:-1], hist
+    
+    
+    def _histogram_blocks(self, blocks, bins=1024, hist_range=(0, 2**14-10), baseline_correction=False, baseline_samples=40):
+        '''
+            Adds the histograms of the amplitudes of all blocks of waveforms. Histograms with fixed bins are additive, so the sum equals the histogram of all waveforms.
+        '''
+        hist, edges = np.histogram(np.empty(0), bins=bins, range=hist_range)
+        for data in blocks:
+            hist += np.histogram(self._get_amplitudes(data, baseline_correction, baseline_samples), bins=bins, range=hist_range)[0]
+        return edges[:-1], hist
     
     
     def _make_title(self, filename):
@@ -115,7 +332,7 @@ class MCA_analysis(object):
         '''
         if multi is not None:
             self.multi = multi
-        return np.array([v*self.multi for v in y])
+        return np.multiply(y, self.multi)
     
     
     def just_plot_waveform(self, y, threshold):
@@ -154,8 +371,8 @@ class MCA_analysis(object):
                 n_max:int          -    [Optional] Maximum number of waveforms to plot for performance reasons. n_max=None plots all waveforms in data.
                 cut:int            -    [Optional] Maximum amplitude. Waveforms with amplitude > cut are not included into the plot.
         '''
-        _, histy = self.histogram_data(data)
-        threshold = self.find_threshold(histy)
+        histx, histy = self.histogram_data(data)
+        threshold = self.find_threshold(histy, x=histx)
         
         if n_max is None:
             alp = 100./len(data)
@@ -189,51 +406,110 @@ class MCA_analysis(object):
         plt.savefig(outfile)
     
     
-    def substract_darkframe(self, y, datafile):
+    def substract_darkframe(self, y, datafile, normalize=None, hist_range=(0, 2**14-10)):
         '''
-            Reads a darkframe from the h5 file, histograms the waveforms and substracts the histogram from the data.
+            Streams a darkframe from the h5 file or run index, histograms the waveforms and substracts the histogram from the data. Negative bins are set to 0.
+            The darkframe histogram is computed once per file and binning and kept in memory (and in the cache, if any).
             Parameters:
-                y:np.ndarray       -    Histogram y-values of the data.
-                datafile:string    -    Full path to darkframe h5 file.
+                y:np.ndarray         -    Histogram y-values of the data.
+                datafile:string      -    Full path to darkframe h5 file or run index.
+                normalize:string     -    [Optional] Scale the darkframe to the data by the number of events ('events') or by the measurement time ('time') of both files.
+                hist_range:tuple     -    [Optional] Range of the histogram of the data, the number of bins is taken from y.
             Returns:
-                y:np.ndarray       -    Difference of histogram y-values and darkframe histogram y-values.
+                y:np.ndarray         -    Difference of histogram y-values and darkframe histogram y-values.
         '''
-        if not os.path.split(datafile)[1].split('.')[1] == 'h5':
+        if not os.path.split(datafile)[1].split('.')[1] in ('h5', 'json'):
             raise IOError('Wrong filetype!')
-        with tables.open_file(datafile, 'r') as infile:
-            darkframe_data = infile.root.event_data[:]
+        darkframe, darkframe_events, darkframe_time = self._get_darkframe(datafile, len(y), hist_range)
+        if normalize == 'events':
+            darkframe = darkframe * (float(self.event_count) / darkframe_events)
+        elif normalize == 'time':
+            with EventRun(os.path.join(self.dirpath, self.f)) as run:
+                live_time = run.get_live_time()
+            if live_time is None or not darkframe_time:
+                raise ValueError('Measurement time of %s or the darkframe is unknown' % self.f)
+            darkframe = darkframe * (live_time / darkframe_time)
+        elif normalize is not None:
+            raise ValueError('Unknown normalization %s' % normalize)
             
         logging.debug('Darkframe correction successful!')
         self._darkframe_corrected = True
-        _, darkframe = self.histogram_data(darkframe_data)
-        return np.array([v if v > 0 else 0 for v in (y - darkframe)])
+        return np.maximum(y - darkframe, 0)
+    
+    
+    def _get_darkframe(self, datafile, bins, hist_range):
+        '''
+            Histogram, number of events and measurement time of a darkframe.
+        '''
+        stat = os.stat(datafile)
+        key = (os.path.abspath(datafile), stat.st_size, stat.st_mtime, bins, tuple(hist_range))
+        if key not in self._darkframes:
+            params = dict(bins=bins, hist_range=hist_range)
+            entry = self.cache.get(datafile, 'darkframe', params) if self.cache is not None else None
+            if entry is not None:
+                self._darkframes[key] = entry['y'], entry['info']['event_count'], entry['info']['live_time']
+            else:
+                run = EventRun(datafile)
+                live_time = run.get_live_time()
+                _, darkframe = self._histogram_blocks(self._iter_run(run), bins, hist_range)
+                self._darkframes[key] = darkframe, run.n_events, live_time
+                if self.cache is not None:
+                    self.cache.put(datafile, 'darkframe', params, info=dict(event_count=run.n_events, live_time=live_time), y=darkframe)
+        return self._darkframes[key]
         
         
-    def correct_baseline(self, data):
+    def correct_baseline(self, data, baseline_samples=40, saturation=2**14-1, dtype=np.int64, in_place=False, return_baselines=False, baseline_plot='baseline_histogram.pdf'):
+        '''
+            Substracts the baseline, the rounded mean of the first baseline_samples samples, from every waveform and omits saturated waveforms.
+            Works on any block of waveforms, e.g. the blocks of iter_data_file, if baseline_plot is None.
+            Parameters:
+                data:np.ndarray           -    (n, sample_count) array of waveforms.
+                baseline_samples:int      -    [Optional] Number of samples at the beginning of every waveform used as baseline.
+                saturation:int            -    [Optional] Waveforms with a maximum of at least saturation are omitted. None keeps all waveforms.
+                dtype:np.dtype            -    [Optional] Data type of the corrected waveforms.
+                in_place:bool             -    [Optional] Substract the baselines in data, which needs a signed integer or float data type. No copy is made if no waveform is omitted.
+                return_baselines:bool     -    [Optional] Return the baselines of the returned waveforms as well.
+                baseline_plot:string      -    [Optional] Filename of the histogram of all baselines. None does not plot.
+            Returns:
+                data:np.ndarray           -    Corrected waveforms without the saturated ones.
+                baselines:np.ndarray      -    Baseline of every returned waveform, only if return_baselines.
+        '''
         self.outfile += '_baselineCorrected'
-        new_data = []
-        baselines = []
-        for wave in data:
-            new_wave = []
-            baseline = np.round(np.mean(wave[:40]))
-            baselines.append(baseline)
-
-            for sample in wave:
-                new_wave.append(int(sample - baseline))
-            
-            if np.amax(wave) < 2**14-1:
-                new_data.append(np.array(new_wave))
-        
-        logging.debug('Mean baseline was at %i' % np.mean(baselines))
-        plt.hist(baselines, 50)
-        plt.xlabel('Baseline [ADC]')
-        plt.ylabel('#')
-        plt.grid()
-        plt.savefig('baseline_histogram.pdf')
-        
-        return np.array(new_data)
-        
+        self._baseline_corrected = True
+        data = np.asarray(data)
+        baselines = self._get_baselines(data, baseline_samples)
+        if len(baselines):
+            logging.debug('Mean baseline was at %i' % np.mean(baselines))
+        if baseline_plot is not None:
+            plt.hist(baselines, 50)
+            plt.xlabel('Baseline [ADC]')
+            plt.ylabel('#')
+            plt.grid()
+            plt.savefig(baseline_plot)
         
+        unsaturated = np.amax(data, axis=1) < saturation if saturation is not None and len(data) else None
+        if in_place:
+            if data.dtype.kind not in 'if':
+                raise TypeError('In place baseline correction needs signed integer or float data, not %s' % data.dtype)
+            new_data = data
+        else:
+            new_data = data.astype(dtype)
+        new_data -= baselines.astype(new_data.dtype)[:, np.newaxis]
+
+        if unsaturated is not None and not unsaturated.all():
+            new_data, baselines = new_data[unsaturated], baselines[unsaturated]
+        if return_baselines:
+            return new_data, baselines
+        return new_data
+    
+    
+    def _get_baselines(self, data, baseline_samples=40):
+        '''
+            Rounded mean of the first baseline_samples samples of every waveform.
+        '''
+        return np.round(np.mean(data[:, :baseline_samples], axis=1))
+    
+    
     def histogram_data(self, data, bins=1024, hist_range=(0, 2**14-10)):
         '''
             Histograms a set of waveforms.
@@ -249,23 +525,28 @@ class MCA_analysis(object):
         return edges[:-1], hist
        
        
-    def calibrate_energy(self, x, m, b, unit):
+    def calibrate_energy(self, x, m=None, b=None, unit=None, calibration=None, out=None):
         '''
             Perform energy calibration of histogrammed data.
             Parameters:
-                x:np.ndarray    -    x-values of histogrammed data in ADC channels.
-                m:float         -    Slope in energy_unit/ADC channel as obtained from energy calibration.
-                b:float         -    Intercept in energy_unit as obtained from energy calibration.
-                unit:string     -    Name of new energy unit (e.g. Electrons / keV) to be used in axis labels.
+                x:np.ndarray                     -    x-values of histogrammed data in ADC channels.
+                m:float                          -    Slope in energy_unit/ADC channel as obtained from energy calibration.
+                b:float                          -    Intercept in energy_unit as obtained from energy calibration.
+                unit:string                      -    Name of new energy unit (e.g. Electrons / keV) to be used in axis labels.
+                calibration:EnergyCalibration    -    [Optional] Calibration to use instead of m, b and unit.
+                out:np.ndarray                   -    [Optional] Array for the result, e.g. x to calibrate in place.
             Returns:
-                x:np.ndarray    -    x-values of histogrammed data in new energy unit.
+                x:np.ndarray                     -    x-values of histogrammed data in new energy unit.
         '''
+        if calibration is None:
+            calibration = EnergyCalibration(m, b, unit)
+        self.calibration = calibration
         self._energy_calibrated = True
-        self._energy_slope = m
-        self._energy_intercept = b
-        self._energy_unit = unit
+        self._energy_slope = calibration.m
+        self._energy_intercept = calibration.b
+        self._energy_unit = calibration.unit
         self.outfile += '_calibrated'
-        return np.array([m*newx+b for newx in x])
+        return calibration(x, out=out)
 
 
     def _fitfunction_testbeam(self, x, *p):
@@ -287,28 +568,55 @@ class MCA_analysis(object):
         return A*np.exp(-(x-mu)**2/(2*sigma**2))
     
     
-    def find_threshold(self, y, condition=90):
+    def get_acquisition_threshold(self):
         '''
-            Automatically finds used threshold of histogrammed data.
+            Trigger threshold of the acquisition of the current data file from its readout table. If the threshold was changed during the run, the lowest one is returned.
+            Returns:
+                threshold:int      -    Threshold in ADC channels, None for files without readout table.
+        '''
+        if self._data_file is None:
+            return None
+        with EventRun(self._data_file) as run:
+            readout_data = run.read_readouts()
+        if len(readout_data) == 0:
+            return None
+        return int(np.amin(readout_data['threshold']))
+    
+    
+    def find_threshold(self, y, condition=90, x=None, use_metadata=True):
+        '''
+            Finds the threshold of histogrammed data. The threshold of the acquisition is used if it is known (see get_acquisition_threshold),
+            otherwise the left edge of the first bin whose y-value is higher than condition times the y-value 2 bins below (see histogram.find_thresholds).
             Parameters:
-                y:np.ndarray       -    y-values of histogrammed data.
-                condition:int    -    At the threshold, the y-value rises by this factor within 2 bins.
+                y:np.ndarray          -    y-values of histogrammed data, or of many histograms with the same bins (one per row).
+                condition:int         -    [Optional] At the threshold, the y-value rises by this factor within 2 bins.
+                x:np.ndarray          -    [Optional] Bin edges (or x-values) of histogrammed data. The bins of histogram_data with len(y) bins if None.
+                use_metadata:bool     -    [Optional] Use the threshold of the acquisition. Only for a single histogram of the current data file without baseline correction.
             Returns:
-                threshold:int      -    Threshold energy in the same unit as x-values.
+                threshold:float       -    Threshold energy in the same unit as x-values, 0 if not found. One threshold per row for many histograms.
         '''
-        threshold = 0      
-        for i in range(0,len(y)):
-            if y[i]/condition > y[i-2]:
-                threshold = i*16
-                break
-        if threshold == 0:
+        y = np.asarray(y)
+        if use_metadata and y.ndim == 1 and not self._baseline_corrected:
+            threshold = self.get_acquisition_threshold()
+            if threshold is not None:
+                if self._energy_calibrated:
+                    threshold = self._energy_slope*threshold + self._energy_intercept
+                logging.debug('Threshold of the acquisition: %i' % threshold)
+                return threshold
+        
+        if x is None:
+            x = np.linspace(0, 2**14-10, y.shape[-1] + 1)
+            if self._energy_calibrated:
+                x = self._energy_slope*x + self._energy_intercept
+        threshold = find_thresholds(y, x, condition)
+        not_found = np.isnan(threshold)
+        if np.any(not_found):
             logging.error('Could not determine threshold!')
-            self.errorfiles.append([os.path.join(self.dirpath, self.f), 'Could not determine threshold!'])
+            self.errorfiles.append([self._data_file, 'Could not determine threshold!'])
             #self.error = True
-        else:
-            threshold = int(round(threshold/500.0) * 500.0)
-            if self._energy_calibrated:
-                threshold = self._energy_slope*threshold + self._energy_intercept
+            threshold = np.where(not_found, 0, threshold)
+        if y.ndim == 1:
+            threshold = float(threshold)
             logging.debug('Automatically found threshold: %i' % threshold)
         return threshold
     
@@ -321,7 +629,7 @@ class MCA_analysis(object):
                 y:np.ndarray        -    y-values of histogrammed data.
                 ymax:int            -    [Optional] Maximum of y-axis of plot. Obtained automatically if None.
         '''
-        threshold = self.find_threshold(y)
+        threshold = self.find_threshold(y, x=x)
         plot_range = (threshold, np.round(np.amax(x)))
         
         if ymax is None:
@@ -352,19 +660,24 @@ class MCA_analysis(object):
         plt.savefig(self.outfile + '.' + self.outformat)
         
         
-    def fit_langau(self, x, y, p0, fit_range, ymax=None, debug=False):
+    def fit_langau(self, x, y, p0=None, fit_range=None, ymax=None, debug=False, bounds=None, cost='lsq'):
         '''
             Fit a simple langau function only to peak of arbitrary spectrum and plot both data and fitted function.
             Parameters:
                 x:np.ndarray       -    x-values of histogrammed data.
                 y:np.ndarray       -    y-values of histogrammed data.
-                p0:tuple           -    Set of startparameters for fit. Format: (mu, eta, sigma, A).
-                fit_range:tuple    -    Approximate region of peak where the fit should be performed.
+                p0:tuple           -    [Optional] Set of startparameters for fit. Format: (mu, eta, sigma, A). Obtained automatically if None.
+                fit_range:tuple    -    [Optional] Approximate region of peak where the fit should be performed. Obtained automatically if None.
                 ymax:int           -    [Optional] Maximum of y-axis of plot. Obtained automatically if None.
                 debug:boolean      -    [Optional] If set, the fitfunction is plotted with startparameters for debugging.
+                bounds:tuple       -    [Optional] (lower, upper) bounds of the parameters, see fitting.fit_histogram. None entries keep the default bounds.
+                cost:string        -    [Optional] 'lsq', 'chi2' or 'poisson', see fitting.fit_histogram.
+            Returns:
+                p:tuple            -    Fitted parameters, p0 if the fit failed.
         '''
         self.error = False
-        threshold = self.find_threshold(y)
+        self.fit_result = None
+        threshold = self.find_threshold(y, x=x)
         plot_range = (threshold, np.round(np.amax(x)))
         
         if fit_range is None:
@@ -372,11 +685,18 @@ class MCA_analysis(object):
         if ymax is None:
             ymax = 1.1*np.amax(y)
         
+        in_plot = (x > plot_range[0]) & (x < plot_range[1])
+        in_fit = (x > fit_range[0]) & (x < fit_range[1])
+        if p0 is None:
+            p0 = guess_start_values(x, y, 'langau', fit_range)
+        p0 = tuple(p0)
+        
         try:
-            p, _ = curve_fit(landau.langau, x[(x > fit_range[0]) & (x < fit_range[1])], y[(x > fit_range[0]) & (x < fit_range[1])], p0=p0)
+            self.fit_result = fit_histogram(x, y, 'langau', p0, fit_range, bounds, cost)
+            p = self.fit_result['p']
             if debug:
                 p = p0
-        except RuntimeError as e:
+        except (RuntimeError, ValueError) as e:
             logging.error('Encountered an error during analysis of file %s: %s' % (os.path.join(self.dirpath, self.f), e))
             self.errorfiles.append([os.path.join(self.dirpath, self.f), e])
             self.error = True
@@ -388,14 +708,12 @@ class MCA_analysis(object):
             self.error = True
             p = p0
         
-        p = tuple([abs(e) for e in p])
-        
         logging.debug('Fitparameters:\nmu = %1.3f\neta = %1.3f\nsigma = %1.3f\nA = %1.3f' % tuple(p))
         
         plt.cla()
-        plt.plot(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], label='Data', color='blue', zorder=0, linewidth=1)
-        plt.fill_between(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], facecolor='blue', alpha=0.3, zorder=0)
-        plt.plot(x[(x > fit_range[0]) & (x < fit_range[1])], landau.langau(x, *p)[(x > fit_range[0]) & (x < fit_range[1])], label='Fit', color='red', zorder=2, linewidth=1)
+        plt.plot(x[in_plot], y[in_plot], label='Data', color='blue', zorder=0, linewidth=1)
+        plt.fill_between(x[in_plot], y[in_plot], facecolor='blue', alpha=0.3, zorder=0)
+        plt.plot(x[in_fit], landau.langau(x[in_fit], *p), label='Fit', color='red', zorder=2, linewidth=1)
         
         if self._energy_calibrated:
             plt.xlim(self._energy_intercept,np.round(np.amax(x)))
@@ -421,30 +739,42 @@ class MCA_analysis(object):
         ax.annotate('Threshold', xy=(threshold,0), xytext=(threshold,-0.1*ymax), horizontalalignment='center', arrowprops=dict(facecolor='black', shrink=0.05, width=0, headwidth=0))
         
         plt.savefig(self.outfile + '.' + self.outformat)
+        return p
         
         
-    def fit_source_spectrum(self, x, y, p0, fit_range=None, ymax=None, debug=False):
+    def fit_source_spectrum(self, x, y, p0=None, fit_range=None, ymax=None, debug=False, bounds=None, cost='lsq'):
         '''
             Fit custom fitfunction to spectrum from sourcescan and plot both data and fitted function.
             Parameters:
                 x:np.ndarray       -    x-values of histogrammed data.
                 y:np.ndarray       -    y-values of histogrammed data.
-                p0:tuple           -    Set of startparameters for fit. Format: (mu, eta, sigma, A).
+                p0:tuple           -    [Optional] Set of startparameters for fit. Format: (mu, sigma, A). Obtained automatically if None.
                 fit_range:tuple    -    [Optional] Region where the fit should be performed. Obtained automatically if None.
                 ymax:int           -    [Optional] Maximum of y-axis of plot. Obtained automatically if None.
                 debug:boolean      -    [Optional] If set, the fitfunction is plotted with startparameters for debugging.
+                bounds:tuple       -    [Optional] (lower, upper) bounds of the parameters, see fitting.fit_histogram. None entries keep the default bounds.
+                cost:string        -    [Optional] 'lsq', 'chi2' or 'poisson', see fitting.fit_histogram.
+            Returns:
+                p:tuple            -    Fitted parameters, p0 if the fit failed.
         '''
         self.error = False
-        threshold = self.find_threshold(y)
+        self.fit_result = None
+        threshold = self.find_threshold(y, x=x)
         if not fit_range or fit_range == 'auto':
             fit_range = (threshold, np.round(np.amax(x)))
         if ymax is None:
             ymax = 1.1*np.amax(y)
         
         plot_range = (threshold, np.round(np.amax(x)))
+        in_plot = (x > plot_range[0]) & (x < plot_range[1])
+        in_fit = (x > fit_range[0]) & (x < fit_range[1])
+        if p0 is None:
+            p0 = guess_start_values(x, y, 'gauss', fit_range)
+        p0 = tuple(p0)
 
         try:
-            p, _ = curve_fit(self._fitfunction_source, x[(x > fit_range[0]) & (x < fit_range[1])], y[(x > fit_range[0]) & (x < fit_range[1])], p0=p0)
+            self.fit_result = fit_histogram(x, y, 'gauss', p0, fit_range, bounds, cost)
+            p = self.fit_result['p']
             logging.debug('Fit successful! Parameters:')
             
             if debug:
@@ -454,18 +784,13 @@ class MCA_analysis(object):
                 logging.error('Encountered an error during analysis of file %s: Peak is below threshold!' % (os.path.join(self.dirpath, self.f)))
                 self.errorfiles.append([os.path.join(self.dirpath, self.f), 'Fit: Peak below threshold!'])
                 self.error = True
-        except RuntimeError as e:
+        except (RuntimeError, ValueError) as e:
             logging.error('Encountered an error during analysis of file %s: %s' % (os.path.join(self.dirpath, self.f), e))
             self.errorfiles.append([os.path.join(self.dirpath, self.f), e])
             self.error = True
         
         if self.error:
             p = p0
-        else:
-            if len(p) == 5:
-                p = tuple([abs(e) for e in p])
-            elif len(p) == 7:
-                p = tuple([abs(e) for e in p[:-2]]) + (p[5], p[6])
         
         if len(p) == 5:
             logging.debug('Fitparameters:\nmu = %1.3f\nsigma = %1.3f\nA = %1.3f\np4 = %1.3f\np5 = %1.3f' % (p))
@@ -478,9 +803,9 @@ class MCA_analysis(object):
             logging.debug(str) 
         
         plt.cla()
-        plt.plot(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], label='Data', color='blue', zorder=0, linewidth=1)
-        plt.fill_between(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], facecolor='blue', alpha=0.3, zorder=0)
-        plt.plot(x[(x > fit_range[0]) & (x < fit_range[1])], self._fitfunction_source(x, *p)[(x > fit_range[0]) & (x < fit_range[1])], label='Fit', color='red', zorder=2, linewidth=1)
+        plt.plot(x[in_plot], y[in_plot], label='Data', color='blue', zorder=0, linewidth=1)
+        plt.fill_between(x[in_plot], y[in_plot], facecolor='blue', alpha=0.3, zorder=0)
+        plt.plot(x[in_fit], self._fitfunction_source(x[in_fit], *p), label='Fit', color='red', zorder=2, linewidth=1)
         
         if self._energy_calibrated:
             plt.xlim(self._energy_intercept, np.round(np.amax(x)))
@@ -514,30 +839,42 @@ class MCA_analysis(object):
         ax.annotate('Threshold', xy=(threshold,0), xytext=(threshold,-0.1*ymax), horizontalalignment='center', arrowprops=dict(facecolor='black', shrink=0.05, width=0, headwidth=0))
         
         plt.savefig(self.outfile + '.' + self.outformat)
+        return p
         
         
-    def fit_testbeam_spectrum(self, x, y, p0, fit_range=None, ymax=None, debug=False, detail=False):
+    def fit_testbeam_spectrum(self, x, y, p0=None, fit_range=None, ymax=None, debug=False, detail=False, bounds=None, cost='lsq'):
         '''
             Fit custom fitfunction to spectrum from testbeam and plot both data and fitted function.
             Parameters:
                 x:np.ndarray       -    x-values of histogrammed data.
                 y:np.ndarray       -    y-values of histogrammed data.
-                p0:tuple           -    Set of startparameters for fit. Format: (mu, eta, sigma, A).
+                p0:tuple           -    [Optional] Set of startparameters for fit. Format: (mu, eta, sigma, A, p4, p5). Obtained automatically if None.
                 fit_range:tuple    -    [Optional] Region where the fit should be performed. Obtained automatically if None.
                 ymax:int           -    [Optional] Maximum of y-axis of plot. Obtained automatically if None.
                 debug:boolean      -    [Optional] If set, the fitfunction is plotted with startparameters for debugging.
+                bounds:tuple       -    [Optional] (lower, upper) bounds of the parameters, see fitting.fit_histogram. None entries keep the default bounds.
+                cost:string        -    [Optional] 'lsq', 'chi2' or 'poisson', see fitting.fit_histogram.
+            Returns:
+                p:tuple            -    Fitted parameters, p0 if the fit failed.
         '''
         self.error = False
-        threshold = self.find_threshold(y)
+        self.fit_result = None
+        threshold = self.find_threshold(y, x=x)
         if not fit_range or fit_range == 'auto':
             fit_range = (threshold, np.round(np.amax(x)))
         if ymax is None:
             ymax = 1.1*np.amax(y)
         
         plot_range = (threshold, np.round(np.amax(x)))
+        in_plot = (x > plot_range[0]) & (x < plot_range[1])
+        in_fit = (x > fit_range[0]) & (x < fit_range[1])
+        if p0 is None:
+            p0 = guess_start_values(x, y, 'testbeam', fit_range)
+        p0 = tuple(p0)
 
         try:
-            p, _ = curve_fit(self._fitfunction_testbeam, x[(x > fit_range[0]) & (x < fit_range[1])], y[(x > fit_range[0]) & (x < fit_range[1])], p0=p0)
+            self.fit_result = fit_histogram(x, y, 'testbeam', p0, fit_range, bounds, cost)
+            p = self.fit_result['p']
             
             mpv = float(x[np.argmax(landau.langau(x, p[0], p[1], p[2], p[3]))])
             
@@ -556,7 +893,7 @@ class MCA_analysis(object):
                 logging.error('Encountered an error during analysis of file %s: Oscillation occurred!' % (self.f))
                 self.errorfiles.append([os.path.join(self.dirpath, self.f), 'Fit: Oscillation occurred!'])
                 #self.error = True
-        except RuntimeError as e:
+        except (RuntimeError, ValueError) as e:
             logging.error('Encountered an error during analysis of file %s: %s' % (self.f, e))
             self.errorfiles.append([os.path.join(self.dirpath, self.f), e])
             self.error = True
@@ -564,19 +901,17 @@ class MCA_analysis(object):
         if self.error:
             p = p0
             mpv = p0[0]
-        else:
-            p = tuple([abs(e) for e in p])
         
         logging.debug('Fitparameters:\nMPV = %1.2f\nmu = %1.3f\neta = %1.3f\nsigma = %1.3f\nA = %1.3f\np4 = %1.3f\np5 = %1.3f' % ((mpv,) + p))
         
         plt.cla()
-        plt.plot(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], label='Data', color='blue', zorder=0, linewidth=1)
-        plt.fill_between(x[(x > plot_range[0]) & (x < plot_range[1])], y[(x > plot_range[0]) & (x < plot_range[1])], facecolor='blue', alpha=0.3, zorder=0)
-        plt.plot(x[(x > fit_range[0]) & (x < fit_range[1])], self._fitfunction_testbeam(x, *p)[(x > fit_range[0]) & (x < fit_range[1])], label='Fit', color='red', zorder=2, linewidth=1)
+        plt.plot(x[in_plot], y[in_plot], label='Data', color='blue', zorder=0, linewidth=1)
+        plt.fill_between(x[in_plot], y[in_plot], facecolor='blue', alpha=0.3, zorder=0)
+        plt.plot(x[in_fit], self._fitfunction_testbeam(x[in_fit], *p), label='Fit', color='red', zorder=2, linewidth=1)
         
         if detail:
-            plt.plot(x[(x > fit_range[0]) & (x < fit_range[1])], landau.langau(x, *p[:4])[(x > fit_range[0]) & (x < fit_range[1])], label='Langau', color='purple', linestyle='--', zorder=2, linewidth=1)
-            plt.plot(x[(x > fit_range[0]) & (x < fit_range[1])], p[4]*np.exp(-x/p[5])[(x > fit_range[0]) & (x < fit_range[1])], label='Exponential', color='yellow', linestyle='--', zorder=2, linewidth=1)
+            plt.plot(x[in_fit], landau.langau(x[in_fit], *p[:4]), label='Langau', color='purple', linestyle='--', zorder=2, linewidth=1)
+            plt.plot(x[in_fit], p[4]*np.exp(-x[in_fit]/p[5]), label='Exponential', color='yellow', linestyle='--', zorder=2, linewidth=1)
             plt.plot([mpv, mpv], [0., ymax], label='MPV', color='green', linestyle='--')
         
         if self._energy_calibrated:
@@ -603,6 +938,7 @@ class MCA_analysis(object):
         ax.annotate('Threshold', xy=(threshold,0), xytext=(threshold,-0.1*ymax), horizontalalignment='center', arrowprops=dict(facecolor='black', shrink=0.05, width=0, headwidth=0))
         
         plt.savefig(self.outfile + '.' + self.outformat)
+        return p
         
     
         
@@ -649,32 +985,13 @@ if __name__ == "__main__":
     
     
     '''
-    Just plot a bunch of histograms
+    Just plot a bunch of histograms (all h5 files and run indices in folder, recursively, in parallel)
     '''
+#     from batch_analysis import BatchAnalysis
 #     folder = '/path/to/data'
-#       
-#     files = []
-#     for (dirpath, dirnames, filenames) in os.walk(folder):
-#         for f in filenames:
-#             if not os.path.split(f)[1].split('.')[1] == 'h5':
-#                 continue
-#             files.append(os.path.join(dirpath, f))
-#       
-#     pbar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(files), poll=10, term_width=80).start()
-#     i=1
-#     for f in files:
-#         try:
-#             ''' Do analysis here '''
-#             data = a.load_data_file(f)
-#             x,y = a.histogram_data(data)
-#             a.just_plot_histogram(x, y)
-#             
-#         except Exception as e:
-#             logging.error('Encountered an error during analysis of file %s: %s' % (f, e))
-#             continue
-#         pbar.update(i)
-#         i += 1
-#     pbar.finish()
+#     
+#     batch = BatchAnalysis('histogram', plot=True)
+#     batch.run(folder)
   
     
     '''
@@ -721,50 +1038,15 @@ if __name__ == "__main__":
     
     
     '''
-    Analyze all h5 files in folder (recursively)
+    Analyze all h5 files in folder (recursively) in parallel, see batch_analysis.py
     '''
+#     from batch_analysis import BatchAnalysis, find_data_files
 #     folder = '/path/to/data'
 #     p0 = (9000, 1000, 1000, 900, 10000, 500)
-#       
-#     files = []
-#     for (dirpath, dirnames, filenames) in os.walk(folder):
-#         for f in filenames:
-#             if not os.path.split(f)[1].split('.')[1] == 'h5':
-#                 continue
-#              
-#             '''Blacklist files here'''
-#             #if 'PCB2_structureH' in f:
-#             #    continue
-#              
-#             files.append(os.path.join(dirpath, f))
-#   
-#     pbar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(files), poll=10, term_width=80).start()
-#     i=1
-#     for f in files:
-#         logging.debug('now analyzing file %s' % f)
-#           
-#         try:
-#             ''' Do analysis here '''
-#             data = a.load_data_file(f)
-#             x,y = a.histogram_data(data)
-#             a.fit_testbeam_spectrum(x, y, p0)
-#         except Exception as e:
-#             logging.error('Encountered an error during analysis of file %s: %s' % (f, e))
-#             continue
-#            
-#          
-#        
-#           
-#         pbar.update(i)
-#         i+=1
-#                   
-#     pbar.finish()
-#     logging.info('Done! Analyzed %i files in total.' % len(files))
-#     if len(a.errorfiles) > 0:
-#         logging.error('%i files encountered errors during analysis:' % len(a.errorfiles))
-#         logging.error(a.errorfiles)
-#         with open('errorfiles.log', 'w') as ef:
-#             for f in a.errorfiles:
-#                 ef.write('%s <- %s\n' %(f[1], f[0]))
-    
-    
\ No newline at end of file
+#     
+#     files = find_data_files(folder, exclude=['PCB2_structureH'])    # Blacklist files here
+#     batch = BatchAnalysis('testbeam', p0=p0)
+#     results = batch.run(files)
+#     if batch.get_errors():
+#         batch.write_errors('errorfiles.log')
+    
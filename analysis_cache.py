@@ -0,0 +1,166 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Cache of analysis results (amplitudes, histograms, fits) of data files, so a re-analysis does not read and decompress the waveforms again.
+'''
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+
+CACHE_DIRECTORY = '.mca_cache'                                                  # Sidecar directory next to the data files
+CACHE_BYTES = 2**30
+
+
+def _to_json(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=_to_json).encode('utf-8')).hexdigest()
+
+
+class AnalysisCache(object):
+    '''
+        Content addressed cache of arrays and JSON serializable results per data file.
+        An entry is identified by the absolute path, size and modification time of the data file, the kind of result and its parameters,
+        so an entry is never used after the data file was changed. Every entry is a npz file named <hash of the path>_<hash of the key>.npz.
+        If a cache directory grows beyond max_bytes, the least recently used entries are deleted.
+    '''
+
+    def __init__(self, directory=None, max_bytes=CACHE_BYTES):
+        '''
+            Parameters
+            ----------
+            directory : string
+                [Optional] Cache directory. Defaults to the sidecar directory .mca_cache next to every data file.
+            max_bytes : int
+                [Optional] Maximum size of a cache directory in bytes
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get_directory(self, path):
+        if self.directory is not None:
+            return self.directory
+        return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRECTORY)
+
+    def identity(self, path):
+        '''
+            Returns:
+                identity : dict
+                    Absolute path, size and modification time of a data file
+        '''
+        stat = os.stat(path)
+        return dict(path=os.path.abspath(path), size=stat.st_size, mtime=stat.st_mtime)
+
+    def _get_filename(self, path, kind, params):
+        key = dict(file=self.identity(path), kind=kind, params=params)
+        return os.path.join(self.get_directory(path), '%s_%s.npz' % (_hash(os.path.abspath(path))[:16], _hash(key)))
+
+    def get(self, path, kind, params):
+        '''
+            Looks up a result of a data file.
+            ----------
+            Parameters:
+                path : string
+                    Data file
+                kind : string
+                    Kind of the result, e.g. 'histogram'
+                params : dict
+                    JSON serializable parameters of the result
+            Returns:
+                entry : dict or None
+                    The arrays of the entry and the results under 'info', None if there is no entry
+        '''
+        filename = self._get_filename(path, kind, params)
+        try:
+            with np.load(filename, allow_pickle=False) as npz_file:
+                entry = dict((name, npz_file[name]) for name in npz_file.files)
+        except (IOError, OSError, ValueError):                                 # No entry, or deleted meanwhile by another process
+            self.misses += 1
+            return None
+        entry['info'] = json.loads(str(entry['info']))
+        try:
+            os.utime(filename, None)                                            # Last use for the eviction
+        except OSError:
+            pass
+        self.hits += 1
+        return entry
+
+    def put(self, path, kind, params, info=None, **arrays):
+        '''
+            Stores a result of a data file, see get(). info is a JSON serializable dict, arrays are numpy arrays.
+        '''
+        filename = self._get_filename(path, kind, params)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:                                                     # Created meanwhile by another process
+                pass
+        tmp_filename = '%s.%d.tmp' % (filename[:-len('.npz')], os.getpid())
+        with open(tmp_filename, 'wb') as npz_file:
+            np.savez(npz_file, info=np.array(json.dumps(info or {}, sort_keys=True, default=_to_json)), **arrays)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)                                                 # os.rename does not replace on Windows in Python 2
+        os.rename(tmp_filename, filename)
+        self._evict(directory)
+
+    def invalidate(self, path):
+        '''
+            Deletes all entries of a data file.
+        '''
+        self._remove(self._get_entries(self.get_directory(path), _hash(os.path.abspath(path))[:16] + '_'))
+
+    def clear(self, path=None):
+        '''
+            Deletes all entries of the cache directory (of the data file path if the cache uses sidecar directories).
+        '''
+        self._remove(self._get_entries(self.get_directory(path or '.')))
+
+    def get_size(self, path=None):
+        return sum(size for _, size, _ in self._get_entries(self.get_directory(path or '.')))
+
+    def _get_entries(self, directory, prefix=''):
+        entries = []
+        if not os.path.isdir(directory):
+            return entries
+        for f in os.listdir(directory):
+            if f.startswith(prefix) and f.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(directory, f))
+                except OSError:
+                    continue
+                entries.append((os.path.join(directory, f), stat.st_size, stat.st_mtime))
+        return entries
+
+    def _remove(self, entries):
+        for filename, _, _ in entries:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def _evict(self, directory):
+        entries = self._get_entries(directory)
+        size = sum(entry[1] for entry in entries)
+        evicted = []
+        for entry in sorted(entries, key=lambda entry: entry[2]):               # Least recently used first
+            if size <= self.max_bytes:
+                break
+            evicted.append(entry)
+            size -= entry[1]
+        if evicted:
+            logging.debug('Evicting %d entries from the analysis cache %s', len(evicted), directory)
+            self._remove(evicted)
@@ -0,0 +1,276 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Analysis of many data files in parallel. Every file is analyzed in a worker process by a fresh MCA_analysis object,
+    so the per-file state of the analysis (output filename, calibration, fit errors) is never shared between files.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+
+from analysis_cache import AnalysisCache
+
+
+def find_data_files(folder, exclude=None):
+    '''
+        Finds all h5 data files and run indices below folder (recursively). The files of a run index with several files are analyzed as one run and not listed on their own.
+        ----------
+        Parameters:
+            folder : string
+                Top directory
+            exclude : list of strings
+                [Optional] Files whose path contains one of these strings are skipped
+        Returns:
+            files : list of strings
+                Sorted full paths of the data files
+    '''
+    files = []
+    run_files = set()
+    for dirpath, _, filenames in os.walk(folder):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            if exclude and any(pattern in path for pattern in exclude):
+                continue
+            if f.endswith('_index.json'):
+                with open(path, 'r') as index_file:
+                    entries = json.load(index_file)['files']
+                if len(entries) == 1:                                           # Run of a single file, the file is analyzed directly
+                    continue
+                run_files.update(os.path.join(dirpath, entry['filename']) for entry in entries)
+            elif not f.endswith('.h5'):
+                continue
+            files.append(path)
+    return sorted(path for path in files if path not in run_files)
+
+
+def histogram_file(analysis, path, bins=1024, hist_range=(0, 2**14-10), baseline_correction=False, darkframe=None, plot=False):
+    '''
+        Task: streams and histograms the waveforms of a file, see MCA_analysis.histogram_data_file.
+        ----------
+        Returns:
+            result : dict
+                Bin edges 'x', histogram 'y' and 'event_count'
+    '''
+    x, y = analysis.histogram_data_file(path, bins=bins, hist_range=hist_range, baseline_correction=baseline_correction)
+    if darkframe is not None:
+        y = analysis.substract_darkframe(y, darkframe)
+    if plot:
+        analysis.just_plot_histogram(x, y)
+    return dict(x=x, y=y, event_count=analysis.event_count)
+
+
+def fit_testbeam_file(analysis, path, p0=None, fit_range=None, ymax=None, bins=1024, hist_range=(0, 2**14-10), baseline_correction=False, darkframe=None, calibration=None, cost='lsq'):
+    '''
+        Task: histograms a file and fits the testbeam spectrum, see MCA_analysis.fit_testbeam_spectrum.
+        calibration is an optional EnergyCalibration or tuple (m, b, unit) of MCA_analysis.calibrate_energy.
+        ----------
+        Returns:
+            result : dict
+                Fitted parameters 'p', their uncertainties 'p_err', 'fit_error' and 'event_count'
+    '''
+    return _fit_file(analysis.fit_testbeam_spectrum, analysis, path, p0, fit_range, ymax, bins, hist_range, baseline_correction, darkframe, calibration, cost)
+
+
+def fit_source_file(analysis, path, p0=None, fit_range=None, ymax=None, bins=1024, hist_range=(0, 2**14-10), baseline_correction=False, darkframe=None, calibration=None, cost='lsq'):
+    '''
+        Task: histograms a file and fits the source spectrum, see MCA_analysis.fit_source_spectrum and fit_testbeam_file.
+    '''
+    return _fit_file(analysis.fit_source_spectrum, analysis, path, p0, fit_range, ymax, bins, hist_range, baseline_correction, darkframe, calibration, cost)
+
+
+def _fit_file(fit, analysis, path, p0, fit_range, ymax, bins, hist_range, baseline_correction, darkframe, calibration, cost):
+    if calibration is not None and not isinstance(calibration, (tuple, list)):
+        calibration = (calibration.m, calibration.b, calibration.unit)
+    if analysis.cache is not None:                                              # Same fit of the same histogram, e.g. when a campaign is analyzed again
+        params = dict(fit=fit.__name__, p0=p0, fit_range=fit_range, bins=bins, hist_range=hist_range, baseline_correction=baseline_correction,
+                      darkframe=analysis.cache.identity(darkframe) if darkframe is not None else None, calibration=calibration, cost=cost)
+        entry = analysis.cache.get(path, 'fit', params)
+        if entry is not None:
+            return entry['info']
+    x, y = analysis.histogram_data_file(path, bins=bins, hist_range=hist_range, baseline_correction=baseline_correction)
+    if darkframe is not None:
+        y = analysis.substract_darkframe(y, darkframe)
+    if calibration is not None:
+        x = analysis.calibrate_energy(x, *calibration)
+    p = fit(x, y, p0, fit_range=fit_range, ymax=ymax, cost=cost)
+    p_err = analysis.fit_result['p_err'] if analysis.fit_result is not None and not analysis.error else (float('nan'),) * len(p)
+    result = dict(p=tuple(float(v) for v in p), p_err=p_err, fit_error=analysis.error, event_count=analysis.event_count)
+    if analysis.cache is not None and not analysis.error:
+        analysis.cache.put(path, 'fit', params, info=result)
+    return result
+
+
+TASKS = {'histogram': histogram_file, 'testbeam': fit_testbeam_file, 'source': fit_source_file}
+
+
+def _init_worker():
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')                                                   # Workers only save plots
+
+
+def _analyze_file(job):
+    '''
+        Analyzes one file in a worker process. Exceptions and the fit errors of MCA_analysis are returned in the result instead of being raised.
+    '''
+    task, path, settings, outformat, cache = job
+    from analysis import MCA_analysis
+    analysis = MCA_analysis(outformat=outformat, cache=cache)
+    start_time = time.time()
+    result = dict(path=path, ok=True, result=None, errors=[], pid=os.getpid())
+    try:
+        result['result'] = task(analysis, path, **settings)
+    except Exception as e:
+        result['ok'] = False
+        result['errors'].append(dict(type=type(e).__name__, message=str(e), traceback=traceback.format_exc()))
+    for _, error in analysis.errorfiles:
+        result['errors'].append(dict(type='FitError', message=str(error), traceback=None))
+    if analysis.error:
+        result['ok'] = False
+    result['duration'] = time.time() - start_time
+    return result
+
+
+class BatchAnalysis(object):
+    '''
+        Runs an analysis task on many files with a pool of worker processes.
+        A task is a module level function task(analysis, path, **settings) that returns a picklable result, e.g. histogram_file or fit_testbeam_file.
+    '''
+
+    def __init__(self, task=histogram_file, processes=None, outformat='pdf', cache=None, **settings):
+        '''
+            Parameters
+            ----------
+            task : callable or string
+                [Optional] Analysis of one file, or the name of a task in TASKS
+            processes : int
+                [Optional] Number of worker processes. Defaults to the number of cores.
+            outformat : string
+                [Optional] Format of saved plots
+            cache : AnalysisCache
+                [Optional] Cache of amplitudes, histograms and fit results that is shared by all workers
+            settings
+                Keyword arguments of the task
+        '''
+        self.task = TASKS[task] if task in TASKS else task
+        self.processes = processes or multiprocessing.cpu_count()
+        self.outformat = outformat
+        self.cache = cache
+        self.settings = settings
+        self.results = []
+
+    def iter_results(self, files):
+        '''
+            Analyzes the files in parallel and yields the result of every file as soon as it is done, so not in the order of files.
+            ----------
+            Returns:
+                result : dict
+                    'path', 'ok', the return value of the task 'result', 'errors' (list of dicts with 'type', 'message' and 'traceback'), 'duration' in seconds and 'pid' of the worker
+        '''
+        jobs = [(self.task, path, self.settings, self.outformat, self.cache) for path in files]
+        pool = multiprocessing.Pool(min(self.processes, max(len(jobs), 1)), initializer=_init_worker)
+        try:
+            for result in pool.imap_unordered(_analyze_file, jobs):
+                if not result['ok']:
+                    logging.error('Encountered an error during analysis of file %s: %s', result['path'], '; '.join(error['message'] for error in result['errors']))
+                yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def run(self, files, progress=True):
+        '''
+            Analyzes the files in parallel.
+            ----------
+            Parameters:
+                files : list of strings or string
+                    Data files, or a folder that is searched with find_data_files()
+                progress : bool or callable
+                    [Optional] Show a progress bar, or call progress(n_done, n_files, result) after every file
+            Returns:
+                results : list of dicts
+                    Result of every file in the order of files, see iter_results()
+        '''
+        if not isinstance(files, (list, tuple)):
+            files = find_data_files(files)
+        pbar = None
+        if progress is True:
+            import progressbar
+            pbar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=max(len(files), 1), poll=10, term_width=80).start()
+        results = {}
+        for result in self.iter_results(files):
+            results[result['path']] = result
+            if pbar is not None:
+                pbar.update(len(results))
+            elif progress:
+                progress(len(results), len(files), result)
+        if pbar is not None:
+            pbar.finish()
+        self.results = [results[path] for path in files]
+        n_failed = len(self.get_errors())
+        logging.info('Done! Analyzed %i files in total, %i with errors.' % (len(files), n_failed))
+        return self.results
+
+    def get_errors(self):
+        '''
+            Returns:
+                results : list of dicts
+                    Results of the last run with errors
+        '''
+        return [result for result in self.results if not result['ok'] or result['errors']]
+
+    def write_errors(self, filename='errorfiles.log'):
+        '''
+            Writes one line '<type>: <message> <- <path>' per error of the last run.
+        '''
+        with open(filename, 'w') as error_file:
+            for result in self.get_errors():
+                for error in result['errors']:
+                    error_file.write('%s: %s <- %s\n' % (error['type'], error['message'], result['path']))
+
+
+def main(argv=None):
+    from fitting import COSTS
+    parser = argparse.ArgumentParser(description='Analyzes all h5 files and run indices in a folder (recursively) in parallel.')
+    parser.add_argument('folder', help='Folder with the data files')
+    parser.add_argument('--task', choices=sorted(TASKS), default='histogram', help='Analysis of every file')
+    parser.add_argument('--p0', type=float, nargs='+', help='Start parameters of the fits, estimated from every histogram if not given')
+    parser.add_argument('--fit-range', type=float, nargs=2, help='Range of the fits')
+    parser.add_argument('--cost', choices=COSTS, default='lsq', help='Cost function of the fits')
+    parser.add_argument('--baseline-correction', action='store_true', help='Substract the baseline of every waveform')
+    parser.add_argument('--darkframe', help='Darkframe h5 file or run index that is substracted from every histogram')
+    parser.add_argument('--exclude', nargs='+', help='Skip files whose path contains one of these strings')
+    parser.add_argument('--processes', type=int, help='Number of worker processes, defaults to the number of cores')
+    parser.add_argument('--errors', default='errorfiles.log', help='Error log')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the analysis cache (.mca_cache directories next to the data files)')
+    args = parser.parse_args(argv)
+
+    settings = dict(baseline_correction=args.baseline_correction, darkframe=args.darkframe)
+    if args.task == 'histogram':
+        settings['plot'] = True
+    else:
+        settings.update(p0=tuple(args.p0) if args.p0 is not None else None, fit_range=args.fit_range, cost=args.cost)
+    batch = BatchAnalysis(args.task, processes=args.processes, cache=None if args.no_cache else AnalysisCache(), **settings)
+    batch.run(find_data_files(args.folder, args.exclude))
+    errors = batch.get_errors()
+    if errors:
+        logging.error('%i files encountered errors during analysis, see %s' % (len(errors), args.errors))
+        batch.write_errors(args.errors)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    sys.exit(main())
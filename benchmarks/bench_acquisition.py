@@ -0,0 +1,308 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Throughput benchmark of the software side of the acquisition on synthetic DATA_FIFO streams:
+        record   - qmca._record_data: SRAM read from the replay drivers, channel split and event building
+        write    - EventWriter.append with the flush settings of qmca._main_loop
+        send     - qmca._send_data to a ZeroMQ PULL socket
+        monitor  - DataWorker.process_data of the Online Monitor in 'waveforms' mode (needs PyQt4)
+        pipeline - qmca._main_loop on a ReplayDut at a given trigger rate, latency from SRAM read to written block
+    Reports events/s, MB/s of samples, latency percentiles and CPU time per event of every case.
+    The results can be saved as baseline and later runs compared to it, the exit code is 1 if a case got slower than the tolerance.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+import numpy as np
+import zmq
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_data import generate_waveforms
+from event_builder import encode_events
+from event_writer import EventWriter
+from monitor_protocol import pack_header, MSG_EVENTS
+from replay import ReplayDut
+from qmca import qmca
+
+STAGES = ('record', 'write', 'send', 'monitor', 'pipeline')
+SAMPLE_COUNTS = (100, 200, 1000)
+BLOCK_SIZES = (10, 80, 800)                                                     # Events per SRAM read, 80 events are 10 ms at 8 kHz
+RATES = (8000, 16000, 32000)                                                    # Trigger rates of the pipeline cases in Hz
+SOCKET_ADDR = 'tcp://127.0.0.1:15794'
+BASELINE_VERSION = 1
+
+_cpu_time = getattr(time, 'process_time', None) or time.clock                    # CPU time of the process, also of the stage threads
+
+
+def summarize(n_events, sample_count, latencies, wall_time, cpu_time, **extra):
+    '''
+        Returns:
+            result : dict
+                Events/s, MB/s of 16 bit samples, 50/90/99 % latency percentiles in ms and CPU time per event in us
+    '''
+    latencies = np.array(latencies) * 1e3 if len(latencies) else np.zeros(1)
+    result = dict(
+        events_per_second=n_events / wall_time,
+        mb_per_second=n_events * sample_count * 2 / wall_time / 1e6,
+        latency_p50=np.percentile(latencies, 50),
+        latency_p90=np.percentile(latencies, 90),
+        latency_p99=np.percentile(latencies, 99),
+        cpu_per_event=cpu_time / n_events * 1e6 if n_events else 0.,
+    )
+    result.update(extra)
+    return dict((key, float(value)) for key, value in result.items())
+
+
+def make_blocks(n_events, sample_count, block_size):
+    '''
+        Returns:
+            blocks : list
+                FIFO word stream of n_events cut into reads of block_size events. The cuts are in the middle of events like real SRAM reads.
+    '''
+    raw_data = encode_events(generate_waveforms(n_events, sample_count))
+    cuts = np.arange(1, n_events // block_size) * block_size * sample_count + sample_count // 3
+    return np.split(raw_data, cuts)
+
+
+def make_device(sample_count):
+    return qmca(config=ReplayDut(rate=0.), sample_count=sample_count, socket_addr=SOCKET_ADDR)
+
+
+def bench_record(n_events, sample_count, block_size):
+    device = make_device(sample_count)
+    try:
+        blocks = make_blocks(n_events, sample_count, block_size)
+        fifo = device.dut['DATA_FIFO']
+        latencies, recorded = [], 0
+        wall_time, cpu_time = 0., 0.
+        for block in blocks:
+            fifo.push(block)
+            start, start_cpu = time.time(), _cpu_time()
+            recorded += sum(events.shape[0] for events in device._record_data().values())
+            latencies.append(time.time() - start)
+            wall_time += latencies[-1]
+            cpu_time += _cpu_time() - start_cpu
+    finally:
+        device.close()
+    return summarize(recorded, sample_count, latencies, wall_time, cpu_time)
+
+
+def bench_write(n_events, sample_count, block_size, write_after_n_events=100000):
+    events = generate_waveforms(n_events, sample_count)
+    directory = tempfile.mkdtemp()
+    try:
+        writer = EventWriter(sample_count, dtype=events.dtype, flush_bytes=write_after_n_events * sample_count * events.itemsize)
+        writer.open(os.path.join(directory, 'event_data.h5'))
+        latencies = []
+        start, start_cpu = time.time(), _cpu_time()
+        for i in range(0, n_events, block_size):
+            block_start = time.time()
+            writer.append(events[i:i + block_size], (block_start, 2000, 0, block_size * sample_count, 0))
+            latencies.append(time.time() - block_start)
+        writer.close()                                                          # Includes the final flush
+        wall_time, cpu_time = time.time() - start, _cpu_time() - start_cpu
+    finally:
+        shutil.rmtree(directory)
+    return summarize(n_events, sample_count, latencies, wall_time, cpu_time)
+
+
+def _receive(socket, exit):
+    while not exit.is_set():
+        if socket.poll(10):
+            socket.recv()
+            socket.recv(copy=False)
+
+
+def bench_send(n_events, sample_count, block_size):
+    events = generate_waveforms(n_events, sample_count)
+    device = make_device(sample_count)
+    receiver = device.socket.context.socket(zmq.PULL)
+    receiver.connect(SOCKET_ADDR)
+    exit = threading.Event()
+    thread = threading.Thread(target=_receive, args=(receiver, exit))
+    thread.start()
+    try:
+        latencies, sent = [], 0
+        start, start_cpu = time.time(), _cpu_time()
+        for sequence, i in enumerate(range(0, n_events, block_size)):
+            block = events[i:i + block_size]
+            block_start = time.time()
+            if device._send_data(block, sequence, 2000, 0, block_start) is not None:
+                sent += block.shape[0]
+            latencies.append(time.time() - block_start)
+        wall_time, cpu_time = time.time() - start, _cpu_time() - start_cpu
+    finally:
+        exit.set()
+        thread.join()
+        receiver.close(linger=0)
+        device.close()
+    return summarize(sent, sample_count, latencies, wall_time, cpu_time, send_drops=device.send_drops)
+
+
+def bench_monitor(n_events, sample_count, block_size):
+    try:
+        from online_monitor import DataWorker
+    except (ImportError, SyntaxError):                                          # The Online Monitor needs PyQt4 and Python 2
+        return None
+    events = generate_waveforms(n_events, sample_count)
+    context = zmq.Context()
+    sender = context.socket(zmq.PUSH)
+    sender.bind(SOCKET_ADDR)
+    worker = DataWorker()
+    worker.connect(SOCKET_ADDR)
+    received = []
+    worker.interpreted_data.connect(lambda data: received.append(time.time()))
+    thread = threading.Thread(target=worker.process_data)
+    thread.start()
+    try:
+        send_times = []
+        start, start_cpu = time.time(), _cpu_time()
+        for sequence, i in enumerate(range(0, n_events, block_size)):
+            block = events[i:i + block_size]
+            send_times.append(time.time())
+            sender.send(pack_header(MSG_EVENTS, sequence + 1, block, 2000, 0, send_times[-1]), flags=zmq.SNDMORE)
+            sender.send(block)                                                  # Blocking, so no message is dropped
+        while len(received) < len(send_times) and time.time() - start < 60.:
+            time.sleep(0.001)
+        wall_time, cpu_time = time.time() - start, _cpu_time() - start_cpu
+    finally:
+        worker.stop()
+        thread.join()
+        worker.socket_pull.close(linger=0)
+        sender.close(linger=0)
+        context.term()
+    latencies = np.array(received) - np.array(send_times[:len(received)])
+    return summarize(min(len(received) * block_size, n_events), sample_count, latencies, wall_time, cpu_time)
+
+
+def bench_pipeline(rate, sample_count, duration=2.):
+    dut = ReplayDut(rate=rate, seed=1)
+    device = qmca(config=dut, sample_count=sample_count, socket_addr=SOCKET_ADDR)
+    latencies = []
+    write_data = device.write_stage.target
+
+    def timed_write_data(item):
+        write_data(item)
+        latencies.append(time.time() - item[1][0])                              # Readout timestamp is the time of the SRAM read
+
+    device.write_stage.target = timed_write_data
+    directory = tempfile.mkdtemp()
+    try:
+        start, start_cpu = time.time(), _cpu_time()
+        device.start(os.path.join(directory, 'event_data'))
+        time.sleep(duration)
+        device.stop()
+        wall_time, cpu_time = time.time() - start, _cpu_time() - start_cpu
+        statistics = device.get_pipeline_statistics()
+        loads = dict(('load_%s' % stage.name, statistics[stage.name]['load']) for stage in device.stages)
+    finally:
+        device.close()
+        shutil.rmtree(directory)
+    lost_words = dut.get_statistics()['channels'][0]['lost_words']
+    return summarize(device.event_count, sample_count, latencies, wall_time, cpu_time, trigger_rate=rate, lost_events=lost_words / float(sample_count), **loads)
+
+
+def run(n_events=20000, stages=STAGES, sample_counts=SAMPLE_COUNTS, block_sizes=BLOCK_SIZES, rates=RATES, duration=2.):
+    '''
+        Returns:
+            results : dict
+                Result of every case by name '<stage> sample_count=<n> block_size=<n>' or '<stage> sample_count=<n> rate=<Hz>'
+    '''
+    results = {}
+    for stage in stages:
+        for sample_count in sample_counts:
+            if stage == 'pipeline':
+                cases = [('rate=%d' % rate, lambda rate=rate: bench_pipeline(rate, sample_count, duration)) for rate in rates]
+            else:
+                bench = globals()['bench_%s' % stage]
+                cases = [('block_size=%d' % block_size, lambda block_size=block_size: bench(n_events, sample_count, block_size))
+                         for block_size in block_sizes if block_size * sample_count <= 2**18]   # Maximum read size of the readout scheduler
+            for label, case in cases:
+                name = '%s sample_count=%d %s' % (stage, sample_count, label)
+                result = case()
+                if result is None:
+                    print('%-42s skipped, not available' % name)
+                    continue
+                results[name] = result
+                print('%-42s %9.0f events/s %7.1f MB/s  latency %7.2f / %7.2f / %7.2f ms  cpu %6.1f us/event%s' % (
+                    name, result['events_per_second'], result['mb_per_second'], result['latency_p50'], result['latency_p90'], result['latency_p99'], result['cpu_per_event'],
+                    '  lost %d events' % result['lost_events'] if result.get('lost_events') else ''))
+    return results
+
+
+def save_baseline(results, filename):
+    with open(filename, 'w') as baseline_file:
+        json.dump(dict(version=BASELINE_VERSION, host=platform.node(), python=platform.python_version(), time=time.time(), results=results), baseline_file, indent=2, sort_keys=True)
+
+
+def compare(results, filename, tolerance=0.2, latency_tolerance=1.):
+    '''
+        Compares results to a saved baseline. Only cases in both are compared.
+        ----------
+        Parameters:
+            results : dict
+                Results of run()
+            filename : string
+                Baseline file written by save_baseline()
+            tolerance : float
+                Allowed relative decrease of events/s
+            latency_tolerance : float
+                Allowed relative increase of the 99 % latency percentile
+        Returns:
+            regressions : list
+                (name, metric, baseline value, value) of every regression
+    '''
+    with open(filename, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['version'] != BASELINE_VERSION:
+        raise ValueError('Baseline version %d is not supported' % baseline['version'])
+    regressions = []
+    for name in sorted(set(results) & set(baseline['results'])):
+        reference, result = baseline['results'][name], results[name]
+        if result['events_per_second'] < (1. - tolerance) * reference['events_per_second']:
+            regressions.append((name, 'events_per_second', reference['events_per_second'], result['events_per_second']))
+        if result['latency_p99'] > (1. + latency_tolerance) * reference['latency_p99']:
+            regressions.append((name, 'latency_p99', reference['latency_p99'], result['latency_p99']))
+        if result.get('lost_events', 0) > reference.get('lost_events', 0):
+            regressions.append((name, 'lost_events', reference.get('lost_events', 0), result['lost_events']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the qMCA acquisition path')
+    parser.add_argument('--events', type=int, default=20000, help='Number of events per case')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages, default: %(default)s')
+    parser.add_argument('--sample-counts', default=','.join(str(n) for n in SAMPLE_COUNTS))
+    parser.add_argument('--block-sizes', default=','.join(str(n) for n in BLOCK_SIZES))
+    parser.add_argument('--rates', default=','.join(str(n) for n in RATES))
+    parser.add_argument('--duration', type=float, default=2., help='Duration of every pipeline case in seconds')
+    parser.add_argument('--save', help='Save the results as baseline')
+    parser.add_argument('--compare', help='Compare the results to a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative decrease of events/s, default: %(default)s')
+    args = parser.parse_args()
+
+    logging.disable(logging.ERROR)                                              # Overflows are reported as lost events
+    results = run(n_events=args.events, stages=args.stages.split(','), sample_counts=[int(n) for n in args.sample_counts.split(',')],
+                  block_sizes=[int(n) for n in args.block_sizes.split(',')], rates=[int(n) for n in args.rates.split(',')], duration=args.duration)
+    if args.save:
+        save_baseline(results, args.save)
+    if args.compare:
+        regressions = compare(results, args.compare, tolerance=args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %-42s %s: baseline %.2f, now %.2f' % regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
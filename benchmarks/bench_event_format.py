@@ -0,0 +1,41 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Compares file size, write throughput and ZeroMQ payload of the uint32 and the uint16 event format.
+'''
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_data import generate_waveforms
+from bench_event_writer import write_events
+
+
+def run(n_events=200000, sample_count=200, block_size=80):
+    waveforms = generate_waveforms(n_events, sample_count)
+    results = []
+    for dtype in (np.uint32, np.uint16):
+        events = waveforms.astype(dtype)
+        filename = os.path.join(tempfile.mkdtemp(), 'event_data.h5')
+        t = write_events(filename, events, block_size, complib='blosc', complevel=5)
+        size = os.path.getsize(filename)
+        os.remove(filename)
+        results.append((np.dtype(dtype).name, t, size))
+        print('%-7s %8.1f MB written in %5.2f s: %7.1f MB/s raw, %8.0f events/s, compression ratio %4.2f, ZeroMQ payload per block %6d bytes' % (
+            np.dtype(dtype).name, size / 1e6, t, events.nbytes / t / 1e6, n_events / t, events.nbytes / float(size), events[:block_size].nbytes))
+    return results
+
+
+if __name__ == '__main__':
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print('--- %d events with 200 samples, blocks of 80 events (10 ms at 8 kHz) ---' % n_events)
+    run(n_events=n_events)
@@ -0,0 +1,60 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Micro-benchmark of the event splitter in qmca._record_data on synthetic DATA_FIFO word streams.
+    Compares the former np.split + np.vstack implementation to event_builder.split_events.
+'''
+
+import os
+import sys
+import timeit
+import numpy as np
+
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # ../
+sys.path.append(qmca_dir)
+
+from event_builder import split_events
+from synthetic_data import generate_fifo_data
+
+
+def split_events_legacy(single_data, sample_count):
+    selection = np.where(single_data & 0x10000000 == 0x10000000)[0]
+    event_data = np.bitwise_and(single_data, 0x00003fff).astype(np.uint32)
+    event_data = np.split(event_data, selection)
+    event_data = event_data[1:-1]
+    return np.vstack(event_data)
+
+
+def run(n_events=80, sample_count=200, repeat=5, number=200):
+    raw_data = generate_fifo_data(n_events, sample_count)
+    irregular = np.delete(raw_data, np.s_[sample_count * 2:sample_count * 2 + 7])
+
+    results = []
+    for name, data in (('regular', raw_data), ('irregular', irregular)):
+        for label, func in (('np.split + np.vstack', split_events_legacy), ('split_events', split_events)):
+            times = []
+            try:
+                for _ in range(repeat):
+                    reads = [data.copy() for _ in range(number)]  # split_events removes the new-event-bit in place
+                    start = timeit.default_timer()
+                    for read in reads:
+                        func(read, sample_count)
+                    times.append((timeit.default_timer() - start) / number)
+            except ValueError as e:
+                print('%-10s %-22s ValueError, read is lost: %s' % (name, label, e))
+                continue
+            t = min(times)
+            results.append((name, label, t))
+            print('%-10s %-22s %8.1f us / read  %8.2f Mevents/s' % (name, label, t * 1e6, n_events / t / 1e6))
+    return results
+
+
+if __name__ == '__main__':
+    # 80 events of 200 samples correspond to one 10 ms readout at 8 kHz
+    for n_events in (10, 80, 800):
+        print('--- %d events per read, 200 samples per event ---' % n_events)
+        run(n_events=n_events)
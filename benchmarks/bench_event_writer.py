@@ -0,0 +1,66 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Sweeps chunk shape, compressor, shuffle and compression level of the EventWriter on synthetic waveforms.
+    Reports uncompressed write speed, compression ratio and whether the setting keeps up with 8 kHz of 200 sample events.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import itertools
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_data import generate_waveforms
+from event_writer import EventWriter
+
+COMPLIBS = ('blosc', 'blosc:lz4', 'blosc:zstd', None)
+SHUFFLES = ('shuffle', 'bitshuffle', 'none')
+COMPLEVELS = (1, 5, 9)
+CHUNKSHAPES = (None, 100, 1000)
+REQUIRED_RATE = 8000                                                            # events/s
+
+
+def write_events(filename, events, block_size, **settings):
+    writer = EventWriter(events.shape[1], dtype=events.dtype, **settings)
+    start = time.time()
+    writer.open(filename)
+    for i in range(0, events.shape[0], block_size):
+        writer.append(events[i:i + block_size])
+    writer.close()
+    return time.time() - start
+
+
+def run(n_events=100000, sample_count=200, block_size=80, complibs=COMPLIBS, shuffles=SHUFFLES, complevels=COMPLEVELS, chunkshapes=CHUNKSHAPES):
+    events = generate_waveforms(n_events, sample_count)
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for complib, shuffle, complevel, chunkshape in itertools.product(complibs, shuffles, complevels, chunkshapes):
+            if complib is None and (shuffle != 'none' or complevel != complevels[0]):
+                continue                                                        # No compression, no need to sweep filter settings
+            filename = os.path.join(directory, 'event_data.h5')
+            t = write_events(filename, events, block_size, chunkshape=chunkshape, complib=complib, complevel=complevel, shuffle=shuffle)
+            size = os.path.getsize(filename)
+            os.remove(filename)
+            results.append(dict(complib=complib, shuffle=shuffle, complevel=complevel, chunkshape=chunkshape, write_speed=events.nbytes / t / 1e6, events_per_second=n_events / t, compression_ratio=events.nbytes / float(size)))
+            print('%-11s %-10s %d  chunk %-5s %7.1f MB/s %9.0f events/s  ratio %5.2f  %s' % (
+                complib, shuffle, complevel, chunkshape, results[-1]['write_speed'], results[-1]['events_per_second'], results[-1]['compression_ratio'],
+                'ok' if results[-1]['events_per_second'] > REQUIRED_RATE else 'TOO SLOW'))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+if __name__ == '__main__':
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('--- %d events with 200 samples, blocks of 80 events (10 ms at 8 kHz) ---' % n_events)
+    run(n_events=n_events)
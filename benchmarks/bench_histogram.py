@@ -0,0 +1,56 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Compares the histogramming of the Online Monitor with np.histogram to the IncrementalHistogram.
+'''
+
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_data import generate_waveforms
+from histogram import IncrementalHistogram
+
+
+def run(n_blocks=1000, block_size=80, sample_count=200):
+    amplitudes = np.amax(generate_waveforms(n_blocks * block_size, sample_count), axis=1)
+    blocks = [amplitudes[i:i + block_size] for i in range(0, amplitudes.shape[0], block_size)]
+
+    def legacy():
+        histogram = np.zeros(512)
+        for block in blocks:
+            hist, bin_edges = np.histogram(block, bins=512, range=(0, 2**14))
+            histogram += hist
+        return histogram
+
+    def incremental(n_bins):
+        histogram = IncrementalHistogram(n_bins=n_bins)
+        for block in blocks:
+            histogram.fill(block)
+        return histogram
+
+    assert (legacy() == incremental(512).counts).all()
+    assert (legacy() == incremental(2**14).rebin(512)).all()
+
+    t_legacy = min(timeit.repeat(legacy, number=1, repeat=5)) / n_blocks
+    t_512 = min(timeit.repeat(lambda: incremental(512), number=1, repeat=5)) / n_blocks
+    t_full = min(timeit.repeat(lambda: incremental(2**14), number=1, repeat=5)) / n_blocks
+    full = incremental(2**14)
+    t_rebin = min(timeit.repeat(lambda: full.rebin(512), number=100, repeat=5)) / 100
+
+    print('np.histogram, 512 bins            %6.1f us per block' % (t_legacy * 1e6))
+    print('IncrementalHistogram, 512 bins    %6.1f us per block (%.1fx)' % (t_512 * 1e6, t_legacy / t_512))
+    print('IncrementalHistogram, 16384 bins  %6.1f us per block (%.1fx)' % (t_full * 1e6, t_legacy / t_full))
+    print('Rebinning 16384 to 512 bins       %6.1f us' % (t_rebin * 1e6))
+
+
+if __name__ == '__main__':
+    print('--- blocks of 80 events (10 ms at 8 kHz) ---')
+    run()
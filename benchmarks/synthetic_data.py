@@ -0,0 +1,30 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Synthetic qMCA waveforms and DATA_FIFO word streams for the benchmarks.
+'''
+
+import os
+import sys
+import numpy as np
+
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # ../
+sys.path.append(qmca_dir)
+
+from event_builder import encode_events
+from replay import generate_waveforms
+
+
+def generate_fifo_data(n_events, sample_count, chop=True, seed=0):
+    '''
+        Generates a raw DATA_FIFO word stream of n_events waveforms.
+        If chop is set, the stream starts and ends in the middle of an event like a real SRAM read.
+    '''
+    raw_data = encode_events(generate_waveforms(n_events, sample_count, seed))
+    if chop:
+        raw_data = raw_data[sample_count // 3:-sample_count // 2]
+    return raw_data
@@ -0,0 +1,370 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Runs several qMCA setups (MIO + GPAC + qMCA card) in parallel with one acquisition process per board.
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+import yaml
+import zmq
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from event_run import EventRun
+
+RUN_INDEX_VERSION = 1
+
+
+def load_config(config):
+    '''
+        Reads and checks the configuration of the coordinator.
+        ----------
+        Parameters:
+            config : dict or string
+                Configuration or YAML file with the keys
+                'boards': one entry per board with 'socket_addr' (ZeroMQ address of the board, must be unique), 'board_id' ([Optional] defaults to the position in the list),
+                'usb_id' ([Optional] board ID of the USB transfer layer), 'config' ([Optional] basil configuration of the board) and further keyword arguments of qmca.
+                'monitor_addr': [Optional] Address of the combined Online Monitor feed
+        Returns:
+            config : dict
+                Configuration with 'monitor_addr' and a list of 'boards' with 'board_id', 'socket_addr' and the remaining 'settings' of every board
+    '''
+    if not isinstance(config, dict):
+        with open(config, 'r') as config_file:
+            config = yaml.safe_load(config_file)
+    boards = []
+    for i, board in enumerate(config['boards']):
+        settings = dict(board)
+        board_id = settings.pop('board_id', i)
+        if 'socket_addr' not in settings:
+            raise ValueError('Board %d has no socket_addr' % board_id)
+        boards.append(dict(board_id=board_id, socket_addr=settings['socket_addr'], settings=settings))
+    monitor_addr = config.get('monitor_addr', 'tcp://127.0.0.1:5678')
+    board_ids = [board['board_id'] for board in boards]
+    addresses = [board['socket_addr'] for board in boards] + [monitor_addr]
+    if len(set(board_ids)) != len(board_ids):
+        raise ValueError('Board IDs are not unique')
+    if len(set(addresses)) != len(addresses):
+        raise ValueError('Socket addresses of the boards and the monitor are not unique')
+    return dict(boards=boards, monitor_addr=monitor_addr)
+
+
+def make_qmca(board_id, config='qmca.yaml', usb_id=None, **settings):
+    '''
+        Creates the qmca object of a board. With usb_id the USB transfer layer of the basil configuration is bound to that board.
+    '''
+    from qmca import qmca
+    if usb_id is not None:
+        if not isinstance(config, dict):
+            with open(config, 'r') as config_file:
+                config = yaml.safe_load(config_file)
+        config['transfer_layer'][0].setdefault('init', {})['board_id'] = usb_id
+    return qmca(config=config, board_id=board_id, **settings)
+
+
+def _run_board(board_id, settings, factory, commands, results, start_event, stop_event, event_count):
+    '''
+        Main function of the process of a board. Creates the acquisition object and runs one measurement per 'start' command.
+        The measurement starts when start_event is set and stops when stop_event is set, so that all boards start and stop together.
+    '''
+    try:
+        device = (factory or make_qmca)(board_id=board_id, **settings)
+    except Exception:
+        results.put(('error', board_id, traceback.format_exc()))
+        return
+    results.put(('ready', board_id, None))
+    try:
+        while True:
+            command, out_filename = commands.get()
+            if command == 'exit':
+                break
+            start_event.wait()
+            device.start(out_filename)
+            results.put(('started', board_id, time.time()))
+            while not stop_event.wait(0.2):
+                event_count.value = device.event_count
+            device.stop()
+            event_count.value = device.event_count
+            results.put(('stopped', board_id, dict(stop_time=time.time(), event_count=device.event_count, files=device.get_run_files(), statistics=device.get_pipeline_statistics())))
+    except Exception:
+        results.put(('error', board_id, traceback.format_exc()))
+    finally:
+        device.close()
+
+
+class Coordinator(object):
+    '''
+        Runs one acquisition process per qMCA setup from a single configuration.
+        A hiccup of the Python process of one board (e.g. garbage collection, a slow disk) cannot cause FIFO overflows on the other boards.
+        Start and stop are released for all boards at once. The Online Monitor data of all boards is forwarded to a single socket,
+        the board is identified by the board ID in the message header. Every run gets a combined run index <out_filename>_boards.json.
+    '''
+
+    def __init__(self, config, factory=None, timeout=60.):
+        '''
+            Parameters
+            ----------
+            config : dict or string
+                Configuration or YAML file, see load_config()
+            factory : callable
+                [Optional] Creates the acquisition object of a board from board_id and the settings of the board. Defaults to make_qmca().
+            timeout : float
+                [Optional] Maximum time in seconds to wait for all boards to initialize, start or stop
+        '''
+        self.config = load_config(config)
+        self.factory = factory
+        self.timeout = timeout
+        self.processes = {}
+        self.errors = {}                                                        # Traceback of every failed board
+        self.running = []                                                       # Boards of the current run
+        self.run_index = None
+        self.run_index_filename = None
+        self.monitor_drops = 0                                                  # Messages that did not fit into the send queue of the Online Monitor feed
+        self._commands = {}
+        self._event_counts = {}
+        self._forwarder = None
+        self._stop_forwarding = threading.Event()
+
+    def open(self):
+        '''
+            Starts the processes of all boards and waits until they are initialized. Boards that fail are listed in errors.
+        '''
+        self._results = multiprocessing.Queue()
+        self._start_event = multiprocessing.Event()
+        self._stop_event = multiprocessing.Event()
+        for board in self.config['boards']:
+            board_id = board['board_id']
+            self._commands[board_id] = multiprocessing.Queue()
+            self._event_counts[board_id] = multiprocessing.Value('l', 0)
+            process = multiprocessing.Process(target=_run_board, name='qmca_board%d' % board_id,
+                                              args=(board_id, board['settings'], self.factory, self._commands[board_id], self._results, self._start_event, self._stop_event, self._event_counts[board_id]))
+            process.daemon = True
+            process.start()
+            self.processes[board_id] = process
+        self._collect('ready', list(self.processes))
+        if len(self.errors) == len(self.processes):
+            self.close()
+            raise RuntimeError('No board could be initialized')
+
+        self._stop_forwarding.clear()
+        self._forwarder = threading.Thread(target=self._forward_monitor_data, name='monitor_forwarder')
+        self._forwarder.daemon = True
+        self._forwarder.start()
+
+    @property
+    def boards(self):
+        '''
+            IDs of the boards that are ready
+        '''
+        return [board_id for board_id in self.processes if board_id not in self.errors]
+
+    @property
+    def event_count(self):
+        return sum(event_count.value for event_count in self._event_counts.values())
+
+    def get_event_counts(self):
+        '''
+            Returns:
+                event_counts : dict
+                    Recorded events of the current or last run by board ID
+        '''
+        return dict((board_id, event_count.value) for board_id, event_count in self._event_counts.items())
+
+    def start(self, out_filename='event_data'):
+        '''
+            Starts a measurement on all boards at the same time. The events of board n are written to <out_filename>_board<n>.h5 (see qmca).
+        '''
+        if self.running:
+            raise RuntimeError('Measurement is already running')
+        boards = self.boards
+        for board_id in boards:
+            self._event_counts[board_id].value = 0
+            self._commands[board_id].put(('start', '%s_board%d' % (out_filename, board_id)))
+        self._start_event.set()
+        try:
+            start_times = self._collect('started', boards)
+        finally:
+            self._start_event.clear()
+        self.running = sorted(start_times)
+        if not self.running:
+            raise RuntimeError('No board could be started')
+
+        self.run_index_filename = out_filename + '_boards.json'
+        self.run_index = dict(version=RUN_INDEX_VERSION, start_time=min(start_times.values()), stop_time=None, boards=[
+            dict(board_id=board_id, start_time=start_times.get(board_id), stop_time=None, event_count=0, files={}, error=self.errors.get(board_id)) for board_id in boards])
+        self._write_run_index()
+        logging.info('Started measurement on boards %s.', ', '.join(str(board_id) for board_id in self.running))
+
+    def stop(self):
+        '''
+            Stops the measurement on all boards at the same time and completes the combined run index.
+            ----------
+            Returns:
+                run_index : dict
+                    Start and stop time, number of events and run index of every channel of every board
+        '''
+        if not self.running:
+            logging.info('No measurement was running.')
+            return self.run_index
+        self._stop_event.set()
+        try:
+            results = self._collect('stopped', self.running)
+        finally:
+            self._stop_event.clear()
+            self.running = []
+
+        directory = os.path.dirname(os.path.abspath(self.run_index_filename))
+        for entry in self.run_index['boards']:
+            result = results.get(entry['board_id'])
+            if result is not None:
+                entry.update(stop_time=result['stop_time'], event_count=result['event_count'], statistics=result['statistics'],
+                             files=dict((str(channel), os.path.relpath(os.path.abspath(filename), directory)) for channel, filename in result['files'].items()))
+            entry['error'] = self.errors.get(entry['board_id'])
+        self.run_index['stop_time'] = max([time.time()] + [result['stop_time'] for result in results.values()])
+        self._write_run_index()
+        for entry in self.run_index['boards']:
+            logging.info('Board %d: recorded %i events.', entry['board_id'], entry['event_count'])
+        logging.info('Online Monitor feed: %i messages dropped.', self.monitor_drops)
+        return self.run_index
+
+    def close(self):
+        '''
+            Stops a running measurement and terminates the processes of all boards.
+        '''
+        if self.running:
+            self.stop()
+        for board_id, process in self.processes.items():
+            if process.is_alive():
+                self._commands[board_id].put(('exit', None))
+        for process in self.processes.values():
+            process.join(self.timeout)
+            if process.is_alive():
+                logging.error('Process %s does not respond. Terminating it.', process.name)
+                process.terminate()
+        self.processes = {}
+        self._stop_forwarding.set()
+        if self._forwarder is not None:
+            self._forwarder.join()
+            self._forwarder = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _collect(self, state, board_ids):
+        '''
+            Waits until every board of board_ids reports state or an error.
+            ----------
+            Returns:
+                results : dict
+                    Data of the reports by board ID. Failed boards are added to errors instead.
+        '''
+        results = {}
+        pending = set(board_ids)
+        deadline = time.time() + self.timeout
+        while pending:
+            try:
+                message, board_id, data = self._results.get(timeout=max(deadline - time.time(), 0.01))
+            except Empty:
+                for board_id in pending:
+                    self.errors[board_id] = 'Timeout waiting for %s' % state
+                logging.error('Timeout waiting for boards %s to be %s.', ', '.join(str(board_id) for board_id in sorted(pending)), state)
+                break
+            if message == 'error':
+                logging.error('Board %d failed:\n%s', board_id, data)
+                self.errors[board_id] = data
+            elif message == state:
+                results[board_id] = data
+            else:
+                continue
+            pending.discard(board_id)
+        return results
+
+    def _write_run_index(self):
+        with open(self.run_index_filename, 'w') as index_file:
+            json.dump(self.run_index, index_file, indent=1, default=_to_json)
+
+    def _forward_monitor_data(self):
+        '''
+            Forwards the Online Monitor messages of all boards to monitor_addr without copying the data frames.
+        '''
+        context = zmq.Context()
+        socket_pull = context.socket(zmq.PULL)
+        socket_pull.setsockopt(zmq.RCVHWM, 10)
+        for board in self.config['boards']:
+            socket_pull.connect(board['socket_addr'])
+        socket_push = context.socket(zmq.PUSH)
+        socket_push.setsockopt(zmq.SNDHWM, 10)
+        socket_push.setsockopt(zmq.LINGER, 500)
+        socket_push.bind(self.config['monitor_addr'])
+        poller = zmq.Poller()
+        poller.register(socket_pull, zmq.POLLIN)
+        try:
+            while not self._stop_forwarding.is_set():
+                if not poller.poll(100):
+                    continue
+                frames = socket_pull.recv_multipart(copy=False)
+                try:
+                    socket_push.send_multipart(frames, flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    self.monitor_drops += 1
+        finally:
+            socket_pull.close(linger=0)
+            socket_push.close()
+            context.term()
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()                                                     # numpy scalars of the statistics
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def open_runs(run_index_filename):
+    '''
+        Opens the runs of all boards and channels of a combined run index.
+        ----------
+        Returns:
+            runs : dict
+                EventRun by (board ID, channel)
+    '''
+    with open(run_index_filename, 'r') as index_file:
+        run_index = json.load(index_file)
+    directory = os.path.dirname(run_index_filename)
+    runs = {}
+    for entry in run_index['boards']:
+        for channel, filename in entry['files'].items():
+            runs[(entry['board_id'], int(channel))] = EventRun(os.path.join(directory, filename))
+    return runs
+
+
+if __name__ == '__main__':
+    # python coordinator.py boards.yaml [out_filename] [duration in seconds]
+    logging.basicConfig(level=logging.INFO)
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 60.
+    with Coordinator(sys.argv[1]) as coordinator:
+        coordinator.start(sys.argv[2] if len(sys.argv) > 2 else 'event_data')
+        start_time = time.time()
+        try:
+            while time.time() - start_time < duration:
+                time.sleep(1)
+                logging.info('%d events: %s', coordinator.event_count, coordinator.get_event_counts())
+        finally:
+            coordinator.stop()
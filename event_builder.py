@@ -0,0 +1,339 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import sys
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+NEW_EVENT_BIT = 0x10000000
+SAMPLE_MASK = 0x00003fff
+CHANNEL_SHIFT = 29                                                              # ADC_ID of the gpac_adc_rx in bits 30:29 of every word
+CHANNEL_MASK = 0x3
+N_CHANNELS = 4
+
+_LOW_HALF = 0 if sys.byteorder == 'little' else 1                               # Index of the lower 16 bit of a 32 bit word in a uint16 view
+
+
+def encode_events(events, channel=0):
+    '''
+        Encodes waveforms into the raw DATA_FIFO word format, i.e. one word per sample with the new-event-bit set on the first sample of every event.
+        ----------
+        Parameters:
+            events : np.ndarray
+                (n, sample_count) array of ADC samples
+            channel : int
+                [Optional] qMCA channel number that tags every word
+        Returns:
+            raw_data : np.ndarray
+                Flat uint32 array of FIFO words
+    '''
+    raw_data = np.bitwise_and(np.asarray(events, dtype=np.uint32), SAMPLE_MASK)
+    raw_data[:, 0] |= NEW_EVENT_BIT
+    if channel:
+        raw_data |= np.uint32(channel << CHANNEL_SHIFT)
+    return raw_data.ravel()
+
+
+def split_channels(raw_data, channels):
+    '''
+        Demultiplexes the DATA_FIFO word stream of several channels by the channel number in every word.
+        The arbiter of the firmware interleaves the words of the channels, but the order of the words of every channel is kept.
+        ----------
+        Parameters:
+            raw_data : np.ndarray
+                uint32 words as returned by DATA_FIFO.get_data()
+            channels : list
+                qMCA channel numbers to extract. Words of other channels are omitted.
+        Returns:
+            channel_data : list
+                uint32 words of every channel in order of channels. If all words belong to a single channel, raw_data itself is returned for it.
+    '''
+    tags = np.bitwise_and(np.right_shift(raw_data, CHANNEL_SHIFT), CHANNEL_MASK)
+    counts = np.bincount(tags, minlength=N_CHANNELS)
+    channel_data = []
+    for channel in channels:
+        if counts[channel] == raw_data.shape[0]:
+            channel_data.append(raw_data)
+        elif counts[channel] == 0:
+            channel_data.append(raw_data[:0])
+        else:
+            channel_data.append(raw_data[tags == channel])
+    return channel_data
+
+
+def _find_events(raw_data, sample_count, scratch=None):
+    '''
+        Locates the new-event-bits in raw_data and flags every event that is exactly sample_count words long.
+        If given, scratch is used as preallocated temporary storage of at least the size of raw_data.
+    '''
+    if scratch is None or scratch.shape[0] < raw_data.shape[0]:
+        headers = np.flatnonzero(raw_data & NEW_EVENT_BIT)
+    else:
+        headers = np.flatnonzero(np.bitwise_and(raw_data, NEW_EVENT_BIT, out=scratch[:raw_data.shape[0]]))
+    lengths = np.diff(np.append(headers, raw_data.shape[0]))
+    return headers, lengths == sample_count
+
+
+def _gather_events(raw_data, sample_count, headers, complete, dtype=None, allocate=None):
+    '''
+        Collects the complete events of raw_data into a (n, sample_count) array and removes the new-event-bit.
+        If dtype differs from the dtype of raw_data, the events are converted into an array obtained from allocate(size), if given.
+    '''
+    n_events = np.count_nonzero(complete)
+    if dtype is None:
+        dtype = raw_data.dtype
+
+    if n_events == 0:
+        return np.empty((0, sample_count), dtype=dtype)
+
+    # Complete events are adjacent if only the trailing event is chopped
+    if complete[:n_events].all():
+        start = headers[0]
+        event_data = raw_data[start:start + n_events * sample_count].reshape(n_events, sample_count)
+    else:
+        logging.debug('Irregular event spacing. Dropping %d malformed events.', headers.shape[0] - n_events)
+        index = headers[complete][:, np.newaxis] + np.arange(sample_count)
+        event_data = raw_data[index]
+
+    if event_data.dtype != dtype:
+        out = allocate(event_data.size) if allocate is not None else None
+        out = np.empty(event_data.shape, dtype=dtype) if out is None else out.reshape(event_data.shape)
+        if dtype == np.uint16 and event_data.flags.c_contiguous:
+            event_data = event_data.view(np.uint16)[:, _LOW_HALF::2]           # Avoids the buffered cast of the ufunc
+        return np.bitwise_and(event_data, SAMPLE_MASK, out=out, casting='unsafe')
+    if event_data.flags.writeable:
+        return np.bitwise_and(event_data, SAMPLE_MASK, out=event_data)
+    return np.bitwise_and(event_data, SAMPLE_MASK)
+
+
+def split_events(raw_data, sample_count, dtype=None):
+    '''
+        Splits a raw DATA_FIFO word stream into events by means of the new-event-bit.
+        Every new-event-bit that is followed by exactly sample_count words (up to the next new-event-bit or the end of the stream) starts a complete event.
+        Data before the first new-event-bit and chopped events are omitted.
+        If all complete events are adjacent and no dtype conversion is requested, the events are returned as a reshaped view into raw_data and the new-event-bit is removed in place.
+        Otherwise the complete events are collected with a single fancy-index gather.
+        ----------
+        Parameters:
+            raw_data : np.ndarray
+                uint32 words as returned by DATA_FIFO.get_data()
+            sample_count : int
+                Length of event in ADC samples
+            dtype : np.dtype
+                [Optional] dtype of the events, e.g. np.uint16. Defaults to the dtype of raw_data.
+        Returns:
+            event_data : np.ndarray
+                (n, sample_count) array of events
+    '''
+    headers, complete = _find_events(raw_data, sample_count)
+    return _gather_events(raw_data, sample_count, headers, complete, dtype)
+
+
+class RingBuffer(object):
+    '''
+        Preallocated ring buffer, by default of uint32 words.
+        Every stored block is contiguous, so that views into the buffer can be handed out.
+        Views that are handed out with references are not overwritten until they are released as often. Otherwise they stay valid until the next block is stored.
+    '''
+
+    def __init__(self, capacity, dtype=np.uint32):
+        '''
+            Parameters
+            ----------
+            capacity : int
+                Size of the buffer in elements
+            dtype : np.dtype
+                [Optional] dtype of the elements
+        '''
+        self.capacity = capacity
+        self._buffer = np.zeros(capacity, dtype=dtype)                          # Touch all pages now instead of during acquisition
+        self._address = self._buffer.__array_interface__['data'][0]
+        self._regions = deque()                                                 # [start, end, references] of handed out views in order of storage
+        self._lock = threading.Lock()
+        self._head = 0
+        self.misses = 0
+
+    def allocate(self, size):
+        '''
+            Returns:
+                view : np.ndarray
+                    View of size contiguous free elements of the buffer or None if there is not enough free space
+        '''
+        with self._lock:
+            tail = self._regions[0][0] if self._regions else None
+            if tail is not None and tail > self._head:                         # Free space is [head, tail)
+                start = self._head if self._head + size < tail else None
+            elif self._head + size <= self.capacity:                            # Free space is [head, capacity) and [0, tail)
+                start = self._head
+            elif size < (self.capacity + 1 if tail is None else tail):
+                start = 0
+            else:
+                start = None
+
+        if start is None:
+            self.misses += 1
+            return None
+        self._head = start + size
+        return self._buffer[start:start + size]
+
+    def store(self, head_data, data):
+        '''
+            Copies head_data and data into the buffer, one directly after the other.
+            ----------
+            Returns:
+                words : np.ndarray
+                    View into the buffer. If there is not enough free space, a newly allocated array is returned instead.
+        '''
+        n_head = head_data.shape[0]
+        words = self.allocate(n_head + data.shape[0])
+        if words is None:
+            return np.concatenate((head_data, data))
+        words[:n_head] = head_data
+        words[n_head:] = data
+        return words
+
+    def hand_out(self, view, references):
+        '''
+            Protects the words of view from being overwritten until it is released references times.
+        '''
+        start = self._offset(view)
+        if start is None or references == 0 or view.size == 0:
+            return
+        with self._lock:
+            self._regions.append([start, start + view.size, references])
+
+    def release(self, view):
+        '''
+            Releases a view that was handed out with references.
+        '''
+        start = self._offset(view)
+        if start is None:
+            return
+        with self._lock:
+            for region in self._regions:
+                if region[0] == start:
+                    region[2] -= 1
+                    break
+            while self._regions and self._regions[0][2] <= 0:
+                self._regions.popleft()
+
+    def _offset(self, view):
+        offset = (view.__array_interface__['data'][0] - self._address) // self._buffer.itemsize
+        if 0 <= offset < self.capacity:
+            return offset
+
+
+class EventBuilder(object):
+    '''
+        Reassembles events from consecutive DATA_FIFO reads.
+        The trailing chopped event of a read is kept and joined to the beginning of the next read, so no events are lost at poll boundaries.
+        If a capacity is given, reads are copied into a preallocated ring buffer and the events are handed out as views into a ring buffer, so that no memory is allocated per read.
+        For uint32 events this is the ring buffer of the raw data, for other dtypes the events are converted into a second ring buffer of that dtype.
+    '''
+
+    def __init__(self, sample_count, capacity=None, dtype=np.uint32, max_read_words=None):
+        '''
+            Parameters
+            ----------
+            sample_count : int
+                Length of event in ADC samples
+            capacity : int
+                [Optional] Size of the ring buffers in words/samples. Without ring buffers the events are views into (a copy of) the raw data.
+            dtype : np.dtype
+                [Optional] dtype of the events. The 14 bit ADC samples fit into np.uint16.
+            max_read_words : int
+                [Optional] Largest read in words. Sizes the preallocated temporary storage of the event search, which defaults to the capacity.
+        '''
+        self.sample_count = sample_count
+        self.dtype = np.dtype(dtype)
+        self._remainder = np.empty(0, dtype=np.uint32)
+        self._remainder_buffer = np.empty(sample_count, dtype=np.uint32)
+        if capacity is None:
+            self.ring_buffer = None
+            self.event_buffer = None
+            self._scratch = None
+        else:
+            self.ring_buffer = RingBuffer(capacity)
+            self.event_buffer = self.ring_buffer if self.dtype == self.ring_buffer._buffer.dtype else RingBuffer(capacity, dtype=self.dtype)
+            self._scratch = np.zeros(capacity if max_read_words is None else min(max_read_words + sample_count, capacity), dtype=np.uint32)   # A read and the carried partial event
+        self.recovered_events = 0
+        self.discarded_events = 0
+
+    def reset(self):
+        '''
+            Drops the carried partial event, e.g. after the fadc_rx was reset and the data stream is discontinuous.
+        '''
+        if self._remainder.shape[0] > 0:
+            self.discarded_events += 1
+        self._remainder = np.empty(0, dtype=np.uint32)
+
+    def build_events(self, raw_data, references=0):
+        '''
+            Splits raw_data into events, completing the partial event carried over from the previous read.
+            ----------
+            Parameters:
+                raw_data : np.ndarray
+                    uint32 words as returned by DATA_FIFO.get_data()
+                references : int
+                    [Optional] Number of release() calls after which the event ring buffer may overwrite the returned events.
+                    With 0 the events are valid until the next call.
+            Returns:
+                event_data : np.ndarray
+                    (n, sample_count) array of events
+        '''
+        carried = self._remainder.shape[0] > 0
+        if self.ring_buffer is not None:
+            raw_data = self.ring_buffer.store(self._remainder, raw_data)
+        elif carried:
+            raw_data = np.concatenate((self._remainder, raw_data))
+
+        headers, complete = _find_events(raw_data, self.sample_count, self._scratch)
+
+        discarded = headers.shape[0] - np.count_nonzero(complete)
+        if headers.shape[0] == 0 or headers[0] > 0:                             # Data before the first new-event-bit
+            discarded += 1 if raw_data.shape[0] > 0 else 0
+        if headers.shape[0] > 0 and raw_data.shape[0] - headers[-1] < self.sample_count:
+            self._keep_remainder(raw_data[headers[-1]:])                        # Keep the chopped trailing event for the next read
+            discarded -= 1
+        else:
+            self._remainder = np.empty(0, dtype=np.uint32)
+        if carried and complete[0]:
+            self.recovered_events += 1
+        self.discarded_events += discarded
+
+        if self.event_buffer is not None:
+            event_data = _gather_events(raw_data, self.sample_count, headers, complete, self.dtype, self.event_buffer.allocate)
+            self.event_buffer.hand_out(event_data, references)
+        else:
+            event_data = _gather_events(raw_data, self.sample_count, headers, complete, self.dtype)
+        return event_data
+
+    @property
+    def buffer_misses(self):
+        '''
+            Number of reads that did not fit into the ring buffers
+        '''
+        if self.ring_buffer is None:
+            return 0
+        if self.event_buffer is self.ring_buffer:
+            return self.ring_buffer.misses
+        return self.ring_buffer.misses + self.event_buffer.misses
+
+    def release(self, event_data):
+        '''
+            Releases events that were built with references, see build_events().
+        '''
+        if self.event_buffer is not None:
+            self.event_buffer.release(event_data)
+
+    def _keep_remainder(self, remainder):
+        if self._remainder_buffer.shape[0] < remainder.shape[0]:
+            self._remainder_buffer = np.empty(remainder.shape[0], dtype=np.uint32)
+        self._remainder = self._remainder_buffer[:remainder.shape[0]]
+        self._remainder[:] = remainder
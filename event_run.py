@@ -0,0 +1,209 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import os
+import json
+import logging
+import numpy as np
+import tables as tb
+
+from event_writer import READOUT_DTYPE
+from features import FEATURE_DTYPE
+
+CHUNK_BYTES = 2**26                                                             # Default memory budget of a block of iter_chunks()
+
+
+class EventRun(object):
+    '''
+        Opens the events of a run, that may be split into several files by the EventWriter, as one logical (n, sample_count) dataset.
+        Only the files and HDF5 chunks of the requested event range are read and decompressed.
+        Events of files that were not closed (e.g. after a crash) are available up to the last flush recorded in the run index.
+    '''
+
+    def __init__(self, path):
+        '''
+            Parameters
+            ----------
+            path : string
+                Run index (<name>_index.json) or a single h5 file
+        '''
+        self.path = path
+        self._handles = {}
+        if os.path.splitext(path)[1] == '.json':
+            with open(path, 'r') as index_file:
+                index = json.load(index_file)
+            directory = os.path.dirname(path)
+            self.sample_count = index['sample_count']
+            self.dtype = np.dtype(index['dtype'])
+            self.files = []
+            for entry in index['files']:
+                entry = dict(entry, filename=os.path.join(directory, entry['filename']))
+                if not entry['closed'] and not self._check_file(entry):
+                    break
+                self.files.append(entry)
+        else:
+            with tb.open_file(path, 'r') as infile:
+                self.sample_count = infile.root.event_data.shape[1]
+                self.dtype = infile.root.event_data.dtype
+                self.files = [dict(filename=path, first_event=0, n_events=infile.root.event_data.nrows, closed=True)]
+        self.n_events = self.files[-1]['first_event'] + self.files[-1]['n_events'] if self.files else 0
+        self._first_events = np.array([entry['first_event'] for entry in self.files], dtype=np.int64)
+
+    def _check_file(self, entry):
+        try:
+            with tb.open_file(entry['filename'], 'r') as infile:
+                entry['n_events'] = min(entry['n_events'], infile.root.event_data.nrows)
+        except (IOError, tb.exceptions.HDF5ExtError) as e:
+            logging.error('%s was not closed and cannot be read: %s', entry['filename'], e)
+            return False
+        logging.warning('%s was not closed. Using the %d events of the last flush.', entry['filename'], entry['n_events'])
+        return True
+
+    @property
+    def shape(self):
+        return (self.n_events, self.sample_count)
+
+    def __len__(self):
+        return self.n_events
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_events)
+            return self.read(start, max(start, stop))[::step]
+        if key < 0:
+            key += self.n_events
+        if not 0 <= key < self.n_events:
+            raise IndexError('Event %d out of range' % key)
+        return self.read(key, key + 1)[0]
+
+    def read(self, start=0, stop=None):
+        '''
+            Reads the events [start, stop) of the run.
+            ----------
+            Returns:
+                event_data : np.ndarray
+                    (stop - start, sample_count) array of events
+        '''
+        stop = self.n_events if stop is None else min(stop, self.n_events)
+        event_data = np.empty((max(stop - start, 0), self.sample_count), dtype=self.dtype)
+        if stop <= start:
+            return event_data
+        for i in range(max(np.searchsorted(self._first_events, start, side='right') - 1, 0), len(self.files)):
+            entry = self.files[i]
+            if entry['first_event'] >= stop:
+                break
+            first = max(start, entry['first_event'])
+            last = min(stop, entry['first_event'] + entry['n_events'])
+            if last > first:
+                event_data[first - start:last - start] = self._get_array(i)[first - entry['first_event']:last - entry['first_event']]
+        return event_data
+
+    def iter_blocks(self, block_size=100000, start=0, stop=None):
+        '''
+            Iterates over the events [start, stop) in blocks of block_size events.
+            ----------
+            Returns:
+                first_event : int
+                    Number of the first event of the block
+                event_data : np.ndarray
+                    (n, sample_count) array of events
+        '''
+        stop = self.n_events if stop is None else min(stop, self.n_events)
+        for first_event in range(start, stop, block_size):
+            yield first_event, self.read(first_event, min(first_event + block_size, stop))
+
+    def iter_chunks(self, max_bytes=CHUNK_BYTES, start=0, stop=None):
+        '''
+            Iterates over the events [start, stop) in blocks that follow the HDF5 chunk layout: every block consists of whole chunks of a single file
+            (except at start, stop and the end of a file) and holds at most max_bytes, or one chunk if a chunk is larger. So every chunk is read and decompressed once
+            and the memory is bounded independent of the size of the run.
+            ----------
+            Returns:
+                first_event : int
+                    Number of the first event of the block
+                event_data : np.ndarray
+                    (n, sample_count) array of events
+        '''
+        stop = self.n_events if stop is None else min(stop, self.n_events)
+        for i, entry in enumerate(self.files):
+            first = max(start, entry['first_event']) - entry['first_event']
+            last = min(stop, entry['first_event'] + entry['n_events']) - entry['first_event']
+            if last <= first:
+                continue
+            array = self._get_array(i)
+            chunk_rows = array.chunkshape[0] if array.chunkshape else 1
+            block_rows = max(max_bytes // (chunk_rows * self.sample_count * array.dtype.itemsize), 1) * chunk_rows
+            block_start = first
+            while block_start < last:
+                block_stop = min((block_start // block_rows + 1) * block_rows, last)   # Aligned to the chunks
+                yield entry['first_event'] + block_start, array[block_start:block_stop]
+                block_start = block_stop
+
+    def get_live_time(self):
+        '''
+            Measurement time of the run, the sum of the times from opening to the last flush of every file.
+            Single h5 files have no run index, their measurement time is estimated by the span of the readout block timestamps.
+            ----------
+            Returns:
+                live_time : float
+                    Measurement time in seconds, None if unknown
+        '''
+        if all('start_time' in entry for entry in self.files):
+            return float(sum(entry['stop_time'] - entry['start_time'] for entry in self.files))
+        timestamps = self.read_readouts()['timestamp']
+        if len(timestamps) < 2:
+            return None
+        return float(timestamps[-1] - timestamps[0])
+
+    def read_readouts(self):
+        '''
+            Reads the readout block table of all files, see READOUT_DTYPE. Files written by older versions have no such table.
+            ----------
+            Returns:
+                readout_data : np.ndarray
+                    Structured array with one row per readout block
+        '''
+        readout_data = self._read_table('readout_data', READOUT_DTYPE)
+        if self.files and not self.files[-1]['closed']:
+            readout_data = readout_data[readout_data['timestamp'] <= self.files[-1]['stop_time']]   # Only blocks of the last flush
+        return readout_data
+
+    def read_features(self):
+        '''
+            Reads the pulse features of all events, see FEATURE_DTYPE. Only runs with feature extraction have features.
+            ----------
+            Returns:
+                feature_data : np.ndarray
+                    Structured array with one row per event. waveform_index is the event number in this run of the stored waveform or -1.
+        '''
+        return self._read_table('feature_data', FEATURE_DTYPE)
+
+    def _read_table(self, name, dtype):
+        data = []
+        for i in range(len(self.files)):
+            infile = self._get_array(i)._v_file
+            if name in infile.root:
+                data.append(infile.get_node(infile.root, name)[:])
+        if not data:
+            return np.empty(0, dtype=dtype)
+        return np.concatenate(data)
+
+    def _get_array(self, i):
+        if i not in self._handles:
+            self._handles[i] = tb.open_file(self.files[i]['filename'], 'r')
+        return self._handles[i].root.event_data
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
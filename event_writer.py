@@ -0,0 +1,281 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import os
+import time
+import json
+import logging
+import numpy as np
+import tables as tb
+
+from features import FEATURE_DTYPE
+
+SHUFFLES = ('shuffle', 'bitshuffle', 'none')
+INDEX_VERSION = 1
+
+# One row per SRAM readout block
+READOUT_DTYPE = np.dtype([
+    ('timestamp', '<f8'),                                                       # Host time of the read in seconds since the epoch
+    ('first_event', '<i8'),                                                     # Number of the first event of the block in the run
+    ('n_events', '<u4'),                                                        # Number of events of the block, including events without stored waveform
+    ('threshold', '<u2'),
+    ('channel', '<u1'),
+    ('fifo_words', '<u4'),                                                      # Number of 32 bit words read from the SRAM FIFO
+    ('count_lost', '<u4')                                                       # Lost count of the fadc_rx before the read, > 0 means the FIFO overflowed
+])
+
+
+def make_filters(complib='blosc', complevel=5, shuffle='shuffle'):
+    '''
+        Creates the HDF5 filters of the event EArray.
+        ----------
+        Parameters:
+            complib : string
+                Compressor as known to PyTables, e.g. 'blosc', 'blosc:lz4' or 'blosc:zstd'. None disables compression.
+            complevel : int [0:9]
+                Compression level. 0 disables compression.
+            shuffle : string
+                One of 'shuffle', 'bitshuffle' and 'none'
+        Returns:
+            filters : tables.Filters
+    '''
+    if shuffle not in SHUFFLES:
+        raise ValueError('Unknown shuffle %s' % shuffle)
+    if complib is None or complevel == 0:
+        return tb.Filters(complevel=0, shuffle=False, fletcher32=False)
+    if complib not in tb.filters.all_complibs:
+        raise ValueError('Unknown compressor %s' % complib)
+    return tb.Filters(complib=complib, complevel=complevel, shuffle=shuffle == 'shuffle', bitshuffle=shuffle == 'bitshuffle', fletcher32=False)
+
+
+class EventWriter(object):
+    '''
+        Appends events to the 'event_data' EArray of a HDF5 file.
+        The data is flushed to disk when flush_interval seconds have passed or flush_bytes bytes were appended since the last flush, whichever comes first.
+        If max_file_events or max_file_time is given, the output rolls over to a new file when the limit is reached and the previous file is closed, so that a crash can only affect the last file.
+        A run index (<name>_index.json) lists every file with its event range and timestamps. It is updated on every flush and contains only flushed events, see EventRun.
+        Every file also contains the 'readout_data' table with one row per readout block (see READOUT_DTYPE) and, if features are given, the 'feature_data' table with one row per event (see FEATURE_DTYPE).
+        The rows are collected and appended on flush. With features, only the waveforms of every waveform_prescale-th event are stored.
+    '''
+
+    def __init__(self, sample_count, dtype=np.uint16, chunkshape=None, complib='blosc', complevel=5, shuffle='shuffle', flush_interval=1., flush_bytes=None, max_file_events=None, max_file_time=None, waveform_prescale=1):
+        '''
+            Parameters
+            ----------
+            sample_count : int
+                Length of event in ADC samples
+            dtype : np.dtype
+                [Optional] dtype of the events
+            chunkshape : int or tuple
+                [Optional] Number of events per HDF5 chunk or the full chunk shape. Chosen by PyTables if None.
+            complib : string
+                [Optional] Compressor, see make_filters()
+            complevel : int [0:9]
+                [Optional] Compression level
+            shuffle : string
+                [Optional] One of 'shuffle', 'bitshuffle' and 'none'
+            flush_interval : float
+                [Optional] Maximum time between two flushes in seconds. None disables time based flushing.
+            flush_bytes : int
+                [Optional] Maximum number of bytes appended between two flushes. None disables size based flushing.
+            max_file_events : int
+                [Optional] Maximum number of events per file
+            max_file_time : float
+                [Optional] Maximum time span of a file in seconds
+            waveform_prescale : int
+                [Optional] Store only the waveform of every n-th event for which features are given (features-only mode)
+        '''
+        self.sample_count = sample_count
+        self.dtype = np.dtype(dtype)
+        if isinstance(chunkshape, int):
+            chunkshape = (chunkshape, sample_count)
+        self.chunkshape = chunkshape
+        self.filters = make_filters(complib, complevel, shuffle)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_file_events = max_file_events
+        self.max_file_time = max_file_time
+        self.waveform_prescale = waveform_prescale
+        self.output_file = None
+        self.output_array = None
+        self.readout_table = None
+        self.feature_table = None
+        self.index = None
+        self.index_filename = None
+        self.reset_statistics()
+
+    @property
+    def rolling(self):
+        return self.max_file_events is not None or self.max_file_time is not None
+
+    def reset_statistics(self):
+        self.events_processed = 0
+        self.events_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.write_time = 0.
+        self.flush_time = 0.                                                    # Part of write_time spent in flush()
+        self.last_flush_time = 0.
+        self._unflushed_bytes = 0
+        self._last_flush = time.time()
+
+    def open(self, filename):
+        '''
+            Starts a new run. Without rolling the events are written to filename, otherwise to <name>_0000.h5, <name>_0001.h5, ...
+        '''
+        self.reset_statistics()
+        self._name = os.path.splitext(filename)[0]
+        self.index_filename = self._name + '_index.json'
+        self._readout_rows = []
+        self._feature_rows = []
+        self.index = dict(version=INDEX_VERSION, sample_count=self.sample_count, dtype=self.dtype.name, n_events=0, files=[])
+        self._open_file()
+
+    def append(self, events_data, readout=None, features=None):
+        '''
+            Appends events to the file and flushes if the flush policy requests it. Rolls over to a new file if the file limits are reached.
+            ----------
+            Parameters:
+                events_data : np.ndarray
+                    (n, sample_count) array of events of one readout block
+                readout : tuple
+                    [Optional] (timestamp, threshold, channel, fifo_words, count_lost) of the readout block
+                features : np.ndarray
+                    [Optional] Features of the events, see extract_features()
+        '''
+        start = time.time()
+        if self.max_file_time is not None and start - self._file_start >= self.max_file_time and self.output_array.nrows > 0:
+            self._roll()
+
+        n_events = events_data.shape[0]
+        if readout is not None:
+            self._readout_rows.append((readout[0], self.events_processed, n_events) + tuple(readout[1:]))
+        if features is not None:
+            features['event_number'] = np.arange(self.events_processed, self.events_processed + n_events)
+            features['waveform_index'] = -1
+            if self.waveform_prescale > 1:
+                stored = np.flatnonzero(features['event_number'] % self.waveform_prescale == 0)
+                events_data = events_data[stored]
+                features['waveform_index'][stored] = np.arange(self.events_written, self.events_written + stored.shape[0])
+            else:
+                features['waveform_index'] = features['event_number'] - self.events_processed + self.events_written
+            self._feature_rows.append(features)
+        self.events_processed += n_events
+
+        if self.max_file_events is not None:
+            while self.output_array.nrows + events_data.shape[0] > self.max_file_events:
+                n_events = self.max_file_events - self.output_array.nrows
+                self._append(events_data[:n_events])
+                self._roll()
+                events_data = events_data[n_events:]
+        self._append(events_data)
+        if (self.flush_bytes is not None and self._unflushed_bytes >= self.flush_bytes) or (self.flush_interval is not None and start - self._last_flush >= self.flush_interval):
+            logging.debug('Recorded %d events. Write data to disk.', self.events_written)
+            self.flush()
+        self.write_time += time.time() - start
+
+    def flush(self):
+        '''
+            Writes the data to disk and updates the run index.
+        '''
+        start = time.time()
+        self._write_readouts()
+        self.output_file.flush()
+        self.flushes += 1
+        self._unflushed_bytes = 0
+        self._last_flush = time.time()
+        self._update_index()
+        self._write_index()
+        self.last_flush_time = time.time() - start
+        self.flush_time += self.last_flush_time
+
+    def close(self):
+        if self.output_file is None:
+            return
+        self._close_file()
+
+    def _append(self, events_data):
+        if events_data.shape[0] == 0:
+            return
+        self.output_array.append(events_data)
+        self.events_written += events_data.shape[0]
+        self.bytes_written += events_data.nbytes
+        self._unflushed_bytes += events_data.nbytes
+
+    def _open_file(self):
+        filename = '%s_%04d.h5' % (self._name, len(self.index['files'])) if self.rolling else self._name + '.h5'
+        self._file_start = time.time()
+        self.output_file = tb.open_file(filename, 'w')
+        self.output_array = self.output_file.create_earray(self.output_file.root, name='event_data', atom=tb.Atom.from_dtype(self.dtype), shape=(0, self.sample_count), title='The raw events from the ADC', filters=self.filters, chunkshape=self.chunkshape)
+        self.output_array.attrs.first_event = self.index['n_events']
+        self.readout_table = self.output_file.create_table(self.output_file.root, name='readout_data', description=READOUT_DTYPE, title='Readout blocks', filters=self.filters)
+        self.index['files'].append(dict(filename=os.path.basename(filename), first_event=self.index['n_events'], n_events=0, start_time=self._file_start, stop_time=self._file_start, closed=False))
+        self._write_index()
+
+    def _close_file(self):
+        self._write_readouts()
+        self.output_file.flush()
+        entry = self._update_index()
+        self.output_file.close()
+        self.output_file = None
+        self.output_array = None
+        self.readout_table = None
+        self.feature_table = None
+        entry['closed'] = True
+        self.flushes += 1
+        self._unflushed_bytes = 0
+        self._write_index()
+        return entry
+
+    def _roll(self):
+        entry = self._close_file()
+        logging.info('Closed %s with %d events.', entry['filename'], entry['n_events'])
+        self._open_file()
+
+    def _write_readouts(self):
+        if self._readout_rows:
+            self.readout_table.append(self._readout_rows)
+            self._readout_rows = []
+        if self._feature_rows:
+            if self.feature_table is None:
+                self.feature_table = self.output_file.create_table(self.output_file.root, name='feature_data', description=FEATURE_DTYPE, title='Pulse features', filters=self.filters)
+            self.feature_table.append(np.concatenate(self._feature_rows))
+            self._feature_rows = []
+
+    def _update_index(self):
+        entry = self.index['files'][-1]
+        entry['n_events'] = int(self.output_array.nrows)
+        entry['stop_time'] = time.time()
+        self.index['n_events'] = entry['first_event'] + entry['n_events']
+        return entry
+
+    def _write_index(self):
+        '''
+            Replaces the run index atomically, so a valid index exists at any time.
+        '''
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w') as index_file:
+            json.dump(self.index, index_file, indent=1)
+        if os.name == 'nt' and os.path.exists(self.index_filename):
+            os.remove(self.index_filename)                                      # os.rename does not replace on Windows in Python 2
+        os.rename(tmp_filename, self.index_filename)
+
+    def get_statistics(self):
+        '''
+            Returns:
+                statistics : dict
+                    Processed events, written events and uncompressed bytes, number of flushes, the time spent appending and flushing and the resulting uncompressed write speed in MB/s
+        '''
+        return dict(
+            events_processed=self.events_processed,
+            events_written=self.events_written,
+            bytes_written=self.bytes_written,
+            flushes=self.flushes,
+            write_time=self.write_time,
+            flush_time=self.flush_time,
+            write_speed=self.bytes_written / self.write_time / 1e6 if self.write_time > 0 else 0.
+        )
@@ -0,0 +1,57 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+
+# One row per event
+FEATURE_DTYPE = np.dtype([
+    ('event_number', '<i8'),                                                    # Number of the event in the run
+    ('waveform_index', '<i8'),                                                  # Row of the waveform in event_data or -1 if it was not stored
+    ('baseline', '<f4'),
+    ('baseline_rms', '<f4'),
+    ('amplitude', '<f4'),                                                       # Peak height above baseline
+    ('peak_position', '<u2'),
+    ('rise_time', '<u2'),                                                       # Samples from 10% to 90% of the amplitude
+    ('integral', '<f4')                                                         # Sum of the samples above baseline
+])
+
+
+def extract_features(events_data, baseline_samples=40):
+    '''
+        Computes the pulse features of a block of events at once. event_number and waveform_index are left to the caller.
+        ----------
+        Parameters:
+            events_data : np.ndarray
+                (n, sample_count) array of events
+            baseline_samples : int
+                [Optional] Number of samples at the beginning of every event that are used for the baseline
+        Returns:
+            features : np.ndarray
+                Structured array of FEATURE_DTYPE with one row per event
+    '''
+    n_events, sample_count = events_data.shape
+    features = np.zeros(n_events, dtype=FEATURE_DTYPE)
+    if n_events == 0:
+        return features
+
+    pre_trigger = events_data[:, :baseline_samples].astype(np.float32)
+    baseline = pre_trigger.mean(axis=1)
+    features['baseline'] = baseline
+    features['baseline_rms'] = pre_trigger.std(axis=1)
+
+    peak_position = np.argmax(events_data, axis=1)
+    amplitude = events_data[np.arange(n_events), peak_position] - baseline
+    features['peak_position'] = peak_position
+    features['amplitude'] = amplitude
+    features['integral'] = events_data.sum(axis=1, dtype=np.int64) - baseline * sample_count
+
+    # First samples above 10% and 90% of the amplitude. The peak itself is always above.
+    pulse = events_data - baseline[:, np.newaxis]
+    rise_start = np.argmax(pulse >= 0.1 * amplitude[:, np.newaxis], axis=1)
+    rise_stop = np.argmax(pulse >= 0.9 * amplitude[:, np.newaxis], axis=1)
+    features['rise_time'] = np.maximum(rise_stop - rise_start, 0)
+    return features
@@ -71,6 +71,7 @@ module qmca (
 
     localparam ADC_RX_CH0_BASEADDR = 16'h0030;                 // 0x0030
     localparam ADC_RX_CH0_HIGHADDR = ADC_RX_CH0_BASEADDR + 15; // 0x003f
+    // Receivers of channel 1-3 follow at 0x0040, 0x0050 and 0x0060
 
     localparam GPIO_TH_BASEADDR = 16'h0100;                 
     localparam GPIO_TH_HIGHADDR = GPIO_TH_BASEADDR + 16'h00ff; 
@@ -153,13 +154,25 @@ module qmca (
     
     // -------  USER MODULES  ------- //
      
-     wire [1:0] SEL_ADC_CH; 
-     wire [13:0] TH;
+     /**
+      * Trigger configuration
+      * 16 bit per channel with the 14 bit threshold TH<ch> in the lower bits,
+      * followed by the trigger enable EN_CH of every channel
+      */
+     wire [71:0] GPIO_TH_IO;
+     wire [13:0] TH [3:0];
+     wire [3:0] EN_CH;
+     assign TH[0] = GPIO_TH_IO[13:0];
+     assign TH[1] = GPIO_TH_IO[29:16];
+     assign TH[2] = GPIO_TH_IO[45:32];
+     assign TH[3] = GPIO_TH_IO[61:48];
+     assign EN_CH = GPIO_TH_IO[67:64];
+
      gpio #(
          .BASEADDR(GPIO_TH_BASEADDR),
          .HIGHADDR(GPIO_TH_HIGHADDR),
-         .IO_WIDTH(16),
-         .IO_DIRECTION(16'hffff)
+         .IO_WIDTH(72),
+         .IO_DIRECTION(72'hffffffffffffffffff)
       ) i_gpio_rx (
         .BUS_CLK(bus_clk), 
         .BUS_RST(bus_rst), 
@@ -167,7 +180,7 @@ module qmca (
         .BUS_DATA(usb_data),
         .BUS_RD(bus_rd),
         .BUS_WR(bus_wr),
-        .IO({SEL_ADC_CH, TH})
+        .IO(GPIO_TH_IO)
      );
 
 
@@ -244,46 +257,53 @@ module qmca (
 
     /**
      * Setup QMCA Readout
-     */
+     * One receiver per FADC channel, that triggers on the rising edge of its channel over its threshold.
+     * The words of every receiver are tagged with the channel (ADC_ID in bits 30:29)
+     * and merged into the SRAM FIFO by the arbiter.
+     */
 
     wire [3:0] FIFO_EMPTY_ADC, FIFO_READ;
     wire [31:0] FIFO_DATA_ADC [3:0];
 
-    reg adc_trig;
-    always@(posedge adc_enc)
-        adc_trig <= adc_out[SEL_ADC_CH] > TH;
-     
-    wire ADC_TRIG ;
-    assign ADC_TRIG = adc_out[SEL_ADC_CH] > TH && adc_trig == 0;
-
-    gpac_adc_rx 
-    #(
-        .BASEADDR(ADC_RX_CH0_BASEADDR), 
-        .HIGHADDR(ADC_RX_CH0_HIGHADDR),
-        .ADC_ID(0), 
-        .HEADER_ID(0) 
-    ) i_gpac_adc_rx
-    (
-        .ADC_ENC(adc_enc),
-        .ADC_IN(adc_out[SEL_ADC_CH]),
-        .ADC_SYNC(1'b0),
-        .ADC_TRIGGER(ADC_TRIG),
-
-        .BUS_CLK(bus_clk),
-        .BUS_RST(bus_rst),
-        .BUS_ADD(bus_add),
-        .BUS_DATA(usb_data),
-        .BUS_RD(bus_rd),
-        .BUS_WR(bus_wr), 
-
-        .FIFO_READ(FIFO_READ[0]),
-        .FIFO_EMPTY(FIFO_EMPTY_ADC[0]),
-        .FIFO_DATA(FIFO_DATA_ADC[0]),
-
-        .LOST_ERROR()
-    ); 
-
-    assign FIFO_EMPTY_ADC[3:1] = 3'b111;
+    reg [3:0] adc_trig;
+    wire [3:0] ADC_TRIG;
+
+    genvar ch;
+    generate
+        for (ch = 0; ch < 4; ch = ch + 1) begin: adc_rx_ch
+            always@(posedge adc_enc)
+                adc_trig[ch] <= adc_out[ch] > TH[ch];
+
+            assign ADC_TRIG[ch] = EN_CH[ch] && adc_out[ch] > TH[ch] && adc_trig[ch] == 0;
+
+            gpac_adc_rx 
+            #(
+                .BASEADDR(ADC_RX_CH0_BASEADDR + 16 * ch), 
+                .HIGHADDR(ADC_RX_CH0_HIGHADDR + 16 * ch),
+                .ADC_ID(ch), 
+                .HEADER_ID(0) 
+            ) i_gpac_adc_rx
+            (
+                .ADC_ENC(adc_enc),
+                .ADC_IN(adc_out[ch]),
+                .ADC_SYNC(1'b0),
+                .ADC_TRIGGER(ADC_TRIG[ch]),
+
+                .BUS_CLK(bus_clk),
+                .BUS_RST(bus_rst),
+                .BUS_ADD(bus_add),
+                .BUS_DATA(usb_data),
+                .BUS_RD(bus_rd),
+                .BUS_WR(bus_wr), 
+
+                .FIFO_READ(FIFO_READ[ch]),
+                .FIFO_EMPTY(FIFO_EMPTY_ADC[ch]),
+                .FIFO_DATA(FIFO_DATA_ADC[ch]),
+
+                .LOST_ERROR()
+            );
+        end
+    endgenerate
     
     wire ARB_READY_OUT, ARB_WRITE_OUT;
     wire [31:0] ARB_DATA_OUT;
@@ -0,0 +1,337 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Fits of histograms with bounded parameters: least squares or binned Poisson likelihood, automatic start values
+    and a batch mode that fits many histograms and returns a table of the parameters and their uncertainties.
+'''
+
+import logging
+import multiprocessing
+import numpy as np
+from scipy.optimize import curve_fit, minimize
+try:
+    import pylandau as landau
+except ImportError:                                                             # Only the gauss model works without pylandau
+    landau = None
+
+COSTS = ('lsq', 'chi2', 'poisson')                                              # Unweighted least squares, least squares with Poisson errors, Poisson likelihood
+
+
+def langau(x, mu, eta, sigma, A):
+    return landau.langau(x, mu, eta, sigma, A)
+
+
+def testbeam(x, mu, eta, sigma, A, p4, p5):
+    '''
+        Landau-Gauss peak on an exponential background.
+    '''
+    return landau.langau(x, mu, eta, sigma, A) + p4*np.exp(-x/p5)
+
+
+def gauss(x, mu, sigma, A):
+    return A*np.exp(-(x-mu)**2/(2*sigma**2))
+
+
+def gauss_jacobian(x, mu, sigma, A):
+    g = np.exp(-(x-mu)**2/(2*sigma**2))
+    return np.column_stack((A*g*(x-mu)/sigma**2, A*g*(x-mu)**2/sigma**3, g))
+
+
+def _langau_shape(x, mu, eta, sigma):
+    return landau.langau(x, mu, eta, sigma, 1.)
+
+
+def langau_jacobian(x, mu, eta, sigma, A):
+    '''
+        The amplitude is linear, the derivatives of the shape are finite differences (pylandau has no derivatives).
+    '''
+    return np.column_stack((A*numerical_jacobian(_langau_shape, x, (mu, eta, sigma)), _langau_shape(x, mu, eta, sigma)))
+
+
+def testbeam_jacobian(x, mu, eta, sigma, A, p4, p5):
+    e = np.exp(-x/p5)
+    return np.column_stack((langau_jacobian(x, mu, eta, sigma, A), e, p4*e*x/p5**2))
+
+
+def numerical_jacobian(function, x, p):
+    '''
+        Central differences of function(x, *p) with respect to every parameter, shape (len(x), len(p)).
+    '''
+    p = np.asarray(p, dtype=np.float64)
+    jacobian = np.empty((len(x), len(p)))
+    for i in range(len(p)):
+        step = 1e-6 * max(abs(p[i]), 1.)
+        upper, lower = p.copy(), p.copy()
+        upper[i] += step
+        lower[i] -= step
+        jacobian[:, i] = (function(x, *upper) - function(x, *lower)) / (2*step)
+    return jacobian
+
+
+def _guess_peak(x, y):
+    '''
+        Position, width and height of the peak from the moments of the histogram.
+    '''
+    weights = np.maximum(y, 0).astype(np.float64)
+    if weights.sum() == 0:
+        return float(np.mean(x)), float(np.ptp(x)) / 4., 1.
+    mean = np.average(x, weights=weights)
+    std = np.sqrt(np.average((x - mean)**2, weights=weights))
+    peak = np.argmax(y)
+    mu = x[peak] if 0 < peak < len(y) - 1 else mean                             # The mode, unless the maximum is at the edge, e.g. noise below the peak
+    return float(mu), float(max(std, x[1] - x[0] if len(x) > 1 else 1.)), float(max(np.amax(y), 1.))
+
+
+def _guess_langau(x, y):
+    mu, std, A = _guess_peak(x, y)
+    return (mu, std / 4., std / 4., A)
+
+
+def _guess_testbeam(x, y):
+    '''
+        The background from a straight line fit of log(y) in the first tenth of the bins, the peak from the moments of the remaining counts.
+    '''
+    edge = max(len(x) // 10, 2)
+    slope, intercept = np.polyfit(x[:edge], np.log(np.maximum(y[:edge], 1.)), 1)
+    p5 = -1. / slope if slope < 0 else float(np.ptp(x))
+    p4 = np.exp(min(intercept, 700.))
+    mu, std, A = _guess_peak(x, y - p4*np.exp(-x/p5))
+    return (mu, std / 4., std / 4., A, p4, p5)
+
+
+def _guess_gauss(x, y):
+    return _guess_peak(x, y)
+
+
+def _bounds_langau(x, y):
+    width = (x[1] - x[0]) / 2. if len(x) > 1 else 1e-3                         # Narrower peaks cannot be resolved and make pylandau slow
+    return [x[0], width, width, 0.], [x[-1], np.inf, np.inf, np.inf]
+
+
+def _bounds_testbeam(x, y):
+    lower, upper = _bounds_langau(x, y)
+    return lower + [0., lower[1]], upper + [np.inf, np.inf]
+
+
+def _bounds_gauss(x, y):
+    lower, upper = _bounds_langau(x, y)
+    return [lower[0], lower[1], 0.], [upper[0], np.inf, np.inf]
+
+
+class Model(object):
+    '''
+        Fit function with the names, start values and default bounds of its parameters.
+    '''
+
+    def __init__(self, function, names, guess, bounds, jacobian=None):
+        '''
+            Parameters
+            ----------
+            function : callable
+                Vectorized function(x, *p)
+            names : tuple of strings
+                Names of the parameters
+            guess : callable
+                Start values guess(x, y) from the histogram in the fit range
+            bounds : callable
+                Default (lower, upper) bounds(x, y) of the parameters in the fit range
+            jacobian : callable
+                [Optional] Derivatives jacobian(x, *p) of shape (len(x), len(p)), finite differences if None
+        '''
+        self.function = function
+        self.names = names
+        self.guess = guess
+        self.bounds = bounds
+        self.jacobian = jacobian
+
+    def get_jacobian(self, x, p):
+        if self.jacobian is not None:
+            return self.jacobian(x, *p)
+        return numerical_jacobian(self.function, x, p)
+
+
+MODELS = {
+    'langau': Model(langau, ('mu', 'eta', 'sigma', 'A'), _guess_langau, _bounds_langau, langau_jacobian),
+    'testbeam': Model(testbeam, ('mu', 'eta', 'sigma', 'A', 'p4', 'p5'), _guess_testbeam, _bounds_testbeam, testbeam_jacobian),
+    'gauss': Model(gauss, ('mu', 'sigma', 'A'), _guess_gauss, _bounds_gauss, gauss_jacobian)
+}
+
+
+def _get_model(model):
+    return MODELS[model] if model in MODELS else model
+
+
+def _get_bounds(model, x, y, bounds):
+    lower, upper = model.bounds(x, y)
+    if bounds is not None:                                                      # None entries keep the default bound
+        lower = [default if bound is None else bound for default, bound in zip(lower, bounds[0])]
+        upper = [default if bound is None else bound for default, bound in zip(upper, bounds[1])]
+    return np.array(lower, dtype=np.float64), np.array(upper, dtype=np.float64)
+
+
+def guess_start_values(x, y, model, fit_range=None):
+    '''
+        Start values of a model from the moments of the histogram in the fit range.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if fit_range is not None:
+        in_range = (x > fit_range[0]) & (x < fit_range[1])
+        x, y = x[in_range], y[in_range]
+    return tuple(float(v) for v in _get_model(model).guess(x, y))
+
+
+def fit_histogram(x, y, model, p0=None, fit_range=None, bounds=None, cost='lsq'):
+    '''
+        Fits a model to a histogram.
+        ----------
+        Parameters:
+            x : np.ndarray
+                Bin positions
+            y : np.ndarray
+                Counts per bin
+            model : string or Model
+                Name of a model in MODELS or a Model
+            p0 : tuple
+                [Optional] Start values. Estimated from the moments of the histogram in the fit range if None.
+            fit_range : tuple
+                [Optional] (min, max) of the bins that are fitted, all bins if None
+            bounds : tuple
+                [Optional] (lower, upper) sequences of parameter bounds, None entries keep the default bounds of the model
+            cost : string
+                [Optional] 'lsq' (unweighted least squares), 'chi2' (least squares with Poisson errors) or 'poisson' (binned Poisson likelihood)
+        Returns:
+            result : dict
+                'p', uncertainties 'p_err', covariance 'cov', 'cost' (sum of squares, chi2 or Poisson deviance at the minimum) and degrees of freedom 'ndf'
+        Raises:
+            RuntimeError if the fit does not converge
+    '''
+    if cost not in COSTS:
+        raise ValueError('Unknown cost %s' % cost)
+    model = _get_model(model)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if fit_range is not None:
+        in_range = (x > fit_range[0]) & (x < fit_range[1])                     # Computed once for the whole fit
+        x, y = x[in_range], y[in_range]
+    if len(x) <= len(model.names):
+        raise RuntimeError('Not enough bins in the fit range')
+    if not np.any(y > 0):
+        raise RuntimeError('No counts in the fit range')
+    lower, upper = _get_bounds(model, x, y, bounds)
+    p0 = np.array(model.guess(x, y) if p0 is None else p0, dtype=np.float64)
+    inset = 1e-9 * np.maximum(np.abs(p0), 1.)
+    p0 = np.clip(p0, lower + inset, np.where(np.isfinite(upper), upper - inset, upper))   # Start values have to be within the bounds
+
+    if cost == 'poisson':
+        try:
+            p0 = curve_fit(model.function, x, y, p0=p0, sigma=np.sqrt(np.maximum(y, 1.)), bounds=(lower, upper), jac=model.jacobian or '2-point')[0]   # Least squares solution as start values
+        except (RuntimeError, ValueError):
+            pass
+        p, cov, value = _fit_poisson(model, x, y, p0, lower, upper)
+    else:
+        sigma = np.sqrt(np.maximum(y, 1.)) if cost == 'chi2' else None
+        p, cov = curve_fit(model.function, x, y, p0=p0, sigma=sigma, absolute_sigma=cost == 'chi2', bounds=(lower, upper), jac=model.jacobian or '2-point')
+        residuals = y - model.function(x, *p)
+        value = float(np.sum((residuals / sigma)**2) if sigma is not None else np.sum(residuals**2))
+    return dict(p=tuple(float(v) for v in p), p_err=tuple(float(v) for v in np.sqrt(np.abs(np.diag(cov)))), cov=cov, cost=value, ndf=len(x) - len(p))
+
+
+def _fit_poisson(model, x, y, p0, lower, upper):
+    '''
+        Minimizes the Poisson deviance 2 * sum(f - y + y * log(y / f)). The covariance is the inverse Fisher information J^T diag(1 / f) J.
+    '''
+    positive = y > 0
+    scale = np.maximum(np.abs(p0), 1e-9)                                        # The minimizer works on p / scale, so all parameters are of order 1
+
+    def deviance(q):
+        p = q * scale
+        f = np.maximum(model.function(x, *p), 1e-12)
+        value = 2. * (np.sum(f - y) + np.sum(y[positive] * np.log(y[positive] / f[positive])))
+        gradient = 2. * np.dot(1. - y / f, model.get_jacobian(x, p)) * scale
+        return value, gradient
+
+    bounds = [(l / s if np.isfinite(l) else None, u / s if np.isfinite(u) else None) for l, u, s in zip(lower, upper, scale)]
+    result = minimize(deviance, p0 / scale, jac=True, method='L-BFGS-B', bounds=bounds)
+    if not result.success:
+        raise RuntimeError('Poisson likelihood fit did not converge: %s' % result.message)
+    p = result.x * scale
+    f = np.maximum(model.function(x, *p), 1e-12)
+    jacobian = model.get_jacobian(x, p)
+    try:
+        cov = np.linalg.inv(np.dot(jacobian.T / f, jacobian))
+    except np.linalg.LinAlgError:
+        cov = np.full((len(p0), len(p0)), np.inf)
+    return p, cov, float(result.fun)
+
+
+def make_result_dtype(model):
+    '''
+        Returns:
+            dtype : np.dtype
+                Row of the results table of fit_histograms(): 'index' of the histogram, 'success', 'cost', 'ndf' and every parameter with its uncertainty <name>_err
+    '''
+    fields = [('index', '<i8'), ('success', '?'), ('cost', '<f8'), ('ndf', '<i8')]
+    for name in _get_model(model).names:
+        fields += [(name, '<f8'), (name + '_err', '<f8')]
+    return np.dtype(fields)
+
+
+def _fit_row(job):
+    i, x, y, model, p0, fit_range, bounds, cost = job
+    row = np.zeros(1, dtype=make_result_dtype(model))[0]
+    row['index'] = i
+    try:
+        result = fit_histogram(x, y, model, p0, fit_range, bounds, cost)
+    except (RuntimeError, ValueError) as e:
+        logging.error('Fit of histogram %d failed: %s', i, e)
+        for name in _get_model(model).names:
+            row[name] = row[name + '_err'] = np.nan
+        row['cost'] = np.nan
+        return row
+    row['success'] = True
+    row['cost'] = result['cost']
+    row['ndf'] = result['ndf']
+    for name, value, error in zip(_get_model(model).names, result['p'], result['p_err']):
+        row[name] = value
+        row[name + '_err'] = error
+    return row
+
+
+def fit_histograms(x, ys, model, p0=None, fit_range=None, bounds=None, cost='lsq', processes=1):
+    '''
+        Fits the same model to many histograms, e.g. the channels or files of a campaign. A failed fit gives a row with success False and NaN parameters.
+        ----------
+        Parameters:
+            x : np.ndarray
+                Bin positions, common to all histograms
+            ys : sequence of np.ndarray
+                Counts of every histogram
+            model, fit_range, bounds, cost
+                See fit_histogram(). model has to be a name of MODELS for processes > 1.
+            p0 : tuple or sequence of tuples
+                [Optional] Common start values, start values per histogram or None for automatic start values
+            processes : int
+                [Optional] Number of worker processes, None for the number of cores
+        Returns:
+            results : np.ndarray
+                Structured array with one row per histogram, see make_result_dtype()
+    '''
+    n = len(ys)
+    if p0 is None or np.ndim(p0) == 1:
+        p0 = [p0] * n
+    jobs = [(i, x, ys[i], model, p0[i], fit_range, bounds, cost) for i in range(n)]
+    if processes == 1 or n <= 1:
+        rows = [_fit_row(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), n))
+        try:
+            rows = pool.map(_fit_row, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return np.array(rows, dtype=make_result_dtype(model))
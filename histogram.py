@@ -0,0 +1,109 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+
+
+class IncrementalHistogram(object):
+    '''
+        Fixed-bin histogram over the ADC range that is filled incrementally.
+        The bin of a value is found by a bit shift, so filling is a single np.bincount and an in-place addition.
+        The counts can be rebinned to any coarser power of 2 number of bins, e.g. from 16384 to 512 bins for display, without the original values.
+    '''
+
+    def __init__(self, n_bins=2**14, adc_bits=14):
+        '''
+            Parameters
+            ----------
+            n_bins : int
+                Number of bins over the ADC range. Must be a power of 2.
+            adc_bits : int
+                Resolution of the ADC
+        '''
+        self.shift = _get_shift(n_bins, adc_bits)
+        self.n_bins = n_bins
+        self.adc_bits = adc_bits
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.overflow = 0                                                       # Values >= 2**adc_bits
+
+    def reset(self):
+        self.counts[:] = 0
+        self.overflow = 0
+
+    def fill(self, values):
+        '''
+            Adds values (non-negative integers) to the histogram.
+        '''
+        counts = np.bincount(np.right_shift(values, self.shift), minlength=self.n_bins)
+        if counts.shape[0] > self.n_bins:
+            self.overflow += counts[self.n_bins:].sum()
+            counts = counts[:self.n_bins]
+        self.counts += counts
+
+    def add(self, counts):
+        '''
+            Adds a histogram with the same or a finer binning.
+        '''
+        self.counts += _rebin(counts, self.n_bins)
+
+    def rebin(self, n_bins):
+        '''
+            Returns:
+                counts : np.ndarray
+                    Counts in n_bins bins. If n_bins is larger than the number of bins of the histogram, the counts are returned unchanged.
+        '''
+        return _rebin(self.counts, min(n_bins, self.n_bins))
+
+    def bin_edges(self, n_bins=None):
+        '''
+            Returns:
+                bin_edges : np.ndarray
+                    n_bins + 1 bin edges in ADC channels
+        '''
+        n_bins = self.n_bins if n_bins is None else min(n_bins, self.n_bins)
+        return np.linspace(0, 2**self.adc_bits, n_bins + 1)
+
+
+def find_thresholds(y, edges, condition=90, step=2):
+    '''
+        Finds the trigger threshold of one or many histograms with any binning: the left edge of the first bin
+        whose counts are more than condition times the counts step bins below.
+        ----------
+        Parameters:
+            y : np.ndarray
+                Counts of a histogram, or of many histograms with the same binning (one per row)
+            edges : np.ndarray
+                Bin edges, or only the left edges (as returned by MCA_analysis.histogram_data)
+            condition : float
+                [Optional] Factor by which the counts rise at the threshold
+            step : int
+                [Optional] Distance in bins of the compared counts
+        Returns:
+            thresholds : float or np.ndarray
+                Threshold of every histogram in the unit of edges, NaN if no threshold was found
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    if edges.shape[0] not in (y.shape[-1], y.shape[-1] + 1):
+        raise ValueError('Expected %d bin edges, got %d' % (y.shape[-1] + 1, edges.shape[0]))
+    rise = np.zeros(y.shape, dtype=bool)                                        # The first step bins have no bins below to compare with
+    rise[..., step:] = y[..., step:] > condition * y[..., :-step]
+    thresholds = np.where(np.any(rise, axis=-1), edges[np.argmax(rise, axis=-1)], np.nan)
+    return float(thresholds) if thresholds.ndim == 0 else thresholds
+
+
+def _get_shift(n_bins, adc_bits):
+    shift = adc_bits - int(np.log2(n_bins))
+    if shift < 0 or n_bins != 2**(adc_bits - shift):
+        raise ValueError('Number of bins has to be a power of 2 <= 2**%d' % adc_bits)
+    return shift
+
+
+def _rebin(counts, n_bins):
+    if counts.shape[0] % n_bins:
+        raise ValueError('Cannot rebin %d to %d bins' % (counts.shape[0], n_bins))
+    return counts.reshape(n_bins, -1).sum(axis=1)
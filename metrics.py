@@ -0,0 +1,125 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Low-overhead instrumentation of the acquisition loop: timing histograms and counters that are updated in the hot path and reported as snapshots.
+'''
+
+import os
+import json
+import time
+import threading
+
+N_TIMING_BINS = 32                                                              # Bin i counts durations in [2**(i-1), 2**i) us, the last bin everything above
+
+
+class TimingHistogram(object):
+    '''
+        Histogram of durations with logarithmic bins of a factor of 2, starting at 1 us.
+        The bin is found by the bit length of the duration in us, so recording costs no more than a few integer operations.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bins = [0] * N_TIMING_BINS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.bins[min(int(duration * 1e6).bit_length(), N_TIMING_BINS - 1)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, q):
+        '''
+            Returns:
+                duration : float
+                    Upper edge of the bin that contains the q-th percentile in seconds, i.e. the percentile is at most a factor of 2 smaller
+        '''
+        if self.count == 0:
+            return 0.
+        limit = q / 100. * self.count
+        cumulative = 0
+        for i, counts in enumerate(self.bins):
+            cumulative += counts
+            if cumulative >= limit and counts > 0:
+                return min(2**i * 1e-6, self.max)
+        return self.max
+
+
+class Metrics(object):
+    '''
+        Named timing histograms and counters of the acquisition. Thread-safe, so all pipeline stages can report into one object.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+            self.start_time = time.time()
+
+    def record(self, name, duration):
+        '''
+            Adds a duration in seconds to the timing histogram name.
+        '''
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = TimingHistogram()
+            timer.record(duration)
+
+    def count(self, name, n=1):
+        '''
+            Increases the counter name by n.
+        '''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        '''
+            Returns:
+                snapshot : dict
+                    JSON serializable state: time, elapsed time since the reset, counters and count, total, mean, max, 50/90/99 % percentiles (see TimingHistogram.percentile) and bins of every timer. Durations in seconds.
+        '''
+        with self._lock:
+            now = time.time()
+            timers = {}
+            for name, timer in self.timers.items():
+                timers[name] = dict(count=timer.count, total=timer.total, mean=timer.total / timer.count if timer.count else 0., max=timer.max,
+                                    p50=timer.percentile(50), p90=timer.percentile(90), p99=timer.percentile(99), bins=list(timer.bins))
+            return dict(time=now, elapsed=now - self.start_time, counters=dict((name, int(value)) for name, value in self.counters.items()), timers=timers)
+
+
+def write_metrics(filename, snapshot):
+    '''
+        Writes a snapshot as JSON. The file is replaced atomically, so a dashboard never reads a partial file.
+    '''
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as metrics_file:
+        json.dump(snapshot, metrics_file, sort_keys=True)
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)                                                     # os.rename does not replace on Windows in Python 2
+    os.rename(tmp_filename, filename)
+
+
+def format_metrics(snapshot):
+    '''
+        Returns:
+            text : string
+                One line summary of a snapshot with the 99 % percentiles in ms and the counters
+    '''
+    timers = ', '.join('%s %.2f' % (name, timer['p99'] * 1e3) for name, timer in sorted(snapshot['timers'].items()))
+    counters = ', '.join('%s %d' % (name, value) for name, value in sorted(snapshot['counters'].items()))
+    return 'p99 [ms]: %s | %s' % (timers, counters)
@@ -0,0 +1,103 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Wire protocol of the data stream from qmca to the Online Monitor.
+    Every message consists of two ZeroMQ frames: a fixed size binary header and the raw array data.
+'''
+
+import json
+import struct
+import numpy as np
+
+PROTOCOL_VERSION = 3                                                            # 2: board ID, 3: metrics
+MAGIC = b'QMCA'
+
+MSG_EVENTS = 0                                                                  # (n, sample_count) array of events
+MSG_HISTOGRAM = 1                                                               # (n_bins, 1) cumulative amplitude histogram of the run
+MSG_WAVEFORMS = 2                                                               # (n, sample_count) array of sample waveforms, that are not counted as events
+MSG_METRICS = 3                                                                 # JSON encoded metrics snapshot of the acquisition as uint8 array, see pack_json()
+
+# Supported array dtypes by code
+DTYPES = (np.dtype('<u2'), np.dtype('<u4'), np.dtype('<i4'), np.dtype('<i8'), np.dtype('<f4'), np.dtype('<f8'), np.dtype('u1'))
+
+# magic, version, message type, dtype code, sequence number, rows, columns, threshold, channel, board, timestamp
+_HEADER = struct.Struct('<4sHBBQIIHBBd')
+HEADER_SIZE = _HEADER.size
+
+
+def pack_header(msg_type, sequence, data, threshold, channel, timestamp, board=0):
+    '''
+        Creates the header frame of a message.
+        ----------
+        Parameters:
+            msg_type : int
+                Message type, e.g. MSG_EVENTS
+            sequence : int
+                Sequence number of the message. Gaps tell the receiver how many messages were lost.
+            data : np.ndarray
+                One or two dimensional array that is sent as second frame
+            threshold : int
+                ADC threshold
+            channel : int
+                qMCA channel number
+            timestamp : float
+                Host time of the readout in seconds since the epoch
+            board : int
+                [Optional] ID of the qMCA setup, if several setups send to the same Online Monitor
+        Returns:
+            header : bytes
+    '''
+    shape = data.shape if data.ndim == 2 else (data.shape[0], 1)
+    return _HEADER.pack(MAGIC, PROTOCOL_VERSION, msg_type, DTYPES.index(data.dtype), sequence, shape[0], shape[1], threshold, channel, board, timestamp)
+
+
+def unpack_header(header):
+    '''
+        Decodes the header frame of a message.
+        ----------
+        Returns:
+            meta_data : dict
+                msg_type, sequence, dtype, shape, threshold, channel, board and timestamp of the message
+    '''
+    if len(header) != HEADER_SIZE:
+        raise ValueError('Invalid header size %d' % len(header))
+    magic, version, msg_type, dtype_code, sequence, rows, columns, threshold, channel, board, timestamp = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Invalid header')
+    if version != PROTOCOL_VERSION:
+        raise ValueError('Unsupported protocol version %d, expected %d' % (version, PROTOCOL_VERSION))
+    return dict(msg_type=msg_type, sequence=sequence, dtype=DTYPES[dtype_code], shape=(rows, columns), threshold=threshold, channel=channel, board=board, timestamp=timestamp)
+
+
+def unpack_data(meta_data, buf):
+    '''
+        Parameters:
+            meta_data : dict
+                Decoded header, see unpack_header()
+            buf : zmq.Frame
+                Data frame received with copy=False or any other object that exposes a buffer
+        Returns:
+            data : np.ndarray
+                Read-only view of the array in buf
+    '''
+    return np.frombuffer(buf, dtype=meta_data['dtype']).reshape(meta_data['shape'])
+
+
+def pack_json(obj):
+    '''
+        Returns:
+            data : np.ndarray
+                obj encoded as JSON in a uint8 array, that can be sent like any other data frame
+    '''
+    return np.frombuffer(json.dumps(obj).encode('utf-8'), dtype=np.uint8)
+
+
+def unpack_json(data):
+    '''
+        Decodes a data frame created by pack_json(), e.g. the result of unpack_data().
+    '''
+    return json.loads(np.asarray(data).tobytes().decode('utf-8'))
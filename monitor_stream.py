@@ -0,0 +1,81 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import time
+import numpy as np
+
+from histogram import IncrementalHistogram
+
+MONITOR_MODES = ('histogram', 'waveforms')
+
+
+class MonitorStream(object):
+    '''
+        Decimates the event stream for the Online Monitor.
+        The amplitudes (maximum sample) of all events are histogrammed on the acquisition side and the latest n_waveforms events are kept.
+        Both are sent at most rate times per second instead of every event block. The histogram is cumulative, so lost messages only delay the update.
+    '''
+
+    def __init__(self, n_bins=None, n_waveforms=4, rate=10., adc_bits=14):
+        '''
+            Parameters
+            ----------
+            n_bins : int
+                [Optional] Number of histogram bins over the ADC range. Must be a power of 2. Defaults to the full ADC resolution
+                (2**adc_bits), so the Online Monitor can rebin to every number of bins it displays.
+            n_waveforms : int
+                Number of sample waveforms per update
+            rate : float
+                Maximum number of updates per second
+            adc_bits : int
+                Resolution of the ADC
+        '''
+        if n_bins is None:
+            n_bins = 2**adc_bits
+        self.histogram = IncrementalHistogram(n_bins, adc_bits)
+        self.n_bins = n_bins
+        self.n_waveforms = n_waveforms
+        self.rate = rate
+        self.reset()
+
+    def reset(self):
+        self.histogram.reset()
+        self.waveforms = None
+        self.n_events = 0
+        self._last_update = 0.
+
+    def add(self, events_data):
+        '''
+            Histograms the amplitudes of events_data and keeps a copy of the last waveforms.
+        '''
+        if events_data.shape[0] == 0:
+            return
+        self.histogram.fill(np.amax(events_data, axis=1))
+        self.waveforms = np.array(events_data[-self.n_waveforms:])
+        self.n_events += events_data.shape[0]
+
+    def due(self, now=None):
+        '''
+            Returns:
+                due : bool
+                    True if there is new data and the last update is older than 1 / rate
+        '''
+        if now is None:
+            now = time.time()
+        return self.waveforms is not None and now - self._last_update >= 1. / self.rate
+
+    def take(self, now=None):
+        '''
+            Returns:
+                histogram : np.ndarray
+                    Copy of the cumulative histogram (n_bins, )
+                waveforms : np.ndarray
+                    The latest sample waveforms (<= n_waveforms, sample_count)
+        '''
+        self._last_update = time.time() if now is None else now
+        waveforms, self.waveforms = self.waveforms, None
+        return self.histogram.counts.copy(), waveforms
@@ -7,6 +7,8 @@
 
 
 import sys
+import time
+import logging
 import zmq
 import numpy as np
 from PyQt4 import Qt
@@ -19,21 +21,40 @@ from threading import Event
 
 import psutil
 
+from monitor_protocol import unpack_header, unpack_data, unpack_json, MSG_HISTOGRAM, MSG_WAVEFORMS, MSG_METRICS
+from histogram import IncrementalHistogram
+from metrics import format_metrics
+
+CHANNEL_COLORS = [(0, 0, 255), (255, 0, 0), (0, 160, 0), (255, 140, 0)]
+
+
+def get_color(board, channel):
+    if board == 0:
+        return CHANNEL_COLORS[channel % len(CHANNEL_COLORS)]
+    return pg.intColor(4 * board + channel, hues=16).getRgb()[:3]           # Further boards of the Coordinator
+
 
 class DataWorker(QtCore.QObject):
     run_start = QtCore.pyqtSignal()
     config_data = QtCore.pyqtSignal(dict)
     interpreted_data = QtCore.pyqtSignal(dict)
     meta_data = QtCore.pyqtSignal(dict)
+    metrics_data = QtCore.pyqtSignal(dict)
+    invalid_data = QtCore.pyqtSignal(int)
     finished = QtCore.pyqtSignal()
 
     def __init__(self):
         QtCore.QObject.__init__(self)
         self.integrate_readouts = 1
         self._stop_readout = Event()
-        self.n_bins = 512
-        self.hist_range = (0, 2**14)
-        self.histogram = np.zeros(self.n_bins)
+        self.n_bins = 512                                                       # Displayed bins
+        self.histograms = {}                                                    # Histogram of every (board, channel) at full ADC resolution, rebinned for display
+        self.waveforms = {}
+        self.run_histograms = {}                                                # Last cumulative histogram of every (board, channel) received in histogram mode
+        self.last_sequences = {}                                                # By board
+        self.missed_blocks = 0
+        self.invalid_messages = 0                                               # Messages with an incompatible header, e.g. of another protocol version
+        self._last_invalid_update = 0.
         
     def connect(self, socket_addr):
         self.socket_addr = socket_addr
@@ -48,37 +69,81 @@ class DataWorker(QtCore.QObject):
     def on_set_integrate_readouts(self, value):
         self.integrate_readouts = value
         
+    def on_set_n_bins(self, value):
+        self.n_bins = value
+        
     def reset_hist(self):
-        hist, _ = np.histogram(np.zeros(200), bins=self.n_bins, range=self.hist_range)
-        self.histogram = hist
+        for histogram in self.histograms.values():
+            histogram.reset()
         
    # @profile
     def process_data(self):  # infinite loop via QObject.moveToThread(), does not block event loop
         while(not self._stop_readout.wait(0.001)):  # use wait(), do not block here
             try:
-                meta_data = self.socket_pull.recv_json(flags=zmq.NOBLOCK)
-                data = self.socket_pull.recv()
+                header = self.socket_pull.recv(flags=zmq.NOBLOCK)
+                frame = self.socket_pull.recv(copy=False)
+                
+                # reconstruct numpy array without copy
+                meta_data = unpack_header(header)
+                data_array = unpack_data(meta_data, frame)
+                threshold = meta_data['threshold']
+                channel = (meta_data['board'], meta_data['channel'])
+                if meta_data['msg_type'] == MSG_WAVEFORMS:
+                    self.waveforms[channel] = data_array[-1]                    # Shown with the next histogram
+                    continue
+                if meta_data['msg_type'] == MSG_METRICS:
+                    self.metrics_data.emit(unpack_json(data_array))             # Acquisition metrics of the board
+                    continue
                 
-                # reconstruct numpy array
-                buf = buffer(data)
-                dtype = meta_data.pop('dtype')
-                shape = meta_data.pop('shape')
-                threshold = meta_data.pop('thr')
-                data_array = np.frombuffer(buf, dtype=dtype).reshape(shape)
+                # Gaps in the sequence numbers of a board are blocks dropped by the sender or the network
+                sequence = meta_data['sequence']
+                last_sequence = self.last_sequences.get(meta_data['board'])
+                if last_sequence is not None and sequence > last_sequence:
+                    self.missed_blocks += sequence - last_sequence - 1
+                self.last_sequences[meta_data['board']] = sequence              # A smaller sequence number means qmca was restarted
                 
-                hist, bin_edges = np.histogram(np.amax(data_array, axis=1), bins=self.n_bins, range=self.hist_range)
+                if meta_data['msg_type'] == MSG_HISTOGRAM:
+                    # Cumulative histogram of the run, binned by qmca. Only the increase is added.
+                    run_histogram = data_array[:, 0]
+                    if channel not in self.histograms or self.histograms[channel].n_bins != run_histogram.shape[0]:
+                        self.histograms[channel] = IncrementalHistogram(n_bins=run_histogram.shape[0])
+                        self.run_histograms.pop(channel, None)
+                    last_histogram = self.run_histograms.get(channel)
+                    if last_histogram is None or run_histogram.sum() < last_histogram.sum():   # New run
+                        last_histogram = np.zeros_like(run_histogram)
+                    self.histograms[channel].add(run_histogram - last_histogram)
+                    n_actual_events = run_histogram.sum() - last_histogram.sum()
+                    self.run_histograms[channel] = run_histogram.copy()
+                    waveform = self.waveforms.get(channel, np.zeros(200))
+                else:
+                    if channel not in self.histograms or self.histograms[channel].n_bins != 2**14:
+                        self.histograms[channel] = IncrementalHistogram(n_bins=2**14)
+                    self.histograms[channel].fill(np.amax(data_array, axis=1))
+                    waveform = data_array[0]
+                    n_actual_events = data_array.shape[0]
+                histogram = self.histograms[channel]
                 
-                self.histogram += hist
                 #for event_data in data_array:
                 self.interpreted_data.emit({
-                                            "waveform": data_array[0],
-                                            "bin_edges": bin_edges,
-                                            "histogram": self.histogram,
+                                            "channel": channel,
+                                            "waveform": waveform,
+                                            "bin_edges": histogram.bin_edges(self.n_bins),
+                                            "histogram": histogram.rebin(self.n_bins),
                                             "threshold": threshold,
-                                            "n_actual_events": data_array.shape[0]
+                                            "n_actual_events": n_actual_events,
+                                            "missed_blocks": self.missed_blocks,
+                                            "invalid_messages": self.invalid_messages
                                             })
             except zmq.Again:
                 pass
+            except ValueError as e:                                             # Incompatible header
+                self.invalid_messages += 1
+                if self.invalid_messages == 1:                                  # Only the first one, a mismatched sender would log at the full message rate
+                    logging.error('Invalid message: %s. Further invalid messages are only counted.', e)
+                now = time.time()
+                if now - self._last_invalid_update >= 1.:                       # Update the count in the status dock at most once per second
+                    self._last_invalid_update = now
+                    self.invalid_data.emit(self.invalid_messages)
 
         self.finished.emit()
 
@@ -95,8 +160,10 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.fps = 0
         self.eps = 0  # events per second
         self.total_events = 0
-        self.total_readouts = 0
+        self.total_readouts = {}                                                # By channel
         self.last_total_events = 0
+        self.missed_blocks = 0
+        self.invalid_messages = 0
         self.updateTime = ptime.time()
         self.setup_data_worker_and_start(socket_addr)
         self.cpu_load = max(psutil.cpu_percent(percpu=True))
@@ -113,7 +180,10 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.worker.interpreted_data.connect(self.on_interpreted_data)
         self.worker.run_start.connect(self.on_run_start)
         self.worker.config_data.connect(self.on_config_data)
+        self.worker.metrics_data.connect(self.on_metrics_data)
+        self.worker.invalid_data.connect(self.on_invalid_data)
         self.spin_box.valueChanged.connect(self.worker.on_set_integrate_readouts)
+        self.bins_box.currentIndexChanged.connect(lambda index: self.worker.on_set_n_bins(int(self.bins_box.itemText(index))))
         self.worker.moveToThread(self.thread)
         self.worker.connect(socket_addr)
         self.thread.started.connect(self.worker.process_data)
@@ -145,30 +215,57 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         cw.setLayout(layout)
         self.event_rate_label = QtGui.QLabel("Event Rate\n0 Hz")
         self.total_events_label = QtGui.QLabel("Total Events\n0")
+        self.missed_blocks_label = QtGui.QLabel("Missed Blocks\n0")
+        self.invalid_messages_label = QtGui.QLabel("Invalid Messages\n0")
+        self.metrics_label = QtGui.QLabel("Acquisition Metrics\n-")             # Latest metrics of every board sent by qmca
+        self.metrics_label.setWordWrap(True)
+        self.metrics = {}
         self.spin_box = Qt.QSpinBox(value=20, maximum=1000)
         self.reset_button = Qt.QPushButton('Reset', self)
         self.reset_button.clicked.connect(self.reset_plots)
+        self.bins_box = Qt.QComboBox()
+        self.bins_box.addItems([str(2**i) for i in range(6, 15)])
+        self.bins_box.setCurrentIndex(3)                                        # 512 bins
         layout.addWidget(self.event_rate_label, 0, 1, 1, 1)
         layout.addWidget(self.total_events_label, 1, 1, 1, 1)
+        layout.addWidget(self.missed_blocks_label, 0, 2, 1, 1)
+        layout.addWidget(self.invalid_messages_label, 1, 2, 1, 1)
         layout.addWidget(self.spin_box, 0, 3, 1, 1)
-        layout.addWidget(self.reset_button, 1, 3, 1, 1)
+        layout.addWidget(self.bins_box, 1, 3, 1, 1)
+        layout.addWidget(self.reset_button, 0, 4, 1, 1)
+        layout.addWidget(self.metrics_label, 0, 5, 2, 1)
         
         dock_status.addWidget(cw)
 
-        # Different plot docks
-        waveform_widget = pg.PlotWidget(background="w")
-        self.waveform_plot = waveform_widget.plot(range(0, 200), np.zeros(shape=(200)))
-        self.thr_line = pg.InfiniteLine(pos=1000, angle=0, pen={'color':0.0, 'style':QtCore.Qt.DashLine})
-        waveform_widget.addItem(self.thr_line)
-        dock_waveform.addWidget(waveform_widget)
-
-        histogram_widget = pg.PlotWidget(background="w")
-        self.histogram_plot = histogram_widget.plot(range(0, 2**14 + 1), np.zeros(shape=(2**14)), stepMode=True)
-        histogram_widget.showGrid(y=True)
-        self.thr_line_hist = pg.InfiniteLine(pos=1000, angle=90, pen={'color':0.0, 'style':QtCore.Qt.DashLine})
-        histogram_widget.addItem(self.thr_line_hist)
-        dock_histogram.addWidget(histogram_widget)
+        # Different plot docks. The plots of a channel are added when its first data arrives.
+        self.waveform_widget = pg.PlotWidget(background="w")
+        self.waveform_widget.addLegend()
+        dock_waveform.addWidget(self.waveform_widget)
+
+        self.histogram_widget = pg.PlotWidget(background="w")
+        self.histogram_widget.showGrid(y=True)
+        dock_histogram.addWidget(self.histogram_widget)
+        
+        self.waveform_plots = {}
+        self.histogram_plots = {}
+        self.thr_lines = {}
+        self.thr_lines_hist = {}
  
+    def add_channel_plots(self, channel):
+        '''
+            Adds waveform, histogram and threshold lines of channel = (board, channel number)
+        '''
+        color = get_color(*channel)
+        name = 'Channel %d' % channel[1] if channel[0] == 0 else 'Board %d channel %d' % channel
+        self.waveform_plots[channel] = self.waveform_widget.plot(range(0, 200), np.zeros(shape=(200)), pen=color, name=name)
+        self.thr_lines[channel] = pg.InfiniteLine(pos=1000, angle=0, pen={'color':color, 'style':QtCore.Qt.DashLine})
+        self.waveform_widget.addItem(self.thr_lines[channel])
+        
+        self.histogram_plots[channel] = self.histogram_widget.plot(range(0, 2**14 + 1), np.zeros(shape=(2**14)), stepMode=True, pen=color)
+        self.thr_lines_hist[channel] = pg.InfiniteLine(pos=1000, angle=90, pen={'color':color, 'style':QtCore.Qt.DashLine})
+        self.histogram_widget.addItem(self.thr_lines_hist[channel])
+        self.total_readouts[channel] = 0
+
 
     @pyqtSlot()
     def on_run_start(self):
@@ -181,20 +278,36 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
     def setup_config_text(self, conf):
         pass
 
+    @pyqtSlot(dict)
+    def on_metrics_data(self, metrics):
+        self.metrics[metrics['board']] = metrics
+        self.metrics_label.setText("Acquisition Metrics\n" + "\n".join(
+            ('Board %d: ' % board if len(self.metrics) > 1 else '') + format_metrics(self.metrics[board]) for board in sorted(self.metrics)))
+
+    @pyqtSlot(int)
+    def on_invalid_data(self, invalid_messages):
+        self.invalid_messages = invalid_messages
+        self.invalid_messages_label.setText("Invalid Messages\n%d" % self.invalid_messages)
+
     @pyqtSlot(dict)
     def on_interpreted_data(self, interpreted_data):
         self.update_plots(**interpreted_data)
 
-    def update_plots(self, waveform, bin_edges, histogram, threshold, n_actual_events):
+    def update_plots(self, channel, waveform, bin_edges, histogram, threshold, n_actual_events, missed_blocks, invalid_messages):
+        if channel not in self.waveform_plots:
+            self.add_channel_plots(channel)
         self.total_events += n_actual_events
-        self.total_readouts += 1
+        self.missed_blocks = missed_blocks
+        self.invalid_messages = invalid_messages
+        self.total_readouts[channel] += 1
         actual_cpu_load = max(psutil.cpu_percent(percpu=True))
         self.cpu_load = 0.95 * self.cpu_load + 0.05 * actual_cpu_load
-        if self.cpu_load < 55 and self.spin_box.value() > 0 and self.total_readouts % self.spin_box.value() == 0:  # only refresh plot every spin_box.value() readout 
-            self.waveform_plot.setData(waveform, fillLevel=0, brush=(0, 0, 255, 150))
-            self.histogram_plot.setData(x=bin_edges, y=histogram, fillLevel=0, brush=(0, 0, 255, 150))
-            self.thr_line.setValue(threshold)
-            self.thr_line_hist.setValue(threshold)
+        if self.cpu_load < 55 and self.spin_box.value() > 0 and self.total_readouts[channel] % self.spin_box.value() == 0:  # only refresh plot every spin_box.value() readout of the channel
+            brush = get_color(*channel) + (150 if len(self.waveform_plots) == 1 else 50,)
+            self.waveform_plots[channel].setData(waveform, fillLevel=0, brush=brush)
+            self.histogram_plots[channel].setData(x=bin_edges, y=histogram, fillLevel=0, brush=brush)
+            self.thr_lines[channel].setValue(threshold)
+            self.thr_lines_hist[channel].setValue(threshold)
             self.update_monitor()
 
     def update_monitor(self):
@@ -209,22 +322,25 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
             self.event_rate_label.setText("Event Rate\n%d Hz" % int(self.eps))
             
         self.total_events_label.setText("Total Events\n%d" % int(self.total_events))
+        self.missed_blocks_label.setText("Missed Blocks\n%d" % self.missed_blocks)
+        self.invalid_messages_label.setText("Invalid Messages\n%d" % self.invalid_messages)
             
             
     def reset_plots(self):
         self.worker.reset_hist()
         
         self.total_events  = 0
-        self.total_readouts = 0
+        self.total_readouts = dict.fromkeys(self.total_readouts, 0)
         self.last_total_events = 0
         self.updateTime = ptime.time()
         self.fps = 0
         self.eps = 0  # events per second
         
-        self.waveform_plot.setData(x=range(0, 200), y=np.zeros(200), fillLevel=0, brush=(0, 0, 255, 150))
-        self.histogram_plot.setData(x=range(0, 2**14+1), y=np.zeros(2**14), fillLevel=0, brush=(0, 0, 255, 150))
-        self.thr_line.setValue(1000)
-        self.thr_line_hist.setValue(1000)
+        for channel in self.waveform_plots:
+            self.waveform_plots[channel].setData(x=range(0, 200), y=np.zeros(200))
+            self.histogram_plots[channel].setData(x=range(0, 2**14+1), y=np.zeros(2**14))
+            self.thr_lines[channel].setValue(1000)
+            self.thr_lines_hist[channel].setValue(1000)
         self.update_monitor()
 
 
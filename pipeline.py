@@ -0,0 +1,147 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import threading
+import logging
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DROP_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+
+class Stage(object):
+    '''
+        Pipeline stage that processes the items of a bounded queue in its own thread.
+        What happens to new items when the queue is full is defined by the drop policy:
+            'block'       -  The producer waits until there is space (backpressure).
+            'drop_newest' -  The new item is dropped.
+            'drop_oldest' -  The oldest item in the queue is dropped.
+    '''
+
+    _stop_item = object()
+
+    def __init__(self, name, target, maxsize=100, drop_policy='block', on_drop=None):
+        '''
+            Parameters
+            ----------
+            name : string
+                Name of the stage and its thread
+            target : callable
+                Function that is called with every item
+            maxsize : int
+                Maximum number of queued items
+            drop_policy : string
+                One of 'block', 'drop_newest' and 'drop_oldest'
+            on_drop : callable
+                [Optional] Function that is called with every dropped item
+        '''
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('Unknown drop policy %s' % drop_policy)
+        self.name = name
+        self.target = target
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.on_drop = on_drop
+        self.thread = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.blocked_puts = 0
+        self.blocked_time = 0.
+        self.busy_time = 0.
+        self.max_depth = 0
+        self._start_time = time.time()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''
+            Processes all queued items and stops the thread.
+        '''
+        if self.thread is None:
+            return
+        self._queue.put(self._stop_item)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, item):
+        '''
+            Queues item according to the drop policy.
+            ----------
+            Returns:
+                queued : bool
+                    False if the item was dropped
+        '''
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.drop_policy == 'drop_newest':
+                self._drop(item)
+                return False
+            elif self.drop_policy == 'drop_oldest':
+                try:
+                    self._drop(self._queue.get_nowait())
+                except queue.Empty:
+                    pass
+                return self.put(item)
+            start = time.time()
+            self._queue.put(item)
+            with self._lock:
+                self.blocked_puts += 1
+                self.blocked_time += time.time() - start
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def _drop(self, item):
+        with self._lock:
+            self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._stop_item:
+                break
+            start = time.time()
+            try:
+                self.target(item)
+            except Exception as e:
+                self.errors += 1
+                logging.error('Pipeline stage %s experienced an error: %s', self.name, e)
+            self.busy_time += time.time() - start
+            self.processed += 1
+
+    def get_statistics(self):
+        '''
+            Returns:
+                statistics : dict
+                    Current and maximum queue depth, processed, dropped and failed items, number of puts and time the producer was blocked by this stage and the fraction of time the stage was busy
+        '''
+        elapsed = time.time() - self._start_time
+        return dict(
+            depth=self._queue.qsize(),
+            max_depth=self.max_depth,
+            maxsize=self.maxsize,
+            processed=self.processed,
+            dropped=self.dropped,
+            errors=self.errors,
+            blocked_puts=self.blocked_puts,
+            blocked_time=self.blocked_time,
+            load=self.busy_time / elapsed if elapsed > 0 else 0.
+        )
@@ -2,15 +2,18 @@ import matplotlib.pyplot as plt
 import tables as tb
 import numpy as np
 
+from event_run import EventRun
+
 class qmca_plotter():
     def __init__(self):
         pass
     
     def plot_data_file(self, infile='event_data.h5', title=''):
         outfile = infile.split('.')[0] + '.pdf'
-        with tb.openFile(infile, 'r') as infile_h5:
-            data = infile_h5.root.event_data[:]
-            hist, edges = np.histogram(np.amax(data, axis=1), bins=1024, range=(0, 2**14-10))
+        with EventRun(infile) as run:
+            hist, edges = np.histogram(np.empty(0), bins=1024, range=(0, 2**14-10))
+            for _, data in run.iter_chunks():   # Streams the run chunk by chunk, the histograms of the blocks add up
+                hist += np.histogram(np.amax(data, axis=1), bins=1024, range=(0, 2**14-10))[0]
             x, y = edges[:-1], hist
             
             fig = plt.figure()
@@ -23,7 +26,7 @@ class qmca_plotter():
             ax.set_xlim(0, 2**14)
             
             ax.plot(x, y, label='Data')
-            ax.legend(title=('nHits = %i' % len(data)), loc='best')
+            ax.legend(title=('nHits = %i' % run.n_events), loc='best')
     
             fig.savefig(outfile)
             
@@ -5,44 +5,111 @@
 # ------------------------------------------------------------
 #
 
+import os
 import threading
-from basil.dut import Dut
+import time
+try:
+    from basil.dut import Dut
+except ImportError:                                                             # Only a replay of recorded data (see replay.py) works without basil
+    Dut = None
 import numpy as np
 import zmq
-import tables as tb
 import logging
+from collections import deque
+
+from event_builder import EventBuilder, split_channels, N_CHANNELS
+from readout_scheduler import ReadoutScheduler
+from pipeline import Stage
+from event_writer import EventWriter
+from features import extract_features
+from monitor_protocol import pack_header, pack_json, MSG_EVENTS, MSG_HISTOGRAM, MSG_WAVEFORMS, MSG_METRICS
+from monitor_stream import MonitorStream, MONITOR_MODES
+from metrics import Metrics, write_metrics, format_metrics
 
 np.set_printoptions(formatter={'int':hex})
 
 class qmca(object):    
     '''Sets up qMCA setup. Reads data via USB from qMCA setup and sends it via ZeroMQ to Online Monitor.
-    8000 Hz of waveforms with 200 samples can be read out'''    
+    8000 Hz of waveforms with 200 samples can be read out. Up to four channels can be acquired simultaneously.'''    
     
-    def __init__(self, config='qmca.yaml', sample_count=200, sample_delay=50, threshold=2000, channel=0, adc_differential_voltage=1.9, socket_addr='tcp://127.0.0.1:5678', write_after_n_events = 100000):
+    def __init__(self, config='qmca.yaml', sample_count=200, sample_delay=50, threshold=2000, channel=0, adc_differential_voltage=1.9, socket_addr='tcp://127.0.0.1:5678', write_after_n_events = 100000, writer_settings=None, extract_features=False, monitor_mode='histogram', monitor_rate=10., board_id=0, metrics_file=None, metrics_interval=1.):
         '''
         Parameters
         ----------
+        config : string, dict or ReplayDut
+            basil configuration of the qMCA setup, or an already created Dut such as the hardware-free ReplayDut
         sample_count : int
             Length of event in ADC samples
         sample_delay : int
             Number of ADC samples to add to event before detected peak
-        threshold : int [0:2**14]
-            ADC threshold
-        channel : int [0:3]
-            qMCA channel number
+        threshold : int [0:2**14] or list
+            ADC threshold, or one threshold per channel
+        channel : int [0:3] or list
+            qMCA channel number, or list of channel numbers that are acquired simultaneously
         outfile_name : string
             Filename of the raw data output file
         socket_addr : string
             Socket address of Online Monitor
+        write_after_n_events : int
+            Maximum number of events between two writes to disk
+        writer_settings : dict
+            [Optional] Chunk shape, compression and flush policy of the output file, see EventWriter
+        extract_features : boolean
+            [Optional] Compute baseline, amplitude, rise time, ... of every event and store them in the 'feature_data' table.
+            Together with writer_settings['waveform_prescale'] only a fraction of the waveforms is stored (features-only mode).
+        monitor_mode : string
+            [Optional] 'histogram' sends the amplitude histogram and a few waveforms to the Online Monitor at monitor_rate, 'waveforms' sends all events
+        monitor_rate : float
+            [Optional] Maximum number of updates per second in 'histogram' mode
+        board_id : int
+            [Optional] ID of the qMCA setup in the Online Monitor messages, see Coordinator
+        metrics_file : string
+            [Optional] JSON file that is replaced with a snapshot of the acquisition metrics every metrics_interval seconds, e.g. for a dashboard
+        metrics_interval : float
+            [Optional] Time between two metrics snapshots in seconds. The snapshots are also sent to the Online Monitor.
         '''
         
         self.event_count = 0
         self.count_lost = 0
+        self.channel_count_lost = {}                                            # FIFO overflows of the last read by channel
         self.main_thread = None
         self.exit = threading.Event()
         self.write_after_n_events = write_after_n_events
+        self.writer_settings = dict(writer_settings) if writer_settings else {}
+        self.extract_features = extract_features
+        self.baseline_samples = 40                                              # Samples at the beginning of every event used as baseline by the feature extraction
         self.sample_count = sample_count
         self.sample_delay = sample_delay
+        self.event_dtype = np.uint16                                            # 14 bit ADC samples
+        self.ring_buffer_capacity = 2**23                                      # 32 MB of raw data and 16 MB of events that can be in flight in the pipeline, shared by the channels, plus 1 MB of scratch per channel for the largest read
+        self.channels = []
+        self.thresholds = {}
+        self.event_builders = {}                                                # Event builder, output file and monitor stream of every selected channel
+        self.event_writers = {}
+        self.monitor_streams = {}
+        self.readout_scheduler = ReadoutScheduler()
+        
+        # Setup acquisition pipeline. The main thread only reads the SRAM, decoding, writing and publishing run in separate stages.
+        self.decode_stage = Stage('decode', self._decode_data, maxsize=64, drop_policy='block')
+        self.feature_stage = Stage('features', self._extract_features, maxsize=64, drop_policy='block')
+        self.write_stage = Stage('write', self._write_data, maxsize=256, drop_policy='block')
+        self.publish_stage = Stage('publish', self._publish_data, maxsize=10, drop_policy='drop_oldest', on_drop=self._drop_published)
+        self.stages = [self.decode_stage, self.feature_stage, self.write_stage, self.publish_stage]
+        
+        if monitor_mode not in MONITOR_MODES:
+            raise ValueError('Unknown monitor mode %s' % monitor_mode)
+        self.monitor_mode = monitor_mode
+        self.monitor_rate = monitor_rate
+        self.board_id = board_id
+        self.send_drops = 0                                                     # Messages dropped because the ZeroMQ send queue was full
+        self._sequence = 0
+        self._stream_sequence = 0
+        self._pending_sends = deque()                                           # (tracker, events) of messages that are sent without copy
+        self.metrics = Metrics()                                                # Timing histograms and counters of the hot path
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self._metrics_sequence = 0
+        self._last_metrics = 0.
         
         # Setup ZeroMQ socket    
         self.socket = zmq.Context().socket(zmq.PUSH)
@@ -51,7 +118,7 @@ class qmca(object):
         self.socket.bind(socket_addr)
         
         # Setup Dut
-        self.dut = Dut(config)
+        self.dut = config if hasattr(config, 'init') else Dut(config)
         self.dut.init()
         
         self.dut['PWR0'].set_current_limit(100, unit='mA')
@@ -71,18 +138,25 @@ class qmca(object):
         self.dut['PWR3'].set_enable(True)
         
         # Reset ADC and SRAM
-        self.dut['fadc0_rx'].reset()
+        for channel_number in range(N_CHANNELS):
+            self.dut['fadc%d_rx' % channel_number].reset()
         self.dut['DATA_FIFO'].reset()
         
         self.adc_differential_voltage = adc_differential_voltage
         self.set_adc_differential_voltage(adc_differential_voltage)
         self.set_adc_eventsize(self.sample_count, self.sample_delay)
-        self.set_threshold(threshold)
         self.select_channel(channel)
+        self.set_threshold(threshold)
 
     
     def start(self, out_filename='event_data'):
         self.out_filename = out_filename + '.h5'
+        self.readout_scheduler.reset()
+        for monitor_stream in self.monitor_streams.values():
+            monitor_stream.reset()
+        self.send_drops = 0
+        self.metrics.reset()
+        self.exit.clear()
         
         logging.info('Starting main loop in new thread.')
         self.main_thread = threading.Thread(target=self._main_loop)
@@ -91,115 +165,369 @@ class qmca(object):
     def stop(self):
         self.exit.set()
         if self.main_thread:
-            self.main_thread.join(timeout=1)
+            self.main_thread.join()                                             # Waits until all queued data is written
             self.main_thread = None
             logging.info('Measurement stopped. Recorded %i events.' % self.event_count)
+            for channel in self.channels:
+                builder, writer = self.event_builders[channel], self.event_writers[channel]
+                logging.info('Channel %i: %i events, recovered %i events across FIFO reads, discarded %i chopped events.' % (channel, writer.events_processed, builder.recovered_events, builder.discarded_events))
+                logging.info('Channel %i output file: %i flushes, %.1f MB/s uncompressed write speed.' % ((channel,) + tuple(writer.get_statistics()[k] for k in ('flushes', 'write_speed'))))
+            logging.info('Readout statistics: %(poll_rate).1f polls/s, %(words_per_read).0f words per read, %(near_overflow_events)i near-overflow events.' % self.readout_scheduler.get_statistics())
+            for stage in self.stages:
+                logging.info('Stage %s: %i items processed, %i dropped, maximum queue depth %i of %i, producer blocked for %.2f s.' % ((stage.name,) + tuple(stage.get_statistics()[k] for k in ('processed', 'dropped', 'max_depth', 'maxsize', 'blocked_time'))))
+            logging.info('Online Monitor: %i blocks dropped by the publish stage, %i by the ZeroMQ send queue.' % (self.publish_stage.dropped, self.send_drops))
+            logging.info('Metrics: %s' % format_metrics(self.get_metrics()))
         else:
             logging.info('No measurement was running.')
 
+    def close(self):
+        if self.main_thread:
+            self.stop()
+        self.socket.close()
+        self.dut.close()
+
+    def get_run_files(self):
+        '''
+            Returns:
+                files : dict
+                    Run index (see EventWriter) of the output of every channel of the last run
+        '''
+        return dict((channel, writer.index_filename) for channel, writer in self.event_writers.items())
+
     def reset_dut(self):
-        self.dut['fadc0_rx'].reset()
+        for channel in range(N_CHANNELS):
+            self.dut['fadc%d_rx' % channel].reset()
         self.dut['DATA_FIFO'].reset()
         
         self.set_adc_differential_voltage(self.adc_differential_voltage)
         self.set_adc_eventsize(self.sample_count, self.sample_delay)
+        self.select_channel(self.channels)                                     # New event builders
         
         self.event_count = 0
         self.count_lost = 0
         self.main_thread = None
 
-    def set_threshold(self, threshold):
-        self.dut['TH']['TH'] = int(threshold)
+    def set_threshold(self, threshold, channel=None):
+        '''
+            Sets the ADC threshold of channel or of all selected channels. threshold can also be a list with one threshold per selected channel.
+        '''
+        channels = self.channels if channel is None else [channel]
+        thresholds = [threshold] * len(channels) if np.ndim(threshold) == 0 else list(threshold)
+        if len(thresholds) != len(channels):
+            raise ValueError('Expected %d thresholds, got %d' % (len(channels), len(thresholds)))
+        for channel, threshold in zip(channels, thresholds):
+            self.dut['TH']['TH%d' % channel] = int(threshold)
+            self.thresholds[channel] = int(threshold)
         self.dut['TH'].write()
-        self.threshold = threshold
     
     def select_channel(self, channel):
-        self.dut['TH']['SEL_ADC_CH'] = channel
+        '''
+            Enables the trigger of one channel or of a list of channels. Every selected channel is read by its own fadc_rx and gets its own event builder, output file and monitor histogram.
+        '''
+        channels = sorted(set(np.atleast_1d(channel).tolist()))
+        if not channels or channels[0] < 0 or channels[-1] >= N_CHANNELS:
+            raise ValueError('Invalid channel %s' % (channel,))
+        self.dut['TH']['EN_CH'] = sum(1 << channel for channel in channels)
         self.dut['TH'].write()
-        self.channel = channel
+        self.channels = channels
+        capacity = self.ring_buffer_capacity // len(channels)
+        self.event_builders = dict((channel, EventBuilder(self.sample_count, capacity=capacity, dtype=self.event_dtype, max_read_words=self.readout_scheduler.max_read_words)) for channel in channels)
+        self.monitor_streams = dict((channel, MonitorStream(rate=self.monitor_rate)) for channel in channels)
         
     def set_adc_differential_voltage(self, value):
         self.adc_differential_voltage = value
         self.dut['VSRC3'].set_voltage(value, unit='V')
         
     def set_adc_eventsize(self, sample_count, sample_delay):
-        self.dut['fadc0_rx'].set_delay(sample_delay)
-        self.dut['fadc0_rx'].set_data_count(sample_count)
-        self.dut['fadc0_rx'].set_single_data(True)
-        self.dut['fadc0_rx'].set_en_trigger(True)
+        for channel in range(N_CHANNELS):                                       # Channels without trigger (see select_channel) do not record
+            self.dut['fadc%d_rx' % channel].set_delay(sample_delay)
+            self.dut['fadc%d_rx' % channel].set_data_count(sample_count)
+            self.dut['fadc%d_rx' % channel].set_single_data(True)
+            self.dut['fadc%d_rx' % channel].set_en_trigger(True)
         
+        if sample_count != self.sample_count:
+            for event_builder in self.event_builders.values():
+                event_builder.sample_count = sample_count
+                event_builder.reset()
         self.sample_count = sample_count
         self.sample_delay = sample_delay
     
-    def _send_data(self, data, name='qMCA'):
+    def _send_data(self, data, sequence, threshold, channel, timestamp, msg_type=MSG_EVENTS):
+        '''
+            Sends data with a binary header (see monitor_protocol) to the Online Monitor without copying it.
+            ----------
+            Returns:
+                tracker : zmq.MessageTracker
+                    Tracker of the data frame. data must not be modified until it is done. None if the message was dropped.
+        '''
+        start = time.time()
         try:
-            data_meta_data = dict(
-                name=name,
-                dtype=str(data.dtype),
-                shape=data.shape,
-                thr = self.threshold,
-                ch = self.channel
-            )
-            self.socket.send_json(data_meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
-            self.socket.send(data, flags=zmq.NOBLOCK)                           # PyZMQ supports sending numpy arrays without copying any data
+            self.socket.send(pack_header(msg_type, sequence, data, threshold, channel, timestamp, self.board_id), flags=zmq.SNDMORE | zmq.NOBLOCK)
+            tracker = self.socket.send(data, flags=zmq.NOBLOCK, copy=False, track=True)
+            self.metrics.count('messages')
         except zmq.Again:
-            pass
+            self.send_drops += 1
+            self.metrics.count('send_drops')
+            tracker = None
+        self.metrics.record('send', time.time() - start)
+        return tracker
 
-    def _record_data(self):
+    def _read_fifo(self, n_words):
         '''
-            Reads raw event data from SRAM and splits data stream into events
+            Reads n_words 32 bit words from SRAM. Unlike DATA_FIFO.get_data() the size of the USB transfer is bounded.
+        '''
+        if n_words == 0:
+            return np.empty(0, dtype=np.uint32)
+        fifo = self.dut['DATA_FIFO']
+        return np.frombuffer(fifo._intf.read(fifo._conf['base_data_addr'], size=4 * n_words), dtype=np.dtype('<u4'))
+
+    def _read_raw_data(self):
+        '''
+            Checks for FIFO overflows and reads raw data from SRAM. The read size and the next poll interval are chosen by the readout scheduler.
             ----------
             Returns:
-                event_data : np.ndarray
-                    Numpy array of single event numpy arrays 
+                raw_data : np.ndarray
+                    uint32 words of all selected channels read from SRAM. If self.channel_count_lost[channel] > 0, the data of channel is discontinuous to the previous read.
         '''
-        
-        self.count_lost = self.dut['fadc0_rx'].get_count_lost()
+        start = time.time()
+        self.channel_count_lost = dict((channel, self.dut['fadc%d_rx' % channel].get_count_lost()) for channel in self.channels)
+        self.count_lost = sum(self.channel_count_lost.values())
 #         print 'count_lost is %d' % self.count_lost
 #         print 'event_count is %d' % self.event_count
         if self.count_lost > 0:
-            logging.error('SRAM FIFO overflow number %d. Skip data.', self.count_lost)
-            self.dut['fadc0_rx'].reset()
+            self.metrics.count('count_lost', self.count_lost)
+            for channel, count_lost in self.channel_count_lost.items():
+                if count_lost > 0:
+                    logging.error('SRAM FIFO overflow number %d of channel %d. Skip data.', count_lost, channel)
+                    self.dut['fadc%d_rx' % channel].reset()
+                    self.metrics.count('rx_resets')
             self.set_adc_eventsize(self.sample_count, self.sample_delay)
             #return
         
-        single_data = self.dut['DATA_FIFO'].get_data()                          # Read raw data from SRAM
+        fifo_words = int(min(self.dut['DATA_FIFO'].FIFO_INT_SIZE, self.dut['DATA_FIFO'].FIFO_INT_SIZE))   # FIFO fill level in 32 bit words. Read twice like sram_fifo.get_data, the smaller value is safe while the SRAM is written
+        n_words = self.readout_scheduler.schedule(fifo_words)                   # Choose read size and next poll interval
+        raw_data = self._read_fifo(n_words)                                     # Read raw data from SRAM
+        self.metrics.record('fifo_read', time.time() - start)
+        self.metrics.count('reads')
+        self.metrics.count('words', raw_data.shape[0])
+        return raw_data
+
+    def _record_data(self):
+        '''
+            Reads raw event data from SRAM and splits data stream into events of every channel
+            ----------
+            Returns:
+                event_data : dict
+                    (n, sample_count) array of events by channel. The chopped event at the end of the read is completed by the next read.
+        '''
+        raw_data = self._read_raw_data()
+        event_data = {}
+        for channel, channel_data in zip(self.channels, split_channels(raw_data, self.channels)):
+            if self.channel_count_lost[channel] > 0:
+                self.event_builders[channel].reset()                            # Drop the partial event carried over from the last read
+            event_data[channel] = self.event_builders[channel].build_events(channel_data)   # Split data into events and complete the event chopped by the last read
+        return event_data
+
+    def _decode_data(self, item):
+        '''
+            Decode stage: splits a raw SRAM read by channel and into events and passes them to the write and publish stages.
+            The events are views into the ring buffer of the event builder of the channel, which is released by both stages.
+        '''
+        read_number, raw_data, timestamp, count_lost = item
+        if read_number != self._last_read_number + 1:
+            for event_builder in self.event_builders.values():
+                event_builder.reset()                                           # Reads were dropped
+            self.metrics.count('builder_resets', len(self.event_builders))
+        self._last_read_number = read_number
         
-        try:
-            if single_data.shape[0] > 200:
-                selection = np.where(single_data & 0x10000000 == 0x10000000)[0]         # Make mask from new-event-bit
-                event_data = np.bitwise_and(single_data, 0x00003fff).astype(np.uint32)  # Remove new-event-bit from data       
-                event_data = np.split(event_data, selection)                            # Split data into events by means of mask
-                event_data = event_data[1:-1]                                           # Remove first and last event in case of chopping
-                event_data = np.vstack(event_data)                                      # Stack events together
+        start = time.time()
+        channels_data = split_channels(raw_data, self.channels)
+        decode_time = time.time() - start
+        for channel, channel_data in zip(self.channels, channels_data):
+            if count_lost[channel] > 0:
+                self.event_builders[channel].reset()                            # The fadc_rx was reset
+                self.metrics.count('builder_resets')
+            start = time.time()
+            events_data = self.event_builders[channel].build_events(channel_data, references=2)
+            decode_time += time.time() - start                                  # Without the time blocked by the next stages
+            readout = (timestamp, self.thresholds[channel], channel, channel_data.shape[0], count_lost[channel])
+            if self.extract_features:
+                self.feature_stage.put((events_data, readout))
             else:
-                event_data = np.asarray([np.bitwise_and(single_data, 0x00003fff).astype(np.uint32)])
+                self.write_stage.put((events_data, readout, None))              # Every readout block is recorded, also without events
+            if events_data.shape[0] > 0:
+                self._sequence += 1                                             # Counts all blocks, so the Online Monitor sees the blocks dropped by the publish stage
+                self.publish_stage.put((events_data, self._sequence, readout))
+        self.metrics.record('decode', decode_time)
 
-            if event_data.shape[1] == self.sample_count:
-                return event_data
-        except ValueError as e:
-            logging.error('_record_data() experienced a ValueError: ' + str(e))
-            return
+    def _extract_features(self, item):
+        '''
+            Feature stage: computes the pulse features of all events of a readout block at once.
+        '''
+        events_data, readout = item
+        start = time.time()
+        try:
+            features = extract_features(events_data, self.baseline_samples)
+            self.metrics.record('features', time.time() - start)
+        except Exception:
+            self._release_data(events_data, readout[2])
+            raise
+        self.write_stage.put((events_data, readout, features))
 
+    def _write_data(self, item):
+        '''
+            Write stage: appends events, features and readout block metadata to the output file of the channel.
+        '''
+        events_data, readout, features = item
+        writer = self.event_writers[readout[2]]
+        flushes = writer.flushes
+        start = time.time()
+        try:
+            writer.append(events_data, readout, features)
+        finally:
+            self._release_data(events_data, readout[2])
+        append_time = time.time() - start
+        if writer.flushes > flushes:
+            self.metrics.record('flush', writer.last_flush_time)
+            append_time -= writer.last_flush_time
+        self.metrics.record('append', append_time)
+        self.metrics.count('events', events_data.shape[0])
+        self.event_count += events_data.shape[0]
+
+    def _publish_data(self, item):
+        '''
+            Publish stage: sends events to the Online Monitor. The events are released when ZeroMQ has sent them.
+            In 'histogram' mode the events are only histogrammed and the histogram and the latest waveforms are sent at the rate of the monitor stream.
+        '''
+        events_data, sequence, readout = item
+        channel = readout[2]
+        if self.monitor_mode == 'histogram':
+            try:
+                self.monitor_streams[channel].add(events_data)
+            finally:
+                self._release_data(events_data, channel)
+            if self.monitor_streams[channel].due():
+                self._send_monitor_update(channel, readout[0])
+        else:
+            tracker = None
+            try:
+                tracker = self._send_data(events_data, sequence, readout[1], channel, readout[0])
+            finally:
+                if tracker is None:
+                    self._release_data(events_data, channel)
+                else:
+                    self._pending_sends.append((tracker, events_data, channel))
+            self._release_sent()
+        if time.time() - self._last_metrics >= self.metrics_interval:
+            self._report_metrics()
+
+    def _send_monitor_update(self, channel, timestamp):
+        '''
+            Sends the sample waveforms and the histogram of the monitor stream of channel. The arrays are copies, so they are not tracked.
+        '''
+        histogram, waveforms = self.monitor_streams[channel].take()
+        self._stream_sequence += 1                                              # Counts updates instead of blocks
+        self._send_data(waveforms, self._stream_sequence, self.thresholds[channel], channel, timestamp, msg_type=MSG_WAVEFORMS)
+        self._send_data(histogram, self._stream_sequence, self.thresholds[channel], channel, timestamp, msg_type=MSG_HISTOGRAM)
+
+    def _release_sent(self, timeout=None):
+        '''
+            Releases the events of sent messages. With a timeout, waits for all pending messages and releases them in any case.
+        '''
+        while self._pending_sends:
+            tracker, events_data, channel = self._pending_sends[0]
+            if timeout is not None:
+                try:
+                    tracker.wait(timeout)
+                except zmq.NotDone:
+                    pass
+            elif not tracker.done:
+                break
+            self._pending_sends.popleft()
+            self._release_data(events_data, channel)
+
+    def _report_metrics(self):
+        '''
+            Sends a snapshot of the metrics to the Online Monitor and writes it to metrics_file.
+        '''
+        self._last_metrics = time.time()
+        snapshot = self.get_metrics()
+        self._metrics_sequence += 1
+        self._send_data(pack_json(snapshot), self._metrics_sequence, 0, 0, snapshot['time'], msg_type=MSG_METRICS)
+        if self.metrics_file is not None:
+            try:
+                write_metrics(self.metrics_file, snapshot)
+            except (IOError, OSError) as e:
+                logging.error('Cannot write metrics file %s: %s', self.metrics_file, e)
+
+    def get_metrics(self):
+        '''
+            Returns:
+                snapshot : dict
+                    Snapshot of the timing histograms (fifo_read, decode, features, append, flush, send) and counters (reads, words, events, messages,
+                    count_lost, rx_resets, builder_resets, send_drops, publish_drops) of the current run together with the board ID, see Metrics.snapshot()
+        '''
+        snapshot = self.metrics.snapshot()
+        snapshot['board'] = self.board_id
+        return snapshot
+
+    def _drop_published(self, item):
+        self.metrics.count('publish_drops')
+        self._release_data(item[0], item[2][2])
+
+    def _release_data(self, events_data, channel):
+        self.event_builders[channel].release(events_data)
+
+    def get_pipeline_statistics(self):
+        '''
+            Returns:
+                statistics : dict
+                    Statistics of the readout scheduler and of every pipeline stage by name
+        '''
+        statistics = dict((stage.name, stage.get_statistics()) for stage in self.stages)
+        statistics['readout'] = self.readout_scheduler.get_statistics()
+        statistics['readout']['ring_buffer_misses'] = sum(event_builder.buffer_misses for event_builder in self.event_builders.values())
+        statistics['publish']['send_drops'] = self.send_drops
+        if self.event_writers:
+            channels = dict((channel, writer.get_statistics()) for channel, writer in self.event_writers.items())
+            for key in ('events_processed', 'events_written', 'bytes_written', 'flushes', 'write_time'):
+                statistics['write'][key] = sum(writer_statistics[key] for writer_statistics in channels.values())
+            statistics['write']['write_speed'] = statistics['write']['bytes_written'] / statistics['write']['write_time'] / 1e6 if statistics['write']['write_time'] > 0 else 0.
+            statistics['write']['channels'] = channels
+        return statistics
+
+    def _get_channel_filename(self, channel):
+        '''
+            Output file of channel: out_filename for single channel runs, otherwise <out_filename>_ch<channel>.h5
+        '''
+        if len(self.channels) == 1:
+            return self.out_filename
+        return '%s_ch%d.h5' % (os.path.splitext(self.out_filename)[0], channel)
 
     def _main_loop(self):
         logging.info('Beginning measurement. Please open Online Monitor.')
-        last_mod_value = 0
-        with tb.open_file(self.out_filename, 'w') as self.output_file:
-            output_array = self.output_file.createEArray(self.output_file.root, name='event_data', atom=tb.UIntAtom(), shape=(0, self.sample_count), title='The raw events from the ADC', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-            while not self.exit.wait(0.01):
-                events_data = self._record_data()
-                
-                if np.any(events_data):
-                    self._send_data(events_data)
-                    try:
-                        output_array.append(events_data)
-                    except ValueError:
-                        print events_data, events_data.shape
-                    self.event_count += events_data.shape[0]
-                    if (self.event_count % self.write_after_n_events < last_mod_value):
-                        logging.info('Recorded %d events. Write data to disk.', self.write_after_n_events)
-                        output_array.flush()
-                    last_mod_value = self.event_count % self.write_after_n_events
+        self._last_read_number = -1
+        settings = dict(flush_bytes=self.write_after_n_events * self.sample_count * np.dtype(self.event_dtype).itemsize)
+        settings.update(self.writer_settings)
+        self.event_writers = dict((channel, EventWriter(self.sample_count, dtype=self.event_dtype, **settings)) for channel in self.channels)
+        for channel, writer in self.event_writers.items():
+            writer.open(self._get_channel_filename(channel))
+        try:
+            for stage in self.stages:
+                stage.reset_statistics()
+                stage.start()
             
-            output_array.flush()
\ No newline at end of file
+            read_number = 0
+            while not self.exit.wait(self.readout_scheduler.interval):
+                raw_data = self._read_raw_data()
+                self.decode_stage.put((read_number, raw_data, time.time(), self.channel_count_lost))
+                read_number += 1
+        finally:
+            for stage in self.stages:                                           # Stop stages in order, so all queued data is processed
+                stage.stop()
+            self._release_sent(timeout=0.5)
+            for channel in self.channels:
+                if self.monitor_mode == 'histogram' and self.monitor_streams[channel].waveforms is not None:
+                    self._send_monitor_update(channel, time.time())             # Final histogram of the run
+                self.event_writers[channel].close()
+            self._report_metrics()                                              # Final metrics of the run
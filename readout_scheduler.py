@@ -0,0 +1,127 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import time
+import logging
+
+
+class ReadoutScheduler(object):
+    '''
+        Chooses poll interval and read size of the SRAM readout from the DATA_FIFO fill level.
+        The fill rate of the FIFO is estimated from consecutive fill levels. The next poll is scheduled when target_read_words are expected,
+        but never later than max_interval (latency bound) and never later than the FIFO could reach near_full_fraction of its capacity
+        at max_fill_rate (overflow bound, also for sudden bursts). Until a fill rate has been measured, the FIFO is polled every min_interval.
+    '''
+
+    def __init__(self, fifo_capacity=2**19, min_interval=0.001, max_interval=0.01, target_read_words=2**16, max_read_words=2**18, near_full_fraction=0.5, smoothing=0.2, max_fill_rate=2**23):
+        '''
+            Parameters
+            ----------
+            fifo_capacity : int
+                Capacity of the SRAM FIFO in 32 bit words
+            min_interval : float
+                Minimum time between two polls in seconds
+            max_interval : float
+                Maximum time between two polls in seconds, i.e. the latency bound
+            target_read_words : int
+                Number of words to collect per poll at high rates
+            max_read_words : int
+                Maximum number of words per read. The rest is read on the next poll after min_interval.
+            near_full_fraction : float [0:1]
+                FIFO fill fraction that counts as near-overflow
+            smoothing : float [0:1]
+                Weight of the latest measurement in the fill rate estimate
+            max_fill_rate : float
+                Worst case fill rate of the FIFO in words/s, e.g. a burst at the full link rate
+        '''
+        self.fifo_capacity = fifo_capacity
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_read_words = target_read_words
+        self.max_read_words = max_read_words
+        self.near_full_fraction = near_full_fraction
+        self.smoothing = smoothing
+        self.max_fill_rate = max_fill_rate
+        self.reset()
+
+    def reset(self):
+        self.interval = self.min_interval
+        self.fill_rate = 0.
+        self.last_rate = None                                                   # Latest measured fill rate, None until the second poll
+        self.polls = 0
+        self.words_read = 0
+        self.near_overflow_events = 0
+        self.max_fill_fraction = 0.
+        self._start_time = None
+        self._last_time = None
+        self._last_fill = 0
+        self._near_full = False
+
+    def schedule(self, fifo_words, now=None):
+        '''
+            Updates the fill rate estimate and chooses read size and next poll interval.
+            ----------
+            Parameters:
+                fifo_words : int
+                    Current fill level of the FIFO in 32 bit words
+                now : float
+                    [Optional] Time of the fill level measurement. Defaults to time.time().
+            Returns:
+                n_words : int
+                    Number of words to read now. The interval until the next poll is stored in self.interval.
+        '''
+        if now is None:
+            now = time.time()
+
+        if self._last_time is None:
+            self._start_time = now
+        elif now > self._last_time:
+            self.last_rate = max(fifo_words - self._last_fill, 0) / float(now - self._last_time)
+            self.fill_rate = self.smoothing * self.last_rate + (1. - self.smoothing) * self.fill_rate
+
+        fill_fraction = fifo_words / float(self.fifo_capacity)
+        self.max_fill_fraction = max(self.max_fill_fraction, fill_fraction)
+        near_full = fill_fraction >= self.near_full_fraction
+        if near_full:
+            self.near_overflow_events += 1
+            if not self._near_full:                                             # Only when the FIFO becomes near-full, not on every poll
+                logging.warning('SRAM FIFO is %d%% full. Polling at maximum rate.', 100 * fill_fraction)
+        self._near_full = near_full
+
+        n_words = min(fifo_words, self.max_read_words)
+        self._last_fill = fifo_words - n_words
+        self._last_time = now
+        self.polls += 1
+        self.words_read += n_words
+
+        rate = max(self.fill_rate, self.last_rate or 0.)                        # The latest rate reacts to bursts before the smoothed estimate does
+        if near_full or self._last_fill > 0 or self.last_rate is None:
+            self.interval = self.min_interval
+        elif rate > 0:
+            self.interval = min(self.target_read_words / rate, self.max_interval)
+        else:
+            self.interval = self.max_interval
+        headroom = self.near_full_fraction * self.fifo_capacity - self._last_fill
+        self.interval = max(min(self.interval, headroom / float(max(rate, self.max_fill_rate))), self.min_interval)
+
+        return n_words
+
+    def get_statistics(self):
+        '''
+            Returns:
+                statistics : dict
+                    Achieved poll rate in Hz, mean words per read, estimated fill rate in words/s, maximum fill fraction and number of near-overflow events
+        '''
+        elapsed = (self._last_time - self._start_time) if self._last_time is not None else 0.
+        return dict(
+            polls=self.polls,
+            poll_rate=(self.polls - 1) / elapsed if elapsed > 0 else 0.,
+            words_per_read=self.words_read / float(self.polls) if self.polls else 0.,
+            fill_rate=self.fill_rate,
+            max_fill_fraction=self.max_fill_fraction,
+            near_overflow_events=self.near_overflow_events
+        )
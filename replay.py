@@ -0,0 +1,392 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+'''
+    Hardware-free replay of waveforms through the qmca acquisition path.
+    ReplayDut stands in for the basil Dut of the qMCA setup: recorded or generated waveforms are encoded into the raw DATA_FIFO word format and delivered at a configurable rate,
+    so _main_loop, the event builders and the output files run exactly as with hardware, e.g. qmca(config=ReplayDut(rate=8000.)).
+'''
+
+import sys
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+from event_builder import encode_events, N_CHANNELS
+
+GENERATED_EVENTS = 10000                                                        # Number of generated pulses that are replayed in a loop
+FIFO_CAPACITY = 2**19                                                           # 2 MB SRAM of the MIO in 32 bit words
+LOST_COUNT_MAX = 0xff                                                           # COUNT_LOST of the gpac_adc_rx saturates at 8 bit
+
+
+def generate_waveforms(n_events, sample_count, seed=0):
+    '''
+        Generates n_events gaussian pulses with random amplitudes on a noisy baseline as uint16 array.
+    '''
+    rnd = np.random.RandomState(seed)
+    t = np.arange(sample_count)
+    amplitude = rnd.uniform(1000, 12000, size=(n_events, 1))
+    events = 1000 + amplitude * np.exp(-(t - sample_count / 4.) ** 2 / (2 * (sample_count / 20.) ** 2))
+    events += rnd.normal(0, 20, size=events.shape)
+    return np.clip(events, 0, 2**14 - 1).astype(np.uint16)
+
+
+def load_source(source):
+    '''
+        Returns:
+            events : np.ndarray
+                (n, sample_count) waveforms of source, which is an array, an EventRun or the filename of a run (h5 file or run index). Runs are read completely into memory.
+    '''
+    if isinstance(source, (str, type(u''))):
+        from event_run import EventRun
+        with EventRun(source) as run:
+            return run.read()
+    if hasattr(source, 'read'):
+        return source.read()
+    return np.asarray(source)
+
+
+class ReplayDut(object):
+    '''
+        Software stand-in for the basil Dut of the qMCA setup with DATA_FIFO, fadc<n>_rx, TH, PWR<n> and VSRC3 drivers.
+        Every channel that is enabled by EN_CH and whose fadc_rx trigger is enabled triggers at a mean rate (Poisson arrivals) on the events of its source
+        with a maximum above the threshold of the channel. The events are cropped to the data count of the fadc_rx and appended to the SRAM FIFO with the channel number in every word.
+        Words that do not fit into the FIFO are lost and counted by the fadc_rx of the channel like in the firmware. Additional overflows can be injected at a fixed interval.
+        The time starts with init(), events are generated whenever a driver is accessed.
+    '''
+
+    def __init__(self, source=None, rate=8000., n_events=None, fifo_capacity=FIFO_CAPACITY, overflow_interval=None, overflow_words=None, read_speed=None, seed=0):
+        '''
+            Parameters
+            ----------
+            source : np.ndarray, EventRun, string or dict
+                [Optional] Waveforms (n, sample_count) to replay, a run (see load_source) or a dict of those by channel. Channels missing in the dict do not trigger.
+                None replays GENERATED_EVENTS generated pulses (see generate_waveforms) with the data count of the fadc_rx.
+            rate : float
+                Mean trigger rate of every channel in Hz
+            n_events : int
+                [Optional] Number of triggers per channel after which the channel stops. By default the source is replayed in a loop.
+            fifo_capacity : int
+                Capacity of the SRAM FIFO in 32 bit words
+            overflow_interval : float
+                [Optional] Time between injected overflows in seconds. Every injected overflow removes overflow_words words from the stream of every triggering channel.
+            overflow_words : int
+                [Optional] Number of words lost per injected overflow. By default a random number of up to four events is lost,
+                so the stream after an overflow is not aligned to the events.
+            read_speed : float
+                [Optional] Speed of the USB reads in bytes per second. By default reads take no time.
+            seed : int
+                Seed of the arrival times, the injected overflows and the generated pulses
+        '''
+        if not isinstance(source, dict):
+            source = dict((channel, source) for channel in range(N_CHANNELS))
+        self.rate = rate
+        self.n_events = n_events
+        self.overflow_interval = overflow_interval
+        self.overflow_words = overflow_words
+        self.seed = seed
+        self.lock = threading.RLock()                                           # The drivers are used by the readout thread and by the user
+        self._rnd = np.random.RandomState(seed)
+        self._last_time = None
+        self._drivers = {'DATA_FIFO': ReplayFifo(self, fifo_capacity, read_speed), 'TH': ReplayRegister(self), 'VSRC3': ReplaySupply()}
+        for channel in range(N_CHANNELS):
+            self._drivers['fadc%d_rx' % channel] = ReplayRx(self, channel, load_source(source[channel]) if channel in source and source[channel] is not None else None, generate=channel in source and source[channel] is None)
+            self._drivers['PWR%d' % channel] = ReplaySupply()
+
+    def __getitem__(self, name):
+        return self._drivers[name]
+
+    def init(self):
+        with self.lock:
+            self._last_time = time.time()
+            self._next_overflow = self._last_time + self.overflow_interval if self.overflow_interval else None
+
+    def close(self):
+        pass
+
+    def is_done(self):
+        '''
+            Returns:
+                done : bool
+                    True if all triggering channels have reached n_events and the FIFO is empty
+        '''
+        with self.lock:
+            self._update()
+            return self.n_events is not None and not any(self._is_triggering(channel) and self['fadc%d_rx' % channel].triggers < self.n_events for channel in range(N_CHANNELS)) and self['DATA_FIFO'].words == 0
+
+    def get_statistics(self):
+        '''
+            Returns:
+                statistics : dict
+                    Triggers, lost words and injected overflows by channel and the maximum fill level of the FIFO in words
+        '''
+        with self.lock:
+            self._update()
+            channels = dict((channel, dict(triggers=rx.triggers, lost_words=rx.lost_words, injected_overflows=rx.injected_overflows)) for channel, rx in ((channel, self['fadc%d_rx' % channel]) for channel in range(N_CHANNELS)))
+            return dict(channels=channels, max_fifo_words=self['DATA_FIFO'].max_words)
+
+    def _is_triggering(self, channel):
+        rx = self['fadc%d_rx' % channel]
+        return bool((self['TH'].applied.get('EN_CH', 0) >> channel) & 1) and rx.en_trigger and rx.has_source
+
+    def _update(self):
+        '''
+            Delivers the events that were triggered since the last update to the FIFO.
+        '''
+        if self._last_time is None:
+            return
+        now = time.time()
+        elapsed, self._last_time = now - self._last_time, now
+        inject = self._next_overflow is not None and now >= self._next_overflow
+        if inject:
+            self._next_overflow = now + self.overflow_interval
+        fifo = self['DATA_FIFO']
+        for channel in range(N_CHANNELS):
+            if not self._is_triggering(channel):
+                continue
+            rx = self['fadc%d_rx' % channel]
+            n_events = self._rnd.poisson(self.rate * elapsed)
+            if self.n_events is not None:
+                n_events = min(n_events, self.n_events - rx.triggers)
+            if n_events <= 0:
+                continue
+            overflow_words = 0
+            if inject:
+                overflow_words = self.overflow_words if self.overflow_words is not None else self._rnd.randint(1, 4 * rx.data_count)
+            max_events = (fifo.capacity - fifo.words + overflow_words) // rx.data_count + 1   # Only encode what can reach the FIFO
+            raw_data = rx.trigger(n_events, self['TH'].applied.get('TH%d' % channel, 0), max_events)
+            if inject and raw_data.shape[0] > 0:
+                start = self._rnd.randint(0, raw_data.shape[0])                 # Overflow in the middle of an event
+                lost = min(overflow_words, raw_data.shape[0] - start)
+                raw_data = np.concatenate((raw_data[:start], raw_data[start + lost:]))
+                rx.lose(lost)
+                rx.injected_overflows += 1
+            rx.lose(fifo.push(raw_data))
+
+
+class ReplayFifo(object):
+    '''
+        Stand-in for the sram_fifo driver. Also serves as its own interface, so reads via _intf.read(_conf['base_data_addr'], size) work like with basil.
+    '''
+
+    def __init__(self, dut, capacity, read_speed=None):
+        self._dut = dut
+        self._conf = {'base_data_addr': 0}
+        self._intf = self
+        self.capacity = capacity
+        self.read_speed = read_speed
+        self.max_words = 0
+        self._blocks = deque()
+        self.words = 0
+
+    def reset(self):
+        with self._dut.lock:
+            self._dut._update()
+            self._blocks.clear()
+            self.words = 0
+
+    @property
+    def FIFO_SIZE(self):
+        '''
+            Fill level of the FIFO in bytes
+        '''
+        with self._dut.lock:
+            self._dut._update()
+            return 4 * self.words
+
+    @property
+    def FIFO_INT_SIZE(self):
+        '''
+            Fill level of the FIFO in 32 bit words
+        '''
+        return self.FIFO_SIZE // 4
+
+    def get_FIFO_SIZE(self):
+        return self.FIFO_SIZE
+
+    def get_FIFO_INT_SIZE(self):
+        return self.FIFO_INT_SIZE
+
+    def get_data(self):
+        return np.frombuffer(self.read(self._conf['base_data_addr'], self.FIFO_SIZE), dtype=np.dtype('<u4'))
+
+    def read(self, addr, size):
+        '''
+            Reads and removes up to size bytes from the FIFO.
+        '''
+        with self._dut.lock:
+            self._dut._update()
+            n_words = min(size // 4, self.words)
+            blocks = []
+            missing = n_words
+            while missing > 0:
+                block = self._blocks.popleft()
+                if block.shape[0] > missing:
+                    self._blocks.appendleft(block[missing:])
+                    block = block[:missing]
+                blocks.append(block)
+                missing -= block.shape[0]
+            self.words -= n_words
+        if self.read_speed:
+            time.sleep(4 * n_words / float(self.read_speed))
+        return np.concatenate(blocks).tobytes() if blocks else b''
+
+    def push(self, raw_data):
+        '''
+            Appends words to the FIFO.
+            ----------
+            Returns:
+                lost : int
+                    Number of words that did not fit into the FIFO
+        '''
+        n_words = min(raw_data.shape[0], self.capacity - self.words)
+        if n_words > 0:
+            self._blocks.append(raw_data[:n_words])
+            self.words += n_words
+            self.max_words = max(self.max_words, self.words)
+        return raw_data.shape[0] - n_words
+
+
+class ReplayRx(object):
+    '''
+        Stand-in for the fadc_rx driver of one channel. A reset clears the configuration and COUNT_LOST like in the firmware.
+    '''
+
+    def __init__(self, dut, channel, events=None, generate=False):
+        self._dut = dut
+        self.channel = channel
+        self.events = events
+        self.generate = generate
+        self.triggers = 0                                                       # Triggered events including lost ones
+        self.lost_words = 0
+        self.injected_overflows = 0
+        self._position = 0
+        self._selection = None                                                  # (threshold, indices of the events above threshold)
+        self._reset()
+
+    @property
+    def has_source(self):
+        return self.events is not None or self.generate
+
+    def _reset(self):
+        self.count_lost = 0
+        self.en_trigger = False
+        self.single_data = False
+        self.data_count = 0
+        self.delay = 0
+
+    def reset(self):
+        with self._dut.lock:
+            self._dut._update()
+            self._reset()
+
+    def set_delay(self, value):
+        self.delay = value
+
+    def set_data_count(self, count):
+        with self._dut.lock:
+            self._dut._update()
+            if self.generate and (self.events is None or self.events.shape[1] != count):
+                self.events = generate_waveforms(GENERATED_EVENTS, count, seed=self._dut.seed + self.channel)
+                self._selection = None
+            elif self.events is not None and self.events.shape[1] < count:
+                raise ValueError('Source of channel %d has %d samples, cannot replay %d' % (self.channel, self.events.shape[1], count))
+            self.data_count = count
+
+    def set_single_data(self, value):
+        self.single_data = value
+
+    def set_en_trigger(self, value):
+        with self._dut.lock:
+            self._dut._update()
+            self.en_trigger = bool(value)
+
+    def get_count_lost(self):
+        with self._dut.lock:
+            self._dut._update()
+            return self.count_lost
+
+    def lose(self, n_words):
+        if n_words > 0:
+            self.lost_words += n_words
+            self.count_lost = min(self.count_lost + n_words, LOST_COUNT_MAX)
+
+    def trigger(self, n_events, threshold, max_events=None):
+        '''
+            Triggers the next n_events events of the source with a maximum above threshold.
+            ----------
+            Returns:
+                raw_data : np.ndarray
+                    FIFO words of the events. Only max_events events are encoded, the words of the others are counted as lost.
+        '''
+        if self.data_count == 0:
+            return np.empty(0, dtype=np.uint32)
+        if self._selection is None or self._selection[0] != threshold:
+            self._selection = (threshold, np.flatnonzero(np.amax(self.events[:, :self.data_count], axis=1) > threshold))
+        selection = self._selection[1]
+        if selection.shape[0] == 0:
+            return np.empty(0, dtype=np.uint32)
+        n_encoded = n_events if max_events is None else min(n_events, max_events)
+        indices = selection[(self._position + np.arange(n_encoded)) % selection.shape[0]]
+        self._position += n_events
+        self.triggers += n_events
+        self.lose((n_events - n_encoded) * self.data_count)
+        return encode_events(self.events[indices, :self.data_count], self.channel)
+
+
+class ReplayRegister(dict):
+    '''
+        Stand-in for a basil register. Like the firmware, the values are applied by write().
+    '''
+
+    def __init__(self, dut):
+        super(ReplayRegister, self).__init__()
+        self._dut = dut
+        self.applied = {}
+
+    def write(self):
+        with self._dut.lock:
+            self._dut._update()
+            self.applied = dict(self)
+
+
+class ReplaySupply(object):
+    '''
+        Stand-in for the power supplies and voltage sources of the GPAC.
+    '''
+
+    def __init__(self):
+        self.current_limit = None
+        self.voltage = None
+        self.enabled = False
+
+    def set_current_limit(self, value, unit='mA'):
+        self.current_limit = (value, unit)
+
+    def set_voltage(self, value, unit='mV'):
+        self.voltage = (value, unit)
+
+    def set_enable(self, value):
+        self.enabled = value
+
+
+if __name__ == '__main__':
+    # python replay.py [rate in Hz] [duration in seconds] [source run] [channels, e.g. 0,1]
+    from qmca import qmca
+    logging.basicConfig(level=logging.INFO)
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 8000.
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10.
+    channels = [int(channel) for channel in sys.argv[4].split(',')] if len(sys.argv) > 4 else 0
+    dut = ReplayDut(sys.argv[3] if len(sys.argv) > 3 else None, rate=rate)
+    device = qmca(config=dut, channel=channels)
+    device.start('replay_data')
+    time.sleep(duration)
+    device.stop()
+    logging.info('Replay statistics: %s', dut.get_statistics())
+    logging.info('%.0f events/s recorded at %.0f Hz trigger rate per channel', device.event_count / duration, rate)
+    device.close()
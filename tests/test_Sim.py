@@ -92,29 +92,42 @@ class TestSim(unittest.TestCase):
         
         self.my_qmca = qmca.qmca(config=cnfg, channel=self.ch, sample_count=self.sample_count, sample_delay=self.sample_delay, threshold=self.th)
 
-    def test(self):
-        # Wait a while
-        for _ in range(100):
-            self.my_qmca.dut['DATA_FIFO'].get_size()
-        
-        # Record some events
-        event_data = self.my_qmca._record_data()
-        
+    def check_events(self, event_data, channel):
         # Load the simulated event...
         start_data = np.load(self.file_name)
         # ... and shift it according to set threshold
         for i in range(start_data.shape[1]):
-            if start_data[self.ch][i] >= self.th:
+            if start_data[channel][i] >= self.th:
                 break
         dly = i - self.sample_delay
-        start_data_dly = start_data[self.ch][dly:]
+        start_data_dly = start_data[channel][dly:]
         
         # Compare simulated and recorded events
         comp = (event_data[self.ev][:-dly] == start_data_dly)
         self.assertTrue(comp.all())
+
+    def test(self):
+        # Wait a while
+        for _ in range(100):
+            self.my_qmca.dut['DATA_FIFO'].get_FIFO_SIZE()
+        
+        # Record some events
+        event_data = self.my_qmca._record_data()
+        self.check_events(event_data[self.ch], self.ch)
+
+    def test_multi_channel(self):
+        self.my_qmca.select_channel([0, 1, 2, 3])
+        self.my_qmca.set_threshold(self.th)
+        for _ in range(100):
+            self.my_qmca.dut['DATA_FIFO'].get_FIFO_SIZE()
+        
+        # The words of all channels are merged in the FIFO and split by channel
+        event_data = self.my_qmca._record_data()
+        for channel in range(4):
+            self.check_events(event_data[channel], channel)
         
     def tearDown(self):
-        self.my_qmca.dut.close()
+        self.my_qmca.close()                                                    # Stops the threads and closes the socket and the dut
         time.sleep(5)
         cocotb_compile_clean()
 
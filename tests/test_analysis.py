@@ -0,0 +1,194 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    from analysis import MCA_analysis, EnergyCalibration
+except ImportError:                                                             # matplotlib, scipy, pylandau and progressbar are not installed by the CI
+    MCA_analysis = None
+from event_writer import EventWriter
+from replay import generate_waveforms
+
+
+def correct_baseline_loop(data):
+    '''
+        Reference: the original per sample implementation of MCA_analysis.correct_baseline
+    '''
+    new_data = []
+    for wave in data:
+        baseline = np.round(np.mean(wave[:40]))
+        new_wave = [int(sample - baseline) for sample in wave]
+        if np.amax(wave) < 2**14-1:
+            new_data.append(np.array(new_wave))
+    return np.array(new_data)
+
+
+@unittest.skipIf(MCA_analysis is None, 'Analysis dependencies are not installed')
+class TestAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.events = generate_waveforms(2000, 200, seed=42)
+        self.events[::50, 100:120] = 2**14 - 1                                  # Saturated waveforms are omitted by the baseline correction
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)                                                # correct_baseline saves the baseline histogram to the working directory
+        writer = EventWriter(200, chunkshape=64, max_file_events=700)
+        writer.open(os.path.join(self.directory, 'source.h5'))
+        writer.append(self.events)
+        writer.close()
+        self.filename = writer.index_filename
+        self.max_bytes = 3 * 64 * 200 * self.events.itemsize
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_correct_baseline(self):
+        analysis = MCA_analysis()
+        expected = correct_baseline_loop(self.events[:500])
+        corrected, baselines = analysis.correct_baseline(self.events[:500], return_baselines=True)
+        self.assertEqual(corrected.dtype, expected.dtype)
+        np.testing.assert_array_equal(corrected, expected)
+        self.assertTrue(os.path.exists('baseline_histogram.pdf'))
+        unsaturated = np.amax(self.events[:500], axis=1) < 2**14-1
+        np.testing.assert_array_equal(baselines, np.round(np.mean(self.events[:500][unsaturated, :40], axis=1)))
+
+        data = self.events[:500].astype(np.int16)
+        corrected = analysis.correct_baseline(data, in_place=True, saturation=None, baseline_plot=None)
+        self.assertIs(corrected, data)                                          # Nothing omitted, no copy
+        np.testing.assert_array_equal(corrected[unsaturated], expected)
+        self.assertRaises(TypeError, analysis.correct_baseline, self.events, in_place=True, baseline_plot=None)
+
+        blocks = [analysis.correct_baseline(block, dtype=np.int32, baseline_plot=None) for block in analysis.iter_data_file(self.filename, self.max_bytes)]
+        np.testing.assert_array_equal(np.concatenate(blocks), correct_baseline_loop(self.events))
+        self.assertEqual(blocks[0].dtype, np.int32)
+        self.assertEqual(analysis.correct_baseline(self.events[:0], baseline_plot=None).shape, (0, 200))
+
+    def test_streaming(self):
+        analysis = MCA_analysis()
+        self.assertEqual(sum(len(data) for data in analysis.iter_data_file(self.filename, self.max_bytes)), 2000)
+        self.assertEqual(analysis.event_count, 2000)
+
+        x, y = analysis.histogram_data(analysis.load_data_file(self.filename))
+        x_stream, y_stream = analysis.histogram_data_file(self.filename, max_bytes=self.max_bytes)
+        np.testing.assert_array_equal(x_stream, x)
+        np.testing.assert_array_equal(y_stream, y)
+        np.testing.assert_array_equal(analysis.read_amplitudes(self.filename, max_bytes=self.max_bytes), np.amax(self.events, axis=1))
+
+    def test_streaming_baseline_correction(self):
+        analysis = MCA_analysis()
+        corrected = analysis.correct_baseline(analysis.load_data_file(self.filename))
+        x, y = analysis.histogram_data(corrected)
+        x_stream, y_stream = analysis.histogram_data_file(self.filename, baseline_correction=True, max_bytes=self.max_bytes)
+        self.assertTrue(analysis.outfile.endswith('source_index_baselineCorrected'))
+        np.testing.assert_array_equal(y_stream, y)
+        np.testing.assert_array_equal(analysis.read_amplitudes(self.filename, baseline_correction=True, max_bytes=self.max_bytes), np.amax(corrected, axis=1))
+
+        darkframe = os.path.join(self.directory, 'source_0001.h5')
+        np.testing.assert_array_equal(analysis.substract_darkframe(y, darkframe), np.maximum(y - analysis.histogram_data(analysis.load_data_file(darkframe))[1], 0))
+
+
+    def test_calibration(self):
+        analysis = MCA_analysis()
+        x, _ = analysis.histogram_data_file(self.filename)
+        calibrated = analysis.calibrate_energy(x, m=0.004, b=21.32, unit='keV')
+        np.testing.assert_array_equal(calibrated, np.array([0.004*newx+21.32 for newx in x]))   # Equal to the former per bin implementation
+        self.assertTrue(analysis.outfile.endswith('_calibrated'))
+        self.assertEqual(analysis._energy_unit, 'keV')
+
+        calibration = EnergyCalibration(0.004, 21.32, 'keV')
+        edges = calibration.get_edges()
+        self.assertIs(calibration.get_edges(), edges)                           # Shared by all histograms of the binning
+        self.assertFalse(edges.flags.writeable)
+        np.testing.assert_array_equal(edges, calibrated)
+        np.testing.assert_allclose(calibration.inverse(edges), x)
+        analysis.calibrate_energy(x, calibration=calibration, out=x)
+        np.testing.assert_array_equal(x, calibrated)
+        self.assertEqual(pickle.loads(pickle.dumps(calibration)).get_edges(bins=16).shape, (16,))
+        np.testing.assert_array_equal(analysis._apply_multiplicator(np.arange(4), 1e6), np.arange(4) * 1e6)
+
+    def test_darkframe_normalization(self):
+        writer = EventWriter(200)
+        writer.open(os.path.join(self.directory, 'dark.h5'))
+        writer.append(self.events[:500])
+        writer.close()
+        for filename, duration in ((self.filename, 10.), (writer.index_filename, 4.)):
+            with open(filename) as index_file:
+                index = json.load(index_file)
+            for entry in index['files']:
+                entry['stop_time'] = entry['start_time'] + duration / len(index['files'])
+            with open(filename, 'w') as index_file:
+                json.dump(index, index_file)
+
+        analysis = MCA_analysis()
+        _, y = analysis.histogram_data_file(self.filename, bins=256)
+        _, dark = analysis.histogram_data(self.events[:500], bins=256)
+        np.testing.assert_array_equal(analysis.substract_darkframe(y, writer.index_filename), np.maximum(y - dark, 0))
+        np.testing.assert_allclose(analysis.substract_darkframe(y, writer.index_filename, normalize='events'), np.maximum(y - dark * 4., 0))
+        np.testing.assert_allclose(analysis.substract_darkframe(y, writer.index_filename, normalize='time'), np.maximum(y - dark * 2.5, 0), atol=1e-5)
+        self.assertRaises(ValueError, analysis.substract_darkframe, y, writer.index_filename, normalize='runs')
+
+        analysis._iter_run = None                                               # The darkframe histogram of the binning is cached
+        np.testing.assert_array_equal(analysis.substract_darkframe(y, writer.index_filename), np.maximum(y - dark, 0))
+
+
+    def test_find_threshold(self):
+        events = self.events[np.amax(self.events, axis=1) > 4000]             # Triggered by a threshold of 4000 ADC
+        writer = EventWriter(200)
+        writer.open(os.path.join(self.directory, 'thr.h5'))
+        writer.append(events[:500], readout=(0., 4500, 0, 0, 0))
+        writer.append(events[500:], readout=(1., 4000, 0, 0, 0))                # Lowest threshold of the run
+        writer.close()
+        filename = os.path.join(self.directory, 'thr.h5')
+
+        analysis = MCA_analysis()
+        for bins in (1024, 300):
+            x, y = analysis.histogram_data(analysis.load_data_file(filename), bins=bins)
+            self.assertEqual(analysis.get_acquisition_threshold(), 4000)
+            self.assertEqual(analysis.find_threshold(y, x=x), 4000)
+            found = analysis.find_threshold(y, x=x, use_metadata=False)        # Detected from the spectrum
+            self.assertTrue(4000 - (x[1] - x[0]) < found <= 4000)
+        self.assertEqual(analysis.find_threshold(np.vstack((y, y)), x=x).shape, (2,))   # One threshold per histogram
+        calibrated = analysis.calibrate_energy(x, m=0.004, b=21.32, unit='keV')
+        self.assertAlmostEqual(analysis.find_threshold(y, x=calibrated), 0.004*4000+21.32)
+        self.assertAlmostEqual(analysis.find_threshold(y, x=calibrated, use_metadata=False), 0.004*found+21.32)
+
+        x, y = analysis.histogram_data_file(filename, baseline_correction=True)     # The threshold is not known for baseline corrected amplitudes
+        self.assertNotEqual(analysis.find_threshold(y, x=x), 4000)
+        x, y = analysis.histogram_data_file(self.filename)                      # No readout table
+        self.assertIsNone(analysis.get_acquisition_threshold())
+        self.assertEqual(analysis.find_threshold(y), analysis.find_threshold(y, x=x, use_metadata=False))
+        self.assertEqual(analysis.find_threshold(np.zeros(1024)), 0)
+        self.assertEqual(analysis.errorfiles[-1], [self.filename, 'Could not determine threshold!'])
+
+
+    def test_fit_source_spectrum(self):
+        x = np.arange(1024) * 16.                                               # ADC bins of histogram_data
+        y = np.random.RandomState(42).poisson(300. * np.exp(-(x - 8000.)**2 / (2 * 800.**2))).astype(np.float64)
+        analysis = MCA_analysis(outformat='png')
+        analysis.title, analysis.outfile = 'source', os.path.join(self.directory, 'source')
+        analysis.event_count = int(np.sum(y))
+        p = analysis.fit_source_spectrum(x, y)                                  # Automatic start values
+        self.assertFalse(analysis.error)
+        self.assertEqual(p, analysis.fit_result['p'])
+        self.assertLess(abs(p[0] - 8000.), 5 * analysis.fit_result['p_err'][0])
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, 'source.png')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    from analysis import MCA_analysis
+except ImportError:                                                             # matplotlib, scipy, pylandau and progressbar are not installed by the CI
+    MCA_analysis = None
+from analysis_cache import AnalysisCache, CACHE_DIRECTORY
+from event_writer import EventWriter
+from replay import generate_waveforms
+
+
+class TestAnalysisCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'data.h5')
+        self.events = generate_waveforms(1000, 200, seed=42)
+        writer = EventWriter(200)
+        writer.open(self.filename)
+        writer.append(self.events)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries(self):
+        cache = AnalysisCache()
+        self.assertIsNone(cache.get(self.filename, 'histogram', dict(bins=10)))
+        cache.put(self.filename, 'histogram', dict(bins=10), info=dict(event_count=1000), y=np.arange(10))
+        self.assertTrue(os.path.isdir(os.path.join(self.directory, CACHE_DIRECTORY)))   # Sidecar directory
+        entry = cache.get(self.filename, 'histogram', dict(bins=10))
+        np.testing.assert_array_equal(entry['y'], np.arange(10))
+        self.assertEqual(entry['info'], dict(event_count=1000))
+        self.assertIsNone(cache.get(self.filename, 'histogram', dict(bins=20)))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        with open(self.filename, 'ab') as data_file:                            # Changed data file
+            data_file.write(b'\0')
+        self.assertIsNone(cache.get(self.filename, 'histogram', dict(bins=10)))
+        cache.invalidate(self.filename)
+        self.assertEqual(cache.get_size(self.filename), 0)
+
+    def test_eviction(self):
+        cache = AnalysisCache(os.path.join(self.directory, 'cache'))
+        for i in range(3):
+            cache.put(self.filename, 'amplitudes', dict(i=i), amplitudes=np.zeros(1000))
+            cache.max_bytes = 3 * cache.get_size() // (i + 1)                   # Room for three entries
+            os.utime(cache._get_filename(self.filename, 'amplitudes', dict(i=i)), (time.time() - 10 + i, time.time() - 10 + i))
+        self.assertIsNotNone(cache.get(self.filename, 'amplitudes', dict(i=0)))  # Most recently used now
+        cache.put(self.filename, 'amplitudes', dict(i=3), amplitudes=np.zeros(1000))
+        self.assertLessEqual(cache.get_size(), cache.max_bytes)
+        self.assertIsNone(cache.get(self.filename, 'amplitudes', dict(i=1)))     # Least recently used
+        self.assertIsNotNone(cache.get(self.filename, 'amplitudes', dict(i=0)))
+        self.assertIsNotNone(cache.get(self.filename, 'amplitudes', dict(i=3)))
+        cache.clear()
+        self.assertEqual(cache.get_size(), 0)
+
+    @unittest.skipIf(MCA_analysis is None, 'Analysis dependencies are not installed')
+    def test_analysis(self):
+        cache = AnalysisCache()
+        x, y = MCA_analysis().histogram_data_file(self.filename, baseline_correction=True)
+        analysis = MCA_analysis(cache=cache)
+        for _ in range(2):
+            x_cached, y_cached = analysis.histogram_data_file(self.filename, baseline_correction=True)
+            np.testing.assert_array_equal(x_cached, x)
+            np.testing.assert_array_equal(y_cached, y)
+            self.assertEqual(analysis.event_count, 1000)
+            self.assertTrue(analysis.outfile.endswith('data_baselineCorrected'))
+        self.assertEqual(cache.hits, 1)
+
+        analysis.iter_data_file = None                                          # Other binnings from the cached amplitudes, without reading the file
+        y_cached = analysis.histogram_data_file(self.filename, bins=256, baseline_correction=True)[1]
+        np.testing.assert_array_equal(y_cached, MCA_analysis().histogram_data_file(self.filename, bins=256, baseline_correction=True)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    from analysis import MCA_analysis
+except ImportError:                                                             # matplotlib, scipy, pylandau and progressbar are not installed by the CI
+    MCA_analysis = None
+from batch_analysis import BatchAnalysis, find_data_files
+from event_writer import EventWriter
+from replay import generate_waveforms
+
+
+def outfile_task(analysis, path):
+    analysis.load_data_file(path)
+    analysis.calibrate_energy(np.arange(4), 2., 1., 'keV')
+    return analysis.outfile
+
+
+class TestBatchAnalysis(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        self.events = generate_waveforms(600, 200, seed=42)
+        writer = EventWriter(200, max_file_events=250)
+        writer.open(os.path.join(self.directory, 'run.h5'))                     # Run of three files
+        writer.append(self.events)
+        writer.close()
+        self.files = [writer.index_filename]
+        for i in range(3):
+            self.files.append(os.path.join(self.directory, 'sub', 'file%d.h5' % i))
+            writer = EventWriter(200)
+            writer.open(self.files[-1])
+            writer.append(self.events[i * 200:(i + 1) * 200])
+            writer.close()
+        self.broken = os.path.join(self.directory, 'sub', 'broken.h5')
+        with open(self.broken, 'w') as broken_file:
+            broken_file.write('no HDF5')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_find_data_files(self):
+        self.assertEqual(find_data_files(self.directory), sorted(self.files + [self.broken]))
+        self.assertEqual(find_data_files(self.directory, exclude=['broken', 'file1']), sorted(self.files[:2] + self.files[3:]))
+
+    @unittest.skipIf(MCA_analysis is None, 'Analysis dependencies are not installed')
+    def test_histograms(self):
+        progress = []
+        batch = BatchAnalysis('histogram', processes=2, bins=256)
+        results = batch.run(self.files + [self.broken], progress=lambda done, total, result: progress.append((done, total)))
+        self.assertEqual([result['path'] for result in results], self.files + [self.broken])
+        self.assertEqual(progress, [(i, 5) for i in range(1, 6)])
+
+        analysis = MCA_analysis()
+        for result in results[:-1]:
+            self.assertTrue(result['ok'])
+            np.testing.assert_array_equal(result['result']['y'], analysis.histogram_data(analysis.load_data_file(result['path']), bins=256)[1])
+        self.assertEqual(results[0]['result']['event_count'], 600)
+
+        self.assertFalse(results[-1]['ok'])
+        self.assertEqual(batch.get_errors(), [results[-1]])
+        self.assertIn('Traceback', results[-1]['errors'][0]['traceback'])
+        batch.write_errors(os.path.join(self.directory, 'errorfiles.log'))
+        with open(os.path.join(self.directory, 'errorfiles.log')) as error_file:
+            self.assertTrue(error_file.read().strip().endswith('<- %s' % self.broken))
+
+    @unittest.skipIf(MCA_analysis is None, 'Analysis dependencies are not installed')
+    def test_worker_state(self):
+        results = BatchAnalysis(outfile_task, processes=2).run(self.files[1:], progress=False)
+        self.assertEqual([result['result'] for result in results], [path[:-3] + '_calibrated' for path in self.files[1:]])   # No state of the previous file of the worker
+
+
+if __name__ == '__main__':
+    unittest.main()
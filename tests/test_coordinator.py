@@ -0,0 +1,137 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+import zmq
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from coordinator import Coordinator, load_config, open_runs
+from event_writer import EventWriter
+from monitor_protocol import pack_header, unpack_header, MSG_HISTOGRAM
+
+
+class FakeBoard(object):
+    '''
+        Stands in for qmca in the board processes: counts events, sends a histogram per update and writes a run with EventWriter on stop.
+    '''
+
+    def __init__(self, board_id, socket_addr, fail=False):
+        if fail:
+            raise IOError('No USB device')
+        self.board_id = board_id
+        self.event_count = 0
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.PUSH)
+        self.socket.bind(socket_addr)
+        self.exit = threading.Event()
+        self.writer = EventWriter(10)
+
+    def start(self, out_filename):
+        self.event_count = 0
+        self.exit.clear()
+        self.writer.open(out_filename + '.h5')
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        histogram = np.zeros(512, dtype=np.int64)
+        while not self.exit.wait(0.01):
+            self.event_count += 10
+            self.writer.append(np.zeros((10, 10), dtype=np.uint16))
+            try:
+                self.socket.send(pack_header(MSG_HISTOGRAM, self.event_count, histogram, 1000, 0, 0., self.board_id), flags=zmq.SNDMORE | zmq.NOBLOCK)
+                self.socket.send(histogram, flags=zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+
+    def stop(self):
+        self.exit.set()
+        self.thread.join()
+        self.writer.close()
+
+    def get_run_files(self):
+        return {0: self.writer.index_filename}
+
+    def get_pipeline_statistics(self):
+        return dict(publish=dict(send_drops=np.int64(0)))
+
+    def close(self):
+        self.socket.close(linger=0)
+        self.context.term()
+
+
+class TestCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = dict(monitor_addr='tcp://127.0.0.1:15790', boards=[
+            dict(board_id=3, socket_addr='tcp://127.0.0.1:15791'),
+            dict(board_id=5, socket_addr='tcp://127.0.0.1:15792')
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_config(self):
+        config = load_config(dict(boards=[dict(socket_addr='tcp://127.0.0.1:15791', channel=[0, 1]), dict(socket_addr='tcp://127.0.0.1:15792')]))
+        self.assertEqual([board['board_id'] for board in config['boards']], [0, 1])
+        self.assertEqual(config['boards'][0]['settings']['channel'], [0, 1])
+        self.assertRaises(ValueError, load_config, dict(boards=[dict(socket_addr='tcp://127.0.0.1:5678')]))
+
+    def test_run(self):
+        context = zmq.Context()
+        monitor = context.socket(zmq.PULL)
+        monitor.connect(self.config['monitor_addr'])
+        try:
+            with Coordinator(self.config, factory=FakeBoard, timeout=10.) as coordinator:
+                self.assertEqual(sorted(coordinator.boards), [3, 5])
+                out_filename = os.path.join(self.directory, 'run')
+                coordinator.start(out_filename)
+                boards = set()
+                while len(boards) < 2 and monitor.poll(5000):
+                    meta_data = unpack_header(monitor.recv())
+                    monitor.recv()
+                    boards.add(meta_data['board'])
+                run_index = coordinator.stop()
+                event_counts = coordinator.get_event_counts()
+        finally:
+            monitor.close(linger=0)
+            context.term()
+
+        self.assertEqual(boards, set([3, 5]))                                   # Combined feed with the data of both boards
+        with open(out_filename + '_boards.json') as index_file:
+            self.assertEqual([entry['event_count'] for entry in json.load(index_file)['boards']], [entry['event_count'] for entry in run_index['boards']])
+        self.assertLess(abs(run_index['boards'][0]['start_time'] - run_index['boards'][1]['start_time']), 1.)
+        runs = open_runs(out_filename + '_boards.json')
+        self.assertEqual(sorted(runs), [(3, 0), (5, 0)])
+        for entry in run_index['boards']:
+            self.assertGreater(entry['event_count'], 0)
+            self.assertEqual(entry['event_count'], event_counts[entry['board_id']])
+            self.assertEqual(len(runs[(entry['board_id'], 0)]), entry['event_count'])
+            self.assertIsNone(entry['error'])
+        for run in runs.values():
+            run.close()
+
+    def test_failed_board(self):
+        self.config['boards'][0]['fail'] = True
+        with Coordinator(self.config, factory=FakeBoard, timeout=10.) as coordinator:
+            self.assertEqual(coordinator.boards, [5])
+            self.assertIn('No USB device', coordinator.errors[3])
+            coordinator.start(os.path.join(self.directory, 'run'))
+            run_index = coordinator.stop()
+        self.assertEqual([entry['board_id'] for entry in run_index['boards']], [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from event_builder import encode_events, split_events, split_channels, EventBuilder
+
+
+class TestEventBuilder(unittest.TestCase):
+    def setUp(self):
+        self.sample_count = 200
+        rnd = np.random.RandomState(42)
+        self.events = rnd.randint(0, 2**14, size=(500, self.sample_count)).astype(np.uint32)
+        self.raw_data = encode_events(self.events)
+
+    def test_split_events(self):
+        # Chopped first and last event are omitted
+        raw_data = self.raw_data[50:-50].copy()
+        event_data = split_events(raw_data, self.sample_count)
+        self.assertTrue((event_data == self.events[1:-1]).all())
+
+    def test_split_events_irregular(self):
+        # Drop 7 words of the third event
+        raw_data = np.delete(self.raw_data, np.s_[450:457])
+        event_data = split_events(raw_data, self.sample_count)
+        self.assertTrue((event_data == np.delete(self.events, 2, axis=0)).all())
+
+    def test_reassembly(self):
+        builder = EventBuilder(self.sample_count)
+        bounds = np.sort(np.random.RandomState(0).randint(0, self.raw_data.shape[0], size=300))
+        event_data = [builder.build_events(read.copy()) for read in np.split(self.raw_data, bounds)]
+        event_data = np.vstack(event_data)
+        self.assertTrue((event_data == self.events).all())
+        self.assertEqual(builder.discarded_events, 0)
+        self.assertGreater(builder.recovered_events, 0)
+
+    def test_reset(self):
+        builder = EventBuilder(self.sample_count)
+        builder.build_events(self.raw_data[:1050].copy())
+        builder.reset()
+        event_data = builder.build_events(self.raw_data[1050:].copy())
+        self.assertTrue((event_data == self.events[6:]).all())
+        self.assertEqual(builder.discarded_events, 2)
+
+    def test_ring_buffer_reassembly(self):
+        builder = EventBuilder(self.sample_count, capacity=50 * self.sample_count)
+        bounds = np.sort(np.random.RandomState(1).randint(0, self.raw_data.shape[0], size=300))
+        event_data = [builder.build_events(read).copy() for read in np.split(self.raw_data, bounds)]
+        self.assertTrue((np.vstack(event_data) == self.events).all())
+        self.assertEqual(builder.ring_buffer.misses, 0)
+
+    def test_uint16_events(self):
+        for capacity in (None, 50 * self.sample_count):
+            builder = EventBuilder(self.sample_count, capacity=capacity, dtype=np.uint16)
+            reads = np.split(self.raw_data, np.arange(1, 100) * 1013)
+            event_data = [builder.build_events(read, references=1) for read in reads]
+            self.assertTrue(all(e.dtype == np.uint16 for e in event_data))
+            self.assertTrue((np.vstack(event_data) == self.events).all())
+            for e in event_data:
+                builder.release(e)
+
+    def test_ring_buffer_release(self):
+        builder = EventBuilder(self.sample_count, capacity=10 * self.sample_count)
+        reads = np.split(self.raw_data, np.arange(1, 20) * 1000)
+        held = [builder.build_events(read, references=1) for read in reads[:2]]
+        # The handed out events must not be overwritten, the ring buffer falls back to new arrays
+        for read in reads[2:]:
+            builder.build_events(read)
+        self.assertGreater(builder.ring_buffer.misses, 0)
+        self.assertTrue((np.vstack(held) == self.events[:10]).all())
+        for event_data in held:
+            builder.release(event_data)
+        misses = builder.ring_buffer.misses
+        builder.build_events(self.raw_data[-1000:])
+        self.assertEqual(builder.ring_buffer.misses, misses)
+
+    def test_split_channels(self):
+        # Words of channel 0 and 3 interleaved at random by the arbiter
+        raw_data = [encode_events(self.events[:250]), encode_events(self.events[250:], channel=3)]
+        tags = np.random.RandomState(2).permutation(np.repeat([0, 1], raw_data[0].shape[0]))
+        mixed = np.empty(tags.shape[0], dtype=np.uint32)
+        mixed[tags == 0] = raw_data[0]
+        mixed[tags == 1] = raw_data[1]
+        channel_data = split_channels(mixed, [0, 1, 3])
+        self.assertEqual(channel_data[1].shape[0], 0)
+        self.assertTrue((split_events(channel_data[0], self.sample_count) == self.events[:250]).all())
+        self.assertTrue((split_events(channel_data[2], self.sample_count) == self.events[250:]).all())
+        self.assertTrue(split_channels(raw_data[1], [3])[0] is raw_data[1])
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc is not available')
+    def test_ring_buffer_allocations(self):
+        builder = EventBuilder(self.sample_count, capacity=2**20, dtype=np.uint16, max_read_words=2**15)
+        self.assertEqual(builder._scratch.shape[0], 2**15 + self.sample_count)   # Sized to the largest read, not to the ring buffer
+        # 80 events per read, i.e. 10 ms at 8 kHz
+        reads = np.split(self.raw_data, np.arange(1, 6) * 16017)
+        read_size = reads[0].nbytes
+
+        for read in reads:                                                      # Warm up
+            builder.release(builder.build_events(read, references=1))
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            peak_increase = 0
+            for _ in range(100):
+                for read in reads:
+                    if hasattr(tracemalloc, 'reset_peak'):
+                        tracemalloc.reset_peak()
+                    builder.release(builder.build_events(read, references=1))
+                    current, peak = tracemalloc.get_traced_memory()
+                    peak_increase = max(peak_increase, peak - start)
+        finally:
+            tracemalloc.stop()
+
+        # No memory is retained and the temporary allocations per read are small compared to the read
+        self.assertLess(current - start, 1024)
+        self.assertLess(peak_increase, read_size / 10)
+        self.assertEqual(builder.ring_buffer.misses, 0)
+
+if __name__ == '__main__':
+    unittest.main()
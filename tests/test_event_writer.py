@@ -0,0 +1,142 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import tables as tb
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from event_writer import EventWriter, make_filters
+from event_run import EventRun
+from features import extract_features
+
+
+class TestEventWriter(unittest.TestCase):
+    def setUp(self):
+        self.sample_count = 200
+        rnd = np.random.RandomState(42)
+        self.events = rnd.randint(0, 2**14, size=(1000, self.sample_count)).astype(np.uint16)
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'event_data.h5')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_settings(self):
+        writer = EventWriter(self.sample_count, chunkshape=100, complib='blosc:lz4', complevel=3, shuffle='bitshuffle', flush_interval=None)
+        writer.open(self.filename)
+        for i in range(0, 1000, 80):
+            writer.append(self.events[i:i + 80])
+        writer.close()
+
+        with tb.open_file(self.filename) as infile:
+            event_data = infile.root.event_data
+            self.assertEqual(event_data.chunkshape, (100, self.sample_count))
+            self.assertEqual(event_data.filters.complib, 'blosc:lz4')
+            self.assertEqual(event_data.filters.complevel, 3)
+            self.assertTrue(event_data.filters.bitshuffle)
+            self.assertEqual(event_data.dtype, np.uint16)
+            self.assertTrue((event_data[:] == self.events).all())
+
+    def test_flush_bytes(self):
+        writer = EventWriter(self.sample_count, flush_interval=None, flush_bytes=100 * self.events[0].nbytes)
+        writer.open(self.filename)
+        for i in range(0, 1000, 50):
+            writer.append(self.events[i:i + 50])
+        self.assertEqual(writer.flushes, 10)
+        writer.close()
+        self.assertEqual(writer.get_statistics()['events_written'], 1000)
+
+    def test_rolling(self):
+        writer = EventWriter(self.sample_count, max_file_events=300)
+        writer.open(self.filename)
+        for i in range(0, 1000, 80):
+            writer.append(self.events[i:i + 80])
+        writer.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['event_data_0000.h5', 'event_data_0001.h5', 'event_data_0002.h5', 'event_data_0003.h5', 'event_data_index.json'])
+        self.assertEqual([entry['n_events'] for entry in writer.index['files']], [300, 300, 300, 100])
+
+        with EventRun(os.path.join(self.directory, 'event_data_index.json')) as run:
+            self.assertEqual(run.shape, self.events.shape)
+            self.assertTrue((run.read() == self.events).all())
+            self.assertTrue((run[250:650] == self.events[250:650]).all())
+            self.assertTrue((run[-1] == self.events[-1]).all())
+            self.assertEqual([first_event for first_event, _ in run.iter_blocks(400)], [0, 400, 800])
+
+    def test_iter_chunks(self):
+        writer = EventWriter(self.sample_count, chunkshape=100, max_file_events=450)
+        writer.open(self.filename)
+        for i in range(0, 1000, 80):
+            writer.append(self.events[i:i + 80])
+        writer.close()
+
+        with EventRun(writer.index_filename) as run:
+            block_bytes = 200 * self.sample_count * self.events.itemsize
+            blocks = list(run.iter_chunks(block_bytes))
+            self.assertEqual([first_event for first_event, _ in blocks], [0, 200, 400, 450, 650, 850, 900])   # Whole chunks of 100 events, split at the file boundaries
+            self.assertTrue((np.concatenate([data for _, data in blocks]) == self.events).all())
+            blocks = list(run.iter_chunks(1, start=130, stop=420))                 # At least one chunk per block
+            self.assertEqual([(first_event, len(data)) for first_event, data in blocks], [(130, 70), (200, 100), (300, 100), (400, 20)])
+            self.assertTrue((np.concatenate([data for _, data in blocks]) == self.events[130:420]).all())
+
+    def test_readout_data(self):
+        writer = EventWriter(self.sample_count, max_file_events=300)
+        writer.open(self.filename)
+        for i, n_events in enumerate((80, 0, 400, 120, 400)):
+            first_event = writer.events_written
+            writer.append(self.events[first_event:first_event + n_events], (1000. + i, 2000, 1, n_events * self.sample_count, i % 2))
+        writer.close()
+
+        with EventRun(writer.index_filename) as run:
+            readout_data = run.read_readouts()
+        self.assertEqual(readout_data.shape[0], 5)
+        self.assertEqual(readout_data['n_events'].tolist(), [80, 0, 400, 120, 400])
+        self.assertEqual(readout_data['first_event'].tolist(), [0, 80, 80, 480, 600])
+        self.assertEqual(readout_data['timestamp'].tolist(), [1000., 1001., 1002., 1003., 1004.])
+        self.assertEqual(readout_data['count_lost'].tolist(), [0, 1, 0, 1, 0])
+        self.assertTrue((readout_data['fifo_words'] == readout_data['n_events'] * self.sample_count).all())
+
+    def test_features_only(self):
+        writer = EventWriter(self.sample_count, waveform_prescale=10)
+        writer.open(self.filename)
+        for i in range(0, 1000, 80):
+            writer.append(self.events[i:i + 80], features=extract_features(self.events[i:i + 80]))
+        writer.close()
+
+        with EventRun(writer.index_filename) as run:
+            feature_data = run.read_features()
+            self.assertEqual(len(run), 100)
+            self.assertTrue((run.read() == self.events[::10]).all())
+        self.assertEqual(feature_data['event_number'].tolist(), list(range(1000)))
+        stored = feature_data['waveform_index'] >= 0
+        self.assertTrue((feature_data['event_number'][stored] == np.arange(0, 1000, 10)).all())
+        self.assertTrue((feature_data['waveform_index'][stored] == np.arange(100)).all())
+
+    def test_unclosed_file(self):
+        writer = EventWriter(self.sample_count, flush_interval=None, max_file_events=500)
+        writer.open(self.filename)
+        writer.append(self.events[:700])
+        writer.flush()
+        writer.append(self.events[700:800])
+        writer.output_file.close()                                              # The run index is not updated, e.g. the process crashed
+        with EventRun(writer.index_filename) as run:
+            self.assertEqual(len(run), 700)
+            self.assertTrue((run.read() == self.events[:700]).all())
+
+    def test_no_compression(self):
+        self.assertEqual(make_filters(None).complevel, 0)
+        self.assertRaises(ValueError, make_filters, 'blosc', 5, 'byteshuffle')
+        self.assertRaises(ValueError, make_filters, 'gzip', 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from features import extract_features
+
+
+class TestFeatures(unittest.TestCase):
+    def test_pulse(self):
+        # Baseline 1000 with +-2 noise, linear rise from sample 60 to 70, peak 5000 above baseline at 70, flat tail
+        event = np.full(200, 1000, dtype=np.uint16)
+        event[:40:2] += 2
+        event[1:40:2] -= 2
+        event[60:71] += np.linspace(0, 5000, 11).astype(np.uint16)
+        event[71:] += 2000
+        features = extract_features(event[np.newaxis, :])[0]
+
+        self.assertAlmostEqual(features['baseline'], 1000.)
+        self.assertAlmostEqual(features['baseline_rms'], 2.)
+        self.assertAlmostEqual(features['amplitude'], 5000.)
+        self.assertEqual(features['peak_position'], 70)
+        self.assertEqual(features['rise_time'], 8)                              # 10% at sample 61, 90% at sample 69
+        self.assertAlmostEqual(features['integral'], np.sum(event.astype(np.float64) - 1000.), places=0)
+
+    def test_block(self):
+        rnd = np.random.RandomState(42)
+        events_data = rnd.randint(0, 2**14, size=(100, 200)).astype(np.uint16)
+        features = extract_features(events_data)
+        self.assertEqual(features.shape[0], 100)
+        for event, row in zip(events_data[:5], features[:5]):
+            baseline = np.mean(event[:40])
+            self.assertAlmostEqual(row['baseline'], baseline, places=2)
+            self.assertEqual(row['peak_position'], np.argmax(event))
+            self.assertAlmostEqual(row['amplitude'], np.amax(event) - baseline, places=2)
+        self.assertEqual(extract_features(events_data[:0]).shape[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+try:
+    import fitting
+    from fitting import fit_histogram, fit_histograms, guess_start_values, gauss, gauss_jacobian, numerical_jacobian
+except ImportError:                                                             # scipy is not installed by the CI
+    fitting = None
+
+
+@unittest.skipIf(fitting is None, 'scipy is not installed')
+class TestFitting(unittest.TestCase):
+    def setUp(self):
+        self.random = np.random.RandomState(42)
+        self.x = np.linspace(0., 1000., 201)
+        self.p_gauss = (400., 50., 300.)
+        self.y_gauss = self.random.poisson(gauss(self.x, *self.p_gauss)).astype(np.float64)
+
+    def test_jacobian(self):
+        p = (400., 50., 300.)
+        np.testing.assert_allclose(gauss_jacobian(self.x, *p), numerical_jacobian(gauss, self.x, p), rtol=1e-4, atol=1e-6)
+
+    def test_costs(self):
+        for cost in ('lsq', 'chi2', 'poisson'):
+            result = fit_histogram(self.x, self.y_gauss, 'gauss', fit_range=(100, 700), cost=cost)   # Automatic start values
+            for value, error, true in zip(result['p'], result['p_err'], self.p_gauss):
+                self.assertLess(abs(value - true), 5 * error, cost)
+            self.assertEqual(result['ndf'], 116)
+        self.assertLess(result['cost'], 2 * result['ndf'])                      # Poisson deviance
+
+        with self.assertRaises(ValueError):
+            fit_histogram(self.x, self.y_gauss, 'gauss', cost='unknown')
+        with self.assertRaises(RuntimeError):
+            fit_histogram(self.x, np.zeros_like(self.x), 'gauss')
+
+    def test_bounds(self):
+        result = fit_histogram(self.x, self.y_gauss, 'gauss', p0=(350., 50., 300.), bounds=([None, None, None], [380., None, None]))
+        self.assertLessEqual(result['p'][0], 380.)
+        result = fit_histogram(self.x, self.y_gauss, 'gauss', p0=(400., -50., -300.))   # Start values are moved into the bounds
+        self.assertGreater(min(result['p']), 0.)
+
+    @unittest.skipIf(fitting is None or fitting.landau is None, 'pylandau is not installed')
+    def test_testbeam(self):
+        x = np.linspace(0., 20000., 401)
+        p_true = (8000., 300., 600., 200., 2000., 1500.)
+        y = self.random.poisson(fitting.testbeam(x, *p_true)).astype(np.float64)
+        p0 = guess_start_values(x, y, 'testbeam', (500, 20000))
+        self.assertLess(abs(p0[0] - p_true[0]), 2000.)
+        result = fit_histogram(x, y, 'testbeam', p0, (500, 20000))
+        self.assertLess(abs(result['p'][0] - p_true[0]), 5 * result['p_err'][0])
+        self.assertLess(abs(result['p'][5] - p_true[5]), 5 * result['p_err'][5])
+
+    def test_fit_histograms(self):
+        ys = [self.y_gauss, np.zeros_like(self.x), self.random.poisson(gauss(self.x, 600., 30., 100.))]
+        for processes in (1, 2):
+            results = fit_histograms(self.x, ys, 'gauss', processes=processes)
+            np.testing.assert_array_equal(results['index'], [0, 1, 2])
+            np.testing.assert_array_equal(results['success'], [True, False, True])
+            self.assertTrue(np.isnan(results['mu'][1]))
+            self.assertLess(abs(results['mu'][2] - 600.), 5 * results['mu_err'][2])
+            self.assertLess(abs(results['sigma'][0] - 50.), 5 * results['sigma_err'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from histogram import IncrementalHistogram, find_thresholds
+
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(42)
+        self.values = rnd.randint(0, 2**14, size=10000).astype(np.uint16)
+
+    def test_fill(self):
+        histogram = IncrementalHistogram(n_bins=512)
+        for i in range(0, 10000, 80):
+            histogram.fill(self.values[i:i + 80])
+        hist, edges = np.histogram(self.values, bins=512, range=(0, 2**14))
+        self.assertTrue((histogram.counts == hist).all())
+        self.assertTrue((histogram.bin_edges() == edges).all())
+
+    def test_rebin(self):
+        histogram = IncrementalHistogram()
+        histogram.fill(self.values)
+        for n_bins in (2**14, 512, 64):
+            hist, edges = np.histogram(self.values, bins=n_bins, range=(0, 2**14))
+            self.assertTrue((histogram.rebin(n_bins) == hist).all())
+            self.assertTrue((histogram.bin_edges(n_bins) == edges).all())
+        coarse = IncrementalHistogram(n_bins=512)
+        coarse.add(histogram.counts)
+        self.assertTrue((coarse.counts == histogram.rebin(512)).all())
+        self.assertEqual(coarse.rebin(2**14).shape[0], 512)                     # No upsampling
+
+    def test_overflow_and_reset(self):
+        histogram = IncrementalHistogram(n_bins=512)
+        histogram.fill(np.array([0, 2**14 - 1, 2**14, 2**16 - 1], dtype=np.uint32))
+        self.assertEqual(histogram.counts.sum(), 2)
+        self.assertEqual(histogram.overflow, 2)
+        histogram.reset()
+        self.assertEqual(histogram.counts.sum(), 0)
+        self.assertRaises(ValueError, IncrementalHistogram, n_bins=500)
+
+
+    def test_find_thresholds(self):
+        rnd = np.random.RandomState(42)
+        thresholds = [1500, 3000, 5200]
+        for bins, hist_range in ((1024, (0, 2**14-10)), (256, (0, 2**14)), (4096, (1000, 9000))):
+            hists = []
+            for threshold in thresholds:                                        # Spectrum of triggered events: a falling background and a peak above the threshold
+                amplitudes = np.concatenate((threshold + rnd.exponential(2000., 20000), rnd.normal(7000., 500., 20000)))
+                hists.append(np.histogram(amplitudes[amplitudes >= threshold], bins=bins, range=hist_range)[0])
+            edges = np.histogram([], bins=bins, range=hist_range)[1]
+            found = find_thresholds(hists, edges)                               # All histograms at once
+            self.assertEqual(found.shape, (3,))
+            self.assertTrue(np.all((found <= thresholds) & (found > np.array(thresholds) - (edges[1] - edges[0]))))
+            self.assertEqual(find_thresholds(hists[1], edges[:-1]), found[1])   # Left bin edges only
+
+        self.assertTrue(np.isnan(find_thresholds(np.zeros(64), np.arange(65))))
+        self.assertTrue(np.isnan(find_thresholds([100, 100, 0, 0], np.arange(5))))   # No comparison with the last bins
+        self.assertRaises(ValueError, find_thresholds, np.zeros(64), np.arange(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from metrics import TimingHistogram, Metrics, write_metrics, format_metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_timing_histogram(self):
+        timer = TimingHistogram()
+        for duration in [0.5e-6] * 10 + [3e-6] * 80 + [1e-3] * 10:
+            timer.record(duration)
+        self.assertEqual(timer.count, 100)
+        self.assertEqual(timer.bins[0], 10)                                     # < 1 us
+        self.assertEqual(timer.bins[2], 80)                                     # [2, 4) us
+        self.assertEqual(timer.bins[10], 10)                                    # [512, 1024) us
+        self.assertEqual(timer.percentile(50), 4e-6)
+        self.assertEqual(timer.percentile(99), 1e-3)                            # Bin edge limited by the maximum
+        self.assertAlmostEqual(timer.total, 10 * 0.5e-6 + 80 * 3e-6 + 10 * 1e-3)
+        timer.record(1e6)
+        self.assertEqual(timer.bins[-1], 1)
+
+    def test_metrics(self):
+        metrics = Metrics()
+
+        def report():
+            for _ in range(1000):
+                metrics.count('events', 2)
+                metrics.record('decode', 1e-4)
+
+        threads = [threading.Thread(target=report) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], dict(events=8000))
+        self.assertEqual(snapshot['timers']['decode']['count'], 4000)
+        self.assertAlmostEqual(snapshot['timers']['decode']['mean'], 1e-4)
+        self.assertEqual(json.loads(json.dumps(snapshot))['counters']['events'], 8000)
+        self.assertIn('decode 0.10', format_metrics(snapshot))                  # p99 limited by the maximum
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['counters'], {})
+
+    def test_write_metrics(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'metrics.json')
+            for events in (1, 2):
+                write_metrics(filename, dict(counters=dict(events=events)))
+            with open(filename) as metrics_file:
+                self.assertEqual(json.load(metrics_file)['counters']['events'], 2)
+            self.assertEqual(os.listdir(directory), ['metrics.json'])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import zmq
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from monitor_protocol import pack_header, unpack_header, unpack_data, pack_json, unpack_json, MSG_EVENTS, MSG_METRICS, HEADER_SIZE
+
+
+class TestMonitorProtocol(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(42)
+        self.events = rnd.randint(0, 2**14, size=(80, 200)).astype(np.uint16)
+
+    def test_header(self):
+        header = pack_header(MSG_EVENTS, 12345678901, self.events, 6000, 2, 1500000000.25, board=3)
+        self.assertEqual(len(header), HEADER_SIZE)
+        meta_data = unpack_header(header)
+        self.assertEqual(meta_data['msg_type'], MSG_EVENTS)
+        self.assertEqual(meta_data['sequence'], 12345678901)
+        self.assertEqual(meta_data['dtype'], np.uint16)
+        self.assertEqual(meta_data['shape'], (80, 200))
+        self.assertEqual(meta_data['threshold'], 6000)
+        self.assertEqual(meta_data['channel'], 2)
+        self.assertEqual(meta_data['board'], 3)
+        self.assertEqual(meta_data['timestamp'], 1500000000.25)
+
+    def test_invalid_header(self):
+        header = bytearray(pack_header(MSG_EVENTS, 1, self.events, 6000, 2, 0.))
+        header[4] += 1                                                          # Version
+        self.assertRaises(ValueError, unpack_header, bytes(header))
+        self.assertRaises(ValueError, unpack_header, b'{"dtype": "uint32"}')
+
+    def test_json(self):
+        metrics = dict(counters=dict(events=12), timers=dict(decode=dict(p99=0.002)))
+        data = pack_json(metrics)
+        meta_data = unpack_header(pack_header(MSG_METRICS, 1, data, 0, 0, 0.))
+        self.assertEqual(meta_data['shape'], (data.shape[0], 1))
+        self.assertEqual(unpack_json(unpack_data(meta_data, data.tobytes())), metrics)
+
+    def test_zero_copy_transfer(self):
+        context = zmq.Context()
+        push = context.socket(zmq.PUSH)
+        pull = context.socket(zmq.PULL)
+        push.bind('inproc://monitor_protocol')
+        pull.connect('inproc://monitor_protocol')
+        try:
+            for sequence in (1, 2, 5):
+                push.send(pack_header(MSG_EVENTS, sequence, self.events, 6000, 2, 0.), flags=zmq.SNDMORE)
+                tracker = push.send(self.events, copy=False, track=True)
+                meta_data = unpack_header(pull.recv())
+                frame = pull.recv(copy=False)
+                self.assertEqual(meta_data['sequence'], sequence)
+                self.assertTrue((unpack_data(meta_data, frame) == self.events).all())
+                del frame
+                tracker.wait(1)
+                self.assertTrue(tracker.done)
+        finally:
+            push.close(linger=0)
+            pull.close(linger=0)
+            context.term()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import numpy as np
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from monitor_stream import MonitorStream
+
+
+class TestMonitorStream(unittest.TestCase):
+    def setUp(self):
+        rnd = np.random.RandomState(42)
+        self.events = rnd.randint(0, 2**14, size=(1000, 200)).astype(np.uint16)
+
+    def test_histogram(self):
+        stream = MonitorStream(n_bins=512, n_waveforms=4)
+        for i in range(0, 1000, 80):
+            stream.add(self.events[i:i + 80])
+        hist, _ = np.histogram(np.amax(self.events, axis=1), bins=512, range=(0, 2**14))
+        histogram, waveforms = stream.take()
+        self.assertTrue((histogram == hist).all())
+        self.assertEqual(stream.n_events, 1000)
+        self.assertTrue((waveforms == self.events[-4:]).all())
+
+    def test_rate(self):
+        stream = MonitorStream(rate=10.)
+        self.assertFalse(stream.due(now=100.))                                  # No data
+        stream.add(self.events[:80])
+        self.assertTrue(stream.due(now=100.))
+        stream.take(now=100.)
+        stream.add(self.events[80:160])
+        self.assertFalse(stream.due(now=100.05))
+        self.assertTrue(stream.due(now=100.11))
+        histogram, _ = stream.take(now=100.11)
+        self.assertEqual(histogram.sum(), 160)                                  # Cumulative
+
+    def test_bins(self):
+        self.assertRaises(ValueError, MonitorStream, n_bins=500)
+        self.assertEqual(MonitorStream().histogram.shift, 0)                    # Full ADC resolution by default
+        self.assertEqual(MonitorStream().take()[0].shape, (2**14, ))
+
+
+if __name__ == '__main__':
+    unittest.main()
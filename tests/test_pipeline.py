@@ -0,0 +1,104 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import time
+import threading
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from pipeline import Stage
+
+
+class GatedTarget(object):
+    '''
+        Target that blocks on every item until the gate is opened, so the queue of a stage fills deterministically.
+    '''
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.items = []
+
+    def __call__(self, item):
+        self.started.set()
+        self.gate.wait()
+        if item == 'raise':
+            raise RuntimeError('Failing item')
+        self.items.append(item)
+
+
+class TestPipeline(unittest.TestCase):
+    def make_full_stage(self, drop_policy, on_drop=None):
+        '''
+            Stage with maxsize 2 whose thread is busy with item 0 and whose queue holds items 1 and 2.
+        '''
+        self.target = GatedTarget()
+        stage = Stage('test', self.target, maxsize=2, drop_policy=drop_policy, on_drop=on_drop)
+        stage.start()
+        self.assertTrue(stage.put(0))
+        self.assertTrue(self.target.started.wait(5.))
+        self.assertTrue(stage.put(1))
+        self.assertTrue(stage.put(2))
+        return stage
+
+    def test_drop_newest(self):
+        dropped = []
+        stage = self.make_full_stage('drop_newest', on_drop=dropped.append)
+        self.assertFalse(stage.put(3))
+        self.assertEqual(dropped, [3])
+        self.target.gate.set()
+        stage.stop()
+        self.assertEqual(self.target.items, [0, 1, 2])
+        statistics = stage.get_statistics()
+        self.assertEqual((statistics['processed'], statistics['dropped'], statistics['max_depth']), (3, 1, 2))
+
+    def test_drop_oldest(self):
+        dropped = []
+        stage = self.make_full_stage('drop_oldest', on_drop=dropped.append)
+        self.assertTrue(stage.put(3))
+        self.assertEqual(dropped, [1])                                          # The evicted item
+        self.target.gate.set()
+        stage.stop()
+        self.assertEqual(self.target.items, [0, 2, 3])
+        self.assertEqual(stage.get_statistics()['dropped'], 1)
+
+    def test_block(self):
+        stage = self.make_full_stage('block')
+        producer = threading.Thread(target=stage.put, args=(3,))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())                                    # Backpressure: waits for space in the queue
+        self.target.gate.set()
+        producer.join(5.)
+        self.assertFalse(producer.is_alive())
+        stage.stop()
+        self.assertEqual(self.target.items, [0, 1, 2, 3])
+        statistics = stage.get_statistics()
+        self.assertEqual((statistics['blocked_puts'], statistics['dropped']), (1, 0))
+        self.assertGreaterEqual(statistics['blocked_time'], 0.15)
+
+    def test_stop_and_errors(self):
+        target = GatedTarget()
+        target.gate.set()
+        stage = Stage('test', target, maxsize=100)
+        stage.start()
+        for item in [0, 'raise', 1] + list(range(2, 50)):
+            stage.put(item)
+        stage.stop()                                                            # Processes everything queued before it returns
+        self.assertIsNone(stage.thread)
+        self.assertEqual(target.items, list(range(50)))
+        statistics = stage.get_statistics()
+        self.assertEqual((statistics['processed'], statistics['errors'], statistics['depth']), (51, 1, 0))
+        stage.reset_statistics()
+        self.assertEqual(stage.get_statistics()['processed'], 0)
+        self.assertRaises(ValueError, Stage, 'test', target, drop_policy='drop_all')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import logging
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from readout_scheduler import ReadoutScheduler
+
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestReadoutScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ReadoutScheduler(fifo_capacity=2**19, min_interval=0.001, max_interval=0.01, target_read_words=2**12,
+                                          max_read_words=2**14, near_full_fraction=0.5, smoothing=0.2, max_fill_rate=2**23)
+
+    def run_rate(self, rate, n_polls, now=0.):
+        '''
+            Polls at the scheduled intervals while the FIFO fills with a constant rate in words/s. Returns the time of the last poll.
+        '''
+        fifo_words = 0
+        for _ in range(n_polls):
+            fifo_words -= self.scheduler.schedule(fifo_words, now=now)
+            now += self.scheduler.interval
+            fifo_words += int(rate * self.scheduler.interval)
+        return now
+
+    def test_interval_bounds(self):
+        self.assertEqual(self.scheduler.schedule(0, now=0.), 0)
+        self.assertEqual(self.scheduler.interval, 0.001)                        # No fill rate measured yet
+        self.scheduler.schedule(0, now=0.001)
+        self.assertEqual(self.scheduler.interval, 0.01)                         # Idle: latency bound
+
+        self.run_rate(1e6, 50, now=1.)
+        self.assertAlmostEqual(self.scheduler.fill_rate, 1e6, delta=1e5)
+        self.assertAlmostEqual(self.scheduler.interval, 2**12 / 1e6, delta=0.0005)  # target_read_words per poll
+        self.run_rate(1e4, 50, now=2.)
+        self.assertEqual(self.scheduler.interval, 0.01)
+        self.run_rate(1e8, 50, now=3.)
+        self.assertEqual(self.scheduler.interval, 0.001)
+
+        scheduler = ReadoutScheduler(max_interval=1., max_fill_rate=2**23)      # Overflow bound at the worst case fill rate
+        scheduler.schedule(0, now=0.)
+        scheduler.schedule(0, now=0.1)
+        self.assertAlmostEqual(scheduler.interval, 0.5 * 2**19 / 2**23)
+
+    def test_max_read_words(self):
+        self.scheduler.schedule(0, now=0.)
+        self.assertEqual(self.scheduler.schedule(2**14 + 100, now=0.01), 2**14)
+        self.assertEqual(self.scheduler.interval, 0.001)                        # The rest is read on the next poll
+        self.assertEqual(self.scheduler.schedule(100, now=0.011), 100)
+        self.assertGreater(self.scheduler.interval, 0.001)
+
+    def test_rate_step(self):
+        now = self.run_rate(1e4, 50)
+        interval = self.scheduler.interval
+        self.scheduler.schedule(int(1e6 * interval), now=now)                   # Step to a 100 times higher rate
+        self.assertLess(self.scheduler.fill_rate, 1e6)                          # The smoothed estimate lags behind
+        self.assertAlmostEqual(self.scheduler.last_rate, 1e6, delta=1e3)
+        self.assertAlmostEqual(self.scheduler.interval, 2**12 / self.scheduler.last_rate)   # The interval follows immediately
+        self.run_rate(1e6, 50, now=now + interval)
+        self.assertAlmostEqual(self.scheduler.fill_rate, 1e6, delta=1e5)
+
+    def test_statistics(self):
+        handler = CountingHandler()
+        logging.getLogger().addHandler(handler)
+        try:
+            self.scheduler.schedule(0, now=0.)
+            for i in range(1, 11):
+                self.scheduler.schedule(2**18 + 2**14, now=0.001 * i)           # Near-full and more than max_read_words left
+            self.scheduler.schedule(0, now=0.011)
+            self.scheduler.schedule(2**18, now=0.012)
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(len(handler.records), 2)                               # Only when the FIFO becomes near-full
+        statistics = self.scheduler.get_statistics()
+        self.assertEqual(statistics['polls'], 13)
+        self.assertAlmostEqual(statistics['poll_rate'], 1000.)
+        self.assertEqual(statistics['near_overflow_events'], 11)
+        self.assertAlmostEqual(statistics['max_fill_fraction'], (2**18 + 2**14) / 2.**19)
+        self.assertAlmostEqual(statistics['words_per_read'], (11 * 2**14) / 13.)
+
+        self.scheduler.reset()
+        self.assertEqual(self.scheduler.get_statistics()['poll_rate'], 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import unittest
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import numpy as np
+import tables as tb
+qmca_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) #../
+sys.path.append( qmca_dir )
+
+from replay import ReplayDut, generate_waveforms
+from event_builder import EventBuilder, split_events, split_channels, NEW_EVENT_BIT
+from qmca import qmca
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.sample_count = 200
+        self.events = generate_waveforms(4000, self.sample_count + 50, seed=42)
+        self.events[:, 0] = np.arange(self.events.shape[0])                     # Event number as marker in the first sample
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def configure(self, dut, channels, threshold=0):
+        dut.init()
+        for channel in channels:
+            dut['fadc%d_rx' % channel].set_data_count(self.sample_count)
+            dut['fadc%d_rx' % channel].set_en_trigger(True)
+            dut['TH']['TH%d' % channel] = threshold
+        dut['TH']['EN_CH'] = sum(1 << channel for channel in channels)
+        dut['TH'].write()
+
+    def wait(self, dut):
+        start_time = time.time()
+        while not dut.is_done() and time.time() - start_time < 10.:
+            time.sleep(0.01)
+
+    def test_fifo_data(self):
+        dut = ReplayDut({0: self.events, 3: self.events}, rate=1e5, n_events=1000)
+        self.configure(dut, [0, 3], threshold=5000)
+        time.sleep(0.05)
+        raw_data = dut['DATA_FIFO'].get_data()
+        while not dut.is_done():
+            raw_data = np.concatenate((raw_data, dut['DATA_FIFO'].get_data()))
+        self.assertEqual(np.count_nonzero(raw_data & NEW_EVENT_BIT), 2000)
+        triggering = self.events[np.amax(self.events[:, :self.sample_count], axis=1) > 5000, :self.sample_count]
+        for channel_data in split_channels(raw_data, [0, 3]):
+            events = split_events(channel_data, self.sample_count, dtype=np.uint16)
+            np.testing.assert_array_equal(events, triggering[:1000])            # Only events above threshold in source order, cropped to the data count
+        self.assertEqual(dut.get_statistics()['channels'][3]['triggers'], 1000)
+        self.assertEqual(dut.get_statistics()['channels'][1]['triggers'], 0)
+
+    def test_overflow(self):
+        dut = ReplayDut(None, rate=1e5, fifo_capacity=10000)
+        self.configure(dut, [1])
+        time.sleep(0.05)
+        self.assertEqual(dut['DATA_FIFO'].FIFO_INT_SIZE, 10000)
+        self.assertEqual(dut['fadc1_rx'].get_count_lost(), 255)                 # Saturates like in the firmware
+        self.assertGreater(dut.get_statistics()['channels'][1]['lost_words'], 255)
+        dut['fadc1_rx'].reset()
+        self.assertEqual(dut['fadc1_rx'].get_count_lost(), 0)
+        dut['DATA_FIFO'].reset()
+        time.sleep(0.01)
+        self.assertEqual(dut['DATA_FIFO'].FIFO_INT_SIZE, 0)                        # The reset disables the trigger until the fadc_rx is configured again
+
+    def test_event_builder_overflow(self):
+        dut = ReplayDut({2: self.events}, rate=1e5, n_events=4000, overflow_interval=0.005)   # Random number of lost words per overflow
+        self.configure(dut, [2])
+        builder = EventBuilder(self.sample_count, dtype=np.uint16)
+        events = []
+        while not dut.is_done():
+            raw_data = np.frombuffer(dut['DATA_FIFO'].read(0, 4 * 997), dtype=np.dtype('<u4'))    # Reads that are not aligned to the events
+            events.append(builder.build_events(split_channels(raw_data, [2])[0]))
+        event_data = np.concatenate(events)
+        statistics = dut.get_statistics()['channels'][2]
+        self.assertGreater(statistics['injected_overflows'], 0)
+        self.assertNotEqual(statistics['lost_words'] % self.sample_count, 0)
+        self.assertGreater(builder.discarded_events, 0)                        # Events chopped by the overflows
+        self.assertGreater(builder.recovered_events, 0)                        # Events split across reads
+        intact = np.all(event_data == self.events[event_data[:, 0], :self.sample_count], axis=1)
+        self.assertLessEqual(np.count_nonzero(~intact), statistics['injected_overflows'])
+        self.assertTrue(np.all(np.diff(event_data[intact, 0].astype(np.int64)) > 0))
+
+    def run_qmca(self, dut, channels, **settings):
+        logging.disable(logging.ERROR)
+        device = qmca(config=dut, channel=channels, threshold=0, sample_count=self.sample_count, socket_addr='tcp://127.0.0.1:15793', **settings)
+        try:
+            device.start(os.path.join(self.directory, 'replay'))
+            self.wait(dut)
+            device.stop()
+            self.metrics = device.get_metrics()
+        finally:
+            device.close()
+            logging.disable(logging.NOTSET)
+        data = {}
+        for channel in channels:
+            with tb.open_file(device._get_channel_filename(channel)) as infile:
+                data[channel] = infile.root.event_data[:], infile.root.readout_data[:]
+        return data
+
+    def test_qmca(self):
+        dut = ReplayDut({0: self.events, 2: self.events}, rate=8000., n_events=4000)
+        metrics_file = os.path.join(self.directory, 'metrics.json')
+        data = self.run_qmca(dut, [0, 2], metrics_file=metrics_file, writer_settings=dict(flush_interval=0.1))
+        for channel in (0, 2):
+            event_data, readout_data = data[channel]
+            np.testing.assert_array_equal(event_data, self.events[:, :self.sample_count])
+            self.assertTrue(np.all(readout_data['channel'] == channel))
+            self.assertEqual(readout_data['count_lost'].sum(), 0)
+        with open(metrics_file) as infile:
+            metrics = json.load(infile)                                         # Final metrics of the run
+        self.assertEqual(metrics['counters']['events'], 8000)
+        self.assertEqual(metrics['counters']['words'], 8000 * self.sample_count)
+        self.assertNotIn('count_lost', metrics['counters'])
+        for name in ('fifo_read', 'decode', 'append', 'flush', 'send'):
+            self.assertGreater(metrics['timers'][name]['count'], 0)
+
+    def test_qmca_overflow(self):
+        dut = ReplayDut({1: self.events}, rate=8000., n_events=4000, overflow_interval=0.1, overflow_words=950)
+        event_data, readout_data = self.run_qmca(dut, [1])[1]
+        statistics = dut.get_statistics()['channels'][1]
+        self.assertGreater(statistics['injected_overflows'], 0)
+        self.assertGreater(np.count_nonzero(readout_data['count_lost']), 0)
+        self.assertEqual(self.metrics['counters']['rx_resets'], np.count_nonzero(readout_data['count_lost']))
+        intact = np.all(event_data == self.events[event_data[:, 0], :self.sample_count], axis=1)
+        self.assertLessEqual(np.count_nonzero(~intact), statistics['injected_overflows'])   # At most one spliced event per overflow
+        self.assertTrue(np.all(np.diff(event_data[intact, 0].astype(np.int64)) > 0))
+        self.assertLessEqual(event_data.shape[0], 4000 - statistics['lost_words'] // self.sample_count)
+
+
+if __name__ == '__main__':
+    unittest.main()